@@ -0,0 +1,225 @@
+"""Benchmark the crawl and the tree generation against the offline API.
+
+For every graph size, a fake_github.FakeGitHubServer serves a synthetic
+graph, and the crawl and then the tree generation run against it, each in a
+child process with its own temporary data directory. Every phase reports:
+
+  seconds: wall time of the phase.
+  requests: requests the server answered.
+  rps: requests per second.
+  bytes: response body bytes the server sent for the crawl, and JSON bytes
+      written for the tree.
+  peak_mb: peak resident memory of the child process.
+
+Results can be saved with --output and compared with a later run with
+--baseline, for example:
+
+  python benchmark.py --sizes 500,2000 --output before.json
+  python benchmark.py --sizes 500,2000 --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_github
+
+# Columns of the report, with their header and format.
+_COLUMNS = (
+    ('repos', '{:>8}', '{:>8d}'),
+    ('phase', '{:>6}', '{:>6}'),
+    ('seconds', '{:>9}', '{:>9.2f}'),
+    ('requests', '{:>9}', '{:>9d}'),
+    ('rps', '{:>8}', '{:>8.1f}'),
+    ('bytes', '{:>12}', '{:>12d}'),
+    ('peak_mb', '{:>8}', '{:>8.1f}'),
+)
+# Measures compared against a baseline.
+_COMPARED_MEASURES = ('seconds', 'requests', 'bytes', 'peak_mb')
+
+
+def RunBenchmark(sizes, fan_out=4, depth=3, concurrency=1, seed=0):
+  """Run the crawl and tree phases for every graph size.
+
+  Args:
+    sizes: List of integers for the number of repos of every graph.
+    fan_out: Integer for the dependencies of every repo.
+    depth: Integer for the depths to crawl and populate in both directions.
+    concurrency: Integer for the requests the crawl runs in parallel.
+    seed: Integer for the random seed of the graphs.
+
+  Returns:
+    List of dictionaries, one for every size and phase, with the columns of
+    the report.
+  """
+  results = []
+  for size in sizes:
+    server = fake_github.FakeGitHubServer(
+        fake_github.SyntheticGraph(size, fan_out, seed=seed)).Start()
+    data_dir = tempfile.mkdtemp(prefix='git_tree_benchmark_')
+    try:
+      for phase in ('crawl', 'tree'):
+        start_stats = server.GetStats()
+        measures = _RunPhase(phase, server.url, data_dir, depth, concurrency)
+        end_stats = server.GetStats()
+        requests = end_stats.get('requests', 0) - start_stats.get(
+            'requests', 0)
+        if phase == 'crawl':
+          num_bytes = end_stats.get('bytes', 0) - start_stats.get('bytes', 0)
+        else:
+          num_bytes = measures['bytes_written']
+        results.append({
+            'repos': size,
+            'phase': phase,
+            'seconds': measures['seconds'],
+            'requests': requests,
+            'rps': requests / measures['seconds'] if measures['seconds'] else 0,
+            'bytes': num_bytes,
+            'peak_mb': measures['peak_kb'] / 1024.0,
+        })
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(data_dir)
+  return results
+
+
+def _RunPhase(phase, api_url, data_dir, depth, concurrency):
+  """Run a phase in a child process, so its memory is measured on its own.
+
+  Args:
+    phase: String for the phase, 'crawl' or 'tree'.
+    api_url: String for the API root of the fake server.
+    data_dir: String for the data directory of the run.
+    depth: Integer for the depths to crawl and populate.
+    concurrency: Integer for the requests the crawl runs in parallel.
+
+  Returns:
+    Dictionary of the measures the child reported.
+  """
+  result_file = os.path.join(data_dir, '{}_result.json'.format(phase))
+  log_file = os.path.join(data_dir, '{}.log'.format(phase))
+  env = dict(os.environ, GIT_API_URL=api_url, GIT_TREE_DATA_DIR=data_dir)
+  # The crawl and the tree generation log progress, which only matters if
+  # the phase fails.
+  with open(log_file, 'w') as log:
+    return_code = subprocess.call(
+        [sys.executable, os.path.abspath(__file__), '--worker', phase,
+         '--depth', str(depth), '--concurrency', str(concurrency),
+         '--result', result_file],
+        env=env, stdout=log, stderr=subprocess.STDOUT)
+  if return_code:
+    with open(log_file) as log:
+      sys.stderr.write(log.read()[-10000:])
+    raise subprocess.CalledProcessError(return_code, phase)
+  with open(result_file) as result:
+    return json.load(result)
+
+
+def _RunWorker(phase, depth, concurrency, result_file):
+  """Run a phase in this process and write its measures.
+
+  Args:
+    phase: String for the phase, 'crawl' or 'tree'.
+    depth: Integer for the depths to crawl and populate.
+    concurrency: Integer for the requests the crawl runs in parallel.
+    result_file: String for the path to write the measures to.
+  """
+  # The crawler reads its token from the first argument, which the fake
+  # server does not need. The modules read GIT_API_URL and GIT_TREE_DATA_DIR
+  # when imported.
+  sys.argv[1:] = ['']
+  import crawl_git_repo_dependency
+  import dependency_matcher
+  import instrumentation
+  import populate_tree_json
+  import utilities as util
+  measures = {}
+  start_time = time.time()
+  # The phase timers and counters end up in the log of the phase.
+  with instrumentation.Instrumented():
+    if phase == 'crawl':
+      manifest_index = dependency_matcher.ManifestIndex(
+          crawl_git_repo_dependency.GIT_SCRIPT_URL)
+      for direction in ('downward', 'upward'):
+        crawl_git_repo_dependency.LoopThroughDepths(
+            direction, 1, depth, concurrency, manifest_index=manifest_index)
+    else:
+      json_file = os.path.join(util.DATA_DIR, 'all_tree_data.json')
+      with open(json_file, 'w') as js:
+        populate_tree_json.WriteTreeJSON(js, [
+            populate_tree_json.TreeGenerator(direction, depth)
+            for direction in ('downward', 'upward')])
+      measures['bytes_written'] = os.path.getsize(json_file)
+  measures['seconds'] = time.time() - start_time
+  # Linux reports the peak resident memory in kilobytes.
+  measures['peak_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  with open(result_file, 'w') as result:
+    json.dump(measures, result)
+
+
+def FormatReport(results, baseline=None):
+  """Format the results as a table.
+
+  Args:
+    results: List of result dictionaries from RunBenchmark.
+    baseline: List of result dictionaries of an earlier run to compare
+        with, or None.
+
+  Returns:
+    String for the table, with the change of every measure against the
+    baseline below each row that has one.
+  """
+  lines = [' '.join(header.format(name) for name, header, _ in _COLUMNS)]
+  baseline_rows = dict(((row['repos'], row['phase']), row)
+                       for row in baseline or [])
+  for row in results:
+    lines.append(' '.join(
+        row_format.format(row[name]) for name, _, row_format in _COLUMNS))
+    baseline_row = baseline_rows.get((row['repos'], row['phase']))
+    if baseline_row:
+      lines.append('{:>15} '.format('vs baseline') + ', '.join(
+          '{} {:+.1f}%'.format(
+              name, 100.0 * (row[name] - baseline_row[name]) /
+              baseline_row[name])
+          for name in _COMPARED_MEASURES if baseline_row[name]))
+  return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--sizes', default='200,1000,5000',
+                      help='comma separated numbers of repos to benchmark')
+  parser.add_argument('--fan-out', type=int, default=4,
+                      help='dependencies of every repo')
+  parser.add_argument('--depth', type=int, default=3,
+                      help='depths to crawl and populate')
+  parser.add_argument('--concurrency', type=int, default=1,
+                      help='requests the crawl runs in parallel')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('--output', help='file to save the results to')
+  parser.add_argument('--baseline', help='results file to compare with')
+  parser.add_argument('--worker', choices=('crawl', 'tree'),
+                      help=argparse.SUPPRESS)
+  parser.add_argument('--result', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+  if args.worker:
+    _RunWorker(args.worker, args.depth, args.concurrency, args.result)
+    sys.exit(0)
+  all_results = RunBenchmark(
+      [int(size) for size in args.sizes.split(',')], args.fan_out,
+      args.depth, args.concurrency, args.seed)
+  baseline_results = None
+  if args.baseline:
+    with open(args.baseline) as baseline_file:
+      baseline_results = json.load(baseline_file)
+  print FormatReport(all_results, baseline_results)
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(all_results, output_file, indent=2)
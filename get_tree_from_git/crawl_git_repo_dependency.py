@@ -10,23 +10,442 @@ dependencies listed in bower.json/package.json as the, and find the subsequent
 dependcies of the parent nodes.
 """
 
-import base64
 import collections
+import contextlib
+import heapq
+import itertools
 import json
-# Using pprint instead of the usual logging as I am doing data exploration as
-# well at the same time, and will need to see the data structure.
-from pprint import pprint
-import re
-import time
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import sys
+import threading
 
+import crawl_store
+import dependency_matcher
+import instrumentation
 import utilities as util
 
-GIT_SEARCH_API = 'https://api.github.com/{q}'
+# The API root can be pointed elsewhere with GIT_API_URL, for example at the
+# offline stand-in in fake_github.py.
+GIT_SEARCH_API = (os.environ.get('GIT_API_URL') or
+                  'https://api.github.com') + '/{q}'
+GIT_SCRIPT_URL = GIT_SEARCH_API.format(q='repos/{path}/contents/{file}.json')
 
 # Since most of the files we check against are front-end scripts, we first
 # check if bower.json has the dependency, and then check in package.json.
 VERIFY_FILES = ('bower', 'package')
 
+# Search result pages of 100 repos read at most per keyword. Further pages
+# are only requested while the children cap of the depth is not yet met.
+MAX_SEARCH_PAGES = 3
+
+# Keywords the crawl starts from, each the root of its own tree.
+ROOT_KEYWORDS = ('d3',)
+
+
+class FetchPool(ThreadPool):
+  """Thread pool that fetches manifest files in parallel.
+
+  Only manifest fetches go through the pool. When the keywords of a depth are
+  crawled in parallel as well, their searches run on the keyword threads;
+  the crawl engines bound the requests of all threads together with
+  util.LimitRequests, so no more than concurrency requests are in flight.
+
+  Attributes:
+    concurrency: Integer for the number of manifest fetches run at once.
+  """
+
+  def __init__(self, concurrency):
+    """Start the worker threads.
+
+    Args:
+      concurrency: Integer for the number of manifest fetches run at once.
+    """
+    ThreadPool.__init__(self, concurrency)
+    self.concurrency = concurrency
+
+
+class RequestBudget(object):
+  """Total GitHub API requests a crawl may make.
+
+  Requests are counted by the rate limit scheduler, so responses served from
+  the cache and revalidated with a 304 do not count. Crawlers reserve the
+  requests they may make before making them, so the budget is never
+  overrun, even by fetches in flight at once.
+
+  Attributes:
+    max_requests: Integer for the requests the crawl may make.
+  """
+
+  def __init__(self, max_requests):
+    """Start counting requests from now.
+
+    Args:
+      max_requests: Integer for the requests the crawl may make.
+    """
+    self.max_requests = max_requests
+    self._start_requests = self._CountRequests()
+    # Number of requests reserved and not yet made or given back.
+    self._reserved = 0
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def _CountRequests():
+    """Get the requests made so far by all crawls of the process.
+
+    Returns:
+      Integer for the number of requests over all resources.
+    """
+    return sum(util.RATE_LIMITER.GetUsage().itervalues())
+
+  def GetUsed(self):
+    """Get the requests made since the budget was set up.
+
+    Returns:
+      Integer for the number of requests.
+    """
+    return self._CountRequests() - self._start_requests
+
+  def IsExhausted(self):
+    """Check if no more requests may be made.
+
+    Returns:
+      Boolean for whether the budget is used up.
+    """
+    return self.GetUsed() >= self.max_requests
+
+  def GetRemaining(self):
+    """Get the requests that may still be reserved.
+
+    Returns:
+      Integer for the number of requests.
+    """
+    with self._lock:
+      return self.max_requests - self.GetUsed() - self._reserved
+
+  def Reserve(self, count):
+    """Reserve requests, if the budget has room for all of them.
+
+    Args:
+      count: Integer for the most requests about to be made.
+
+    Returns:
+      Boolean for whether the requests were reserved, and may be made.
+    """
+    with self._lock:
+      if self.GetUsed() + self._reserved + count > self.max_requests:
+        return False
+      self._reserved += count
+      return True
+
+  def Release(self, count):
+    """Give back reserved requests once they are made or skipped.
+
+    Args:
+      count: Integer for the requests reserved with Reserve.
+    """
+    with self._lock:
+      self._reserved -= count
+
+
+class CrawlState(object):
+  """Crawl state for one direction, shared between crawlers of a run.
+
+  The expanded repos and the evaluated repos of every parent are read from
+  the crawl store once, and then kept up to date in memory, so crawlers
+  never query the store. Concurrent crawlers check and add repos in the
+  same containers, so all reads and writes go through the lock.
+
+  A re-crawl expands the repos again in crawl order, as a fresh crawl would,
+  and records again every repo still found, from its earlier evaluation if
+  it did not change. The edges it does not record again are removed at the
+  end.
+
+  Attributes:
+    expanded_repos: Dictionary of full name to name for all repos already
+        found with matching dependencies and crawled further.
+    lock: Reentrant lock guarding the containers.
+  """
+
+  def __init__(self, direction, incremental=False):
+    """Read in the crawl state from the crawl store.
+
+    Args:
+      direction: String for children direction that the crawler is getting.
+      incremental: Boolean for whether the run re-crawls an earlier run, and
+          keeps the edges added, changed and removed for a change report.
+    """
+    self._direction = direction
+    self.expanded_repos = util.CRAWL_STORE.GetExpandedNodes(direction)
+    self._expanded_by_name = dict(
+        (name, full_name) for full_name, name in
+        self.expanded_repos.iteritems())
+    # Dictionary of parent to the dictionary of repos evaluated for it to
+    # their status.
+    self._evaluated_repos = collections.defaultdict(dict)
+    # Counter of repo full name to the parents it was found with the
+    # dependency for, whether matched or repeated.
+    self._parent_counts = collections.Counter()
+    for parent, child, status in util.CRAWL_STORE.GetEdges(direction):
+      self._evaluated_repos[parent][child] = status
+      if status != crawl_store.NO_MATCH:
+        self._parent_counts[child] += 1
+    # Dictionary of expanded repo full name to its stars plus forks, for the
+    # repos matched in this run or added from the store.
+    self._popularity = {}
+    # Dictionary of depth to the (full name, keywords) tuples of the repos
+    # matched in that depth, in crawl order, which make up the next frontier.
+    self._depth_matches = collections.defaultdict(list)
+    # Dictionary of change type to the list of changed edges, or None if
+    # changes are not tracked.
+    self._changes = (dict((change, []) for change in
+                          ('added', 'changed', 'removed'))
+                     if incremental else None)
+    # Dictionary of (parent, child) to the pushed_at time the repo was
+    # evaluated at before this run, to tell the repos that changed since.
+    self._evaluated_times = {}
+    # Set of the (parent, child) edges recorded in this run of a re-crawl.
+    self._recorded_edges = set()
+    if incremental:
+      for parent, child, pushed_at in util.CRAWL_STORE.GetEvaluatedTimes(
+          direction):
+        self._evaluated_times[(parent, child)] = pushed_at
+    self.lock = threading.RLock()
+
+  def ResetExpanded(self, start_depth):
+    """Forget the repos expanded from a depth on, to expand them again.
+
+    Args:
+      start_depth: Integer for the first depth a re-crawl goes through.
+    """
+    with self.lock:
+      self.expanded_repos = collections.OrderedDict()
+      for depth in xrange(1, start_depth):
+        for full_name, name, _ in util.CRAWL_STORE.GetDepthExpandedNodes(
+            self._direction, depth):
+          self.expanded_repos[full_name] = name
+      self._expanded_by_name = dict(
+          (name, full_name) for full_name, name in
+          self.expanded_repos.iteritems())
+
+  def GetEvaluated(self, parent):
+    """Get the repos already evaluated for a parent.
+
+    Args:
+      parent: String for the parent repo full name, or the root keyword.
+
+    Returns:
+      Set of repo full names, which is a copy that the caller can modify.
+    """
+    with self.lock:
+      return set(self._evaluated_repos[parent])
+
+  def GetStatus(self, parent, child):
+    """Get the status a repo was evaluated with for a parent.
+
+    Args:
+      parent: String for the parent repo full name, or the root keyword.
+      child: String for the evaluated repo full name.
+
+    Returns:
+      String for crawl_store.MATCH, REPEAT or NO_MATCH, or None if the repo
+      was not evaluated for the parent.
+    """
+    with self.lock:
+      return self._evaluated_repos[parent].get(child)
+
+  def IsChanged(self, parent, child, pushed_at):
+    """Check if a repo was pushed to since it was evaluated for a parent.
+
+    Repos evaluated before their times were kept are always changed.
+
+    Args:
+      parent: String for the parent repo full name, or the root keyword.
+      child: String for the evaluated repo full name.
+      pushed_at: String for the repo's current pushed_at time.
+
+    Returns:
+      Boolean for whether the repo needs to be evaluated again.
+    """
+    evaluated_at = self._evaluated_times.get((parent, child))
+    return evaluated_at is None or evaluated_at != pushed_at
+
+  def GetExpandedByName(self, name):
+    """Get the full name of an expanded repo by its name.
+
+    Args:
+      name: String for the repo name.
+
+    Returns:
+      String for the repo full name, or None if no such repo is expanded.
+    """
+    with self.lock:
+      return self._expanded_by_name.get(name)
+
+  def Record(self, depth, parent, keyword, child, status, repo_node=None,
+             replace=False, pushed_at=None):
+    """Add an evaluated repo to the crawl state and the crawl store.
+
+    Args:
+      depth: Integer for the depth the repo was evaluated in.
+      parent: String for the parent repo full name, or the root keyword.
+      keyword: String for the search keyword the repo was found for.
+      child: String for the evaluated repo full name.
+      status: String for crawl_store.MATCH, REPEAT or NO_MATCH.
+      repo_node: crawl_store.RepoNode for a matched repo.
+      replace: Boolean for whether to replace an evaluation of an earlier
+          run, for a re-crawl.
+      pushed_at: String for the repo's pushed_at time it was evaluated at.
+    """
+    with self.lock:
+      old_status = self._evaluated_repos[parent].get(child)
+      # A repo evaluated in an earlier run keeps its first evaluation.
+      if old_status is not None and not replace:
+        return
+      if status == crawl_store.MATCH:
+        util.CRAWL_STORE.AddNode(repo_node)
+        self.expanded_repos[child] = repo_node.name
+        self._expanded_by_name[repo_node.name] = child
+        self._AddMatch(depth, repo_node)
+      self._parent_counts[child] += (
+          (status != crawl_store.NO_MATCH) -
+          (old_status not in (None, crawl_store.NO_MATCH)))
+      self._evaluated_repos[parent][child] = status
+      util.CRAWL_STORE.AddEdge(
+          self._direction, depth, parent, child, keyword, status, pushed_at)
+      if self._changes is None:
+        return
+      self._recorded_edges.add((parent, child))
+      if old_status is None:
+        self._changes['added'].append((parent, child, status))
+      elif old_status != status:
+        self._changes['changed'].append((parent, child, old_status, status))
+
+  def RemoveUnrecorded(self, start_depth, end_depth):
+    """Remove the edges of the re-crawled depths not recorded again.
+
+    These are the repos no longer found for their keyword, the repos found
+    for keywords no longer crawled, and all repos evaluated below repos
+    that are no longer expanded.
+
+    Args:
+      start_depth: Integer for the first re-crawled depth.
+      end_depth: Integer for the last re-crawled depth.
+    """
+    with self.lock:
+      removed_edges = []
+      for parent, child, status in util.CRAWL_STORE.GetDepthEdges(
+          self._direction, start_depth, end_depth):
+        if (parent, child) in self._recorded_edges:
+          continue
+        self._evaluated_repos[parent].pop(child, None)
+        removed_edges.append((parent, child))
+        if status != crawl_store.NO_MATCH:
+          self._parent_counts[child] -= 1
+        self._changes['removed'].append((parent, child, status))
+      util.CRAWL_STORE.DeleteEdges(self._direction, removed_edges)
+
+  def AddStoredMatches(self, depth):
+    """Add the repos matched in a depth of an earlier run to the frontier.
+
+    Args:
+      depth: Integer for the depth to read the matched repos for.
+    """
+    with self.lock:
+      for _, _, repo_node in util.CRAWL_STORE.GetDepthExpandedNodes(
+          self._direction, depth):
+        self._AddMatch(depth, repo_node)
+
+  def _AddMatch(self, depth, repo_node):
+    """Add a matched repo to the frontier of the next depth.
+
+    Args:
+      depth: Integer for the depth the repo was matched in.
+      repo_node: crawl_store.RepoNode for the repo.
+    """
+    self._depth_matches[depth].append(
+        (repo_node.full_name, _GetNextKeywords(self._direction, repo_node)))
+    self._popularity[repo_node.full_name] = (
+        (repo_node.stargazers_count or 0) + (repo_node.forks_count or 0))
+
+  def GetPriority(self, parents):
+    """Get how valuable crawling a keyword for its parents is.
+
+    Every parent counts with its stars plus forks, times the number of
+    parents the parent itself was found for, so keywords of popular repos
+    that many others depend on, or that many repos share, come first.
+
+    Args:
+      parents: List of full names of expanded repos the keyword is for.
+
+    Returns:
+      Integer for the priority, higher for more valuable keywords.
+    """
+    with self.lock:
+      return sum(self._popularity.get(parent, 0) *
+                 max(self._parent_counts[parent], 1) for parent in parents)
+
+  def PopFrontier(self, depth):
+    """Get the keywords to crawl for the depth after a crawled depth.
+
+    Keywords are deduplicated across parents, so that each keyword is only
+    searched for once per depth.
+
+    Args:
+      depth: Integer for the crawled depth.
+
+    Returns:
+      OrderedDict of keyword to the list of parent full names it was found
+      for, in crawl order.
+    """
+    frontier = collections.OrderedDict()
+    with self.lock:
+      for full_name, keywords in self._depth_matches.pop(depth, []):
+        for keyword in keywords:
+          frontier.setdefault(keyword, []).append(full_name)
+    return frontier
+
+  def Save(self):
+    """Write all buffered rows of the crawl store."""
+    util.CRAWL_STORE.Flush()
+
+  def WriteChanges(self, file_name):
+    """Write the changes of the run as a JSON report.
+
+    The report lists the added, changed and removed edges, and the parents
+    they belong to. It is informational only: the tree is still written in
+    full from the crawl store.
+
+    Args:
+      file_name: String for the path of the report file.
+    """
+    with self.lock:
+      report = dict(self._changes, direction=self._direction)
+      report['affected_parents'] = sorted(set(
+          edge[0] for edges in self._changes.itervalues() for edge in edges))
+    with open(file_name, 'w') as report_file:
+      json.dump(report, report_file, indent=2)
+    logging.info('%d added, %d changed and %d removed edges for %s.',
+                 len(report['added']), len(report['changed']),
+                 len(report['removed']), self._direction)
+
+
+def _GetNextKeywords(direction, repo_node):
+  """Get the keywords to crawl further for a matched repo.
+
+  Args:
+    direction: String for the crawl direction.
+    repo_node: crawl_store.RepoNode for the repo.
+
+  Returns:
+    List of keywords; for downward, the repo name itself, and for upward,
+    the names of the repo's dependencies.
+  """
+  if direction == 'upward':
+    return list(repo_node.all_dependencies)
+  return [repo_node.name]
+
 
 class GitCrawler(object):
   """Crawler to go through GitHub and find library name.
@@ -39,9 +458,20 @@ class GitCrawler(object):
         keyword.
     direction: String for children direction that the crawler is getting.
     tree_depth: Integer for depths of tree data, starts from 0 as base level.
+    parents: List of full names of the repos the keyword was found for, or
+        the root keyword itself.
+    max_search_pages: Integer for the search result pages read at most.
+    incremental: Boolean for whether the keyword is re-crawled, recording
+        again all repos found, but checking repos evaluated in an earlier run
+        again only if they were pushed to since.
+    exhausted: Boolean for whether the crawl stopped short because the
+        request budget ran out.
   """
 
-  def __init__(self, keyword, direction, tree_depth):
+  def __init__(self, keyword, direction, tree_depth, parents=None,
+               crawl_state=None, fetch_pool=None, manifest_index=None,
+               max_search_pages=MAX_SEARCH_PAGES, incremental=False,
+               budget=None):
     """Set up basic search connectors.
 
     Args:
@@ -49,230 +479,791 @@ class GitCrawler(object):
           keyword.
       direction: String for children direction that the crawler is getting.
       tree_depth: Integer for depths of tree data, starts from 0 as base level.
+      parents: List of full names of the repos the keyword was found for; if
+          not given, the keyword is a root.
+      crawl_state: CrawlState shared with other crawlers of the same run; if
+          not given, the crawl state is read in from the crawl store, and
+          written back once the keyword is crawled.
+      fetch_pool: FetchPool used to fetch manifest files in parallel; if not
+          given, manifests are fetched one at a time.
+      manifest_index: dependency_matcher.ManifestIndex shared with other
+          crawlers of the same run; if not given, the crawler fetches its own
+          manifests.
+      max_search_pages: Integer for the search result pages read at most.
+      incremental: Boolean for whether the keyword is re-crawled, recording
+          again all repos found, but checking repos evaluated in an earlier
+          run again only if they were pushed to since.
+      budget: RequestBudget shared with other crawlers of the same run; if
+          given, the crawler stops before a search page or a batch of fetches
+          the budget has no room for.
     """
-    pprint('==Initiazliazing crawler for %s for %s...==' % (keyword, direction))
+    logging.debug('==Initiazliazing crawler for %s for %s...==', keyword,
+                  direction)
     self.keyword = keyword
     self.direction = direction
     self.tree_depth = tree_depth
-    # DefaultDict that stores the search's future generation info.
-    self._raw_data_file_name = '{}_raw_data_depth_{}'.format(
-        direction, tree_depth)
-    self._all_repos_file_name = '{}_all_dependent_repo_names'.format(
-        direction)
-    self._tree_dict = util.GetTreePickle(
-        self._raw_data_file_name) or collections.defaultdict(dict)
-    # Read in cumulative repo names to get overall names that have been
-    # found with matching dependencies. If not found, use set as default.
-    self._all_dependent_repo_names = util.GetTreePickle(
-        self._all_repos_file_name) or set()
+    self.parents = parents or [keyword]
+    self.max_search_pages = max_search_pages
+    self.incremental = incremental
+    self.exhausted = False
+    self._budget = budget
+    self._owns_state = crawl_state is None
+    self._crawl_state = crawl_state or CrawlState(direction)
+    self._lock = self._crawl_state.lock
+    self._fetch_pool = fetch_pool
     # We currently only search for JavaScript repositories.
     self._repo_url = GIT_SEARCH_API.format(
         q='search/repositories?per_page=100&{q_params}'.format(
             q_params='q={}+language:js&sort=stars&order=desc'.format(keyword)))
-    self._script_url = GIT_SEARCH_API.format(
-        q='repos/{path}/contents/{file}.json')
+    self._manifest_index = manifest_index or dependency_matcher.ManifestIndex(
+        GIT_SCRIPT_URL)
+
+  def _Record(self, child, status, repo_node=None, replace=False,
+              pushed_at=None):
+    """Record an evaluated repo for all parents of the keyword.
+
+    Only the first parent gets a matched repo crawled further, and for the
+    other parents the repo is a repeat.
+
+    Args:
+      child: String for the evaluated repo full name.
+      status: String for crawl_store.MATCH, REPEAT or NO_MATCH.
+      repo_node: crawl_store.RepoNode for a matched repo.
+      replace: Boolean for whether to replace the evaluation of an earlier
+          run, for a repo that changed since.
+      pushed_at: String for the repo's pushed_at time it was evaluated at.
+    """
+    for parent in self.parents:
+      self._crawl_state.Record(
+          self.tree_depth, parent, self.keyword, child, status, repo_node,
+          replace, pushed_at)
+      if status == crawl_store.MATCH:
+        status = crawl_store.REPEAT
+
+  def _Save(self):
+    """Write the crawl state if this crawler is not part of a larger run."""
+    if self._owns_state:
+      self._crawl_state.Save()
+
+  @contextlib.contextmanager
+  def _Spend(self, count):
+    """Reserve requests from the budget for the requests made in the block.
+
+    If the budget has no room for them, the crawl is marked as exhausted and
+    the block is given False.
+
+    Args:
+      count: Integer for the most requests the block makes.
+
+    Yields:
+      Boolean for whether the block may make the requests.
+    """
+    if not self._budget or not count:
+      yield True
+      return
+    if not self._budget.Reserve(count):
+      if not self.exhausted:
+        # The repos evaluated so far are kept, so crawling the keyword again
+        # picks up where this crawl stopped.
+        logging.info('Request budget ran out while crawling %s.',
+                     self.keyword)
+        self.exhausted = True
+      yield False
+      return
+    try:
+      yield True
+    finally:
+      self._budget.Release(count)
+
+  def _GetKeptDependencies(self, item, previous_status):
+    """For downward, get the dependencies a repo was evaluated with before.
+
+    Args:
+      item: Dictionary for the repo detail from the search.
+      previous_status: String for the status the repo was evaluated with for
+          the first parent, or None.
+
+    Returns:
+      Dictionary for all the dependencies of an unchanged repo with the
+      dependency, False for an unchanged repo without it, or None if the
+      repo needs to be checked.
+    """
+    if previous_status is None or self._crawl_state.IsChanged(
+        self.parents[0], item['full_name'], item.get('pushed_at')):
+      return None
+    if previous_status == crawl_store.NO_MATCH:
+      return False
+    stored_node = util.CRAWL_STORE.GetNode(item['full_name'])
+    if stored_node is None or not stored_node.all_dependencies:
+      return None
+    return stored_node.all_dependencies
+
+  def _IterSearchItems(self, max_pages):
+    """Lazily get the repos found by the keyword search, in search order.
+
+    Args:
+      max_pages: Integer for the search result pages read at most.
+
+    Yields:
+      Dictionary for the repo detail of each found repo.
+    """
+    # Results can shift between pages while we read them, so a repo may show
+    # up twice.
+    seen_repos = set()
+    # A re-crawl looks for repos pushed to since, which cached pages cannot
+    # show.
+    pages = util.IterGitPages(self._repo_url, max_pages, self.incremental)
+    for page_number in itertools.count(1):
+      # Only the page requests are timed, not the work on the found repos.
+      with self._Spend(1) as allowed, util.METRICS.Time('search'):
+        query_output = next(pages, None) if allowed else None
+      if query_output is None:
+        return
+      items = query_output.get('items', [])
+      logging.debug('Reading page %d with %d of %d found repos ...',
+                    page_number, len(items), query_output.get('total_count', 0))
+      for item in items:
+        if item['full_name'] not in seen_repos:
+          seen_repos.add(item['full_name'])
+          yield item
 
-  # The following two functions are for downward population.
+  # The following functions are for downward population. Fetching only reads
+  # the crawl state of the keyword's own parents, so keywords of a depth can
+  # be fetched in parallel, while the results are applied one keyword at a
+  # time in frontier order, as the repos expanded so far decide between a
+  # match and a repeat.
   def GetdownwardRepoList(self):
-    """For downward, get a list of all repositories with matching queries.
+    """For downward, get a list of all repositories with matching queries."""
+    self.ApplydownwardResults(self.FetchdownwardResults())
+
+  def FetchdownwardResults(self):
+    """For downward, check the repositories with matching queries.
 
-    We will get matching repositories and take the top 100 items and store the
-    item's name and create time as key-value pair.
+    We will go through matching repositories page by page until enough of
+    them have the dependency.
+
+    Returns:
+      List of (string for the repo full name, string for its previous status
+      or None, crawl_store.RepoNode for a repo with the dependency or None,
+      string for its pushed_at time) tuples of the checked repos, in search
+      order.
     """
-    query_output, _ = util.GitURLOpener(self._repo_url)
-    pprint('Checking dependency through %d found repos ...' % (
-        min(query_output['total_count'], 100)))
-    tree = self._tree_dict[self.keyword]
+    evaluated_repos = self._crawl_state.GetEvaluated(self.parents[0])
+    # Skip any repositories that have the same name as keyword, as that may be
+    # a self reference; also skip repos that were already evaluated for the
+    # parent (including a previous no match), unless they are re-crawled;
+    candidates = (
+        item for item in self._IterSearchItems(self.max_search_pages)
+        if item['name'] != self.keyword and
+        (self.incremental or item['full_name'] not in evaluated_repos))
     # We will limit each level to be 60 - 10 * depth to restrict data layout,
     # for example, the first depth will have at most 50 children nodes, and
     # each node at depth 5 will at most contain 10 children nodes.
+    max_children = 60 - (10 * self.tree_depth)
     children_count = 0
-    for item in query_output['items']:
-      if children_count >= (60 - (10 * self.tree_depth)):
+    batch_size = self._fetch_pool.concurrency if self._fetch_pool else 1
+    results = []
+    while children_count < max_children and not self.exhausted:
+      # Fetch manifests for the whole batch at once, and then go through the
+      # results in search order. Every repo takes at most one place under the
+      # children cap, so a batch no larger than the places left fetches the
+      # same repos as a one-by-one crawl would. The next search page is only
+      # requested once the batches of the previous one are used up.
+      batch_limit = min(batch_size, max_children - children_count)
+      if self._budget:
+        # The last batches shrink to what the budget has room for, so that
+        # its last requests are not left unused.
+        batch_limit = min(batch_limit, max(
+            1, self._budget.GetRemaining() // len(VERIFY_FILES)))
+      batch = list(itertools.islice(candidates, batch_limit))
+      if not batch:
         break
-      item_name = item['name']
-      # Skip any repositories that have the same name as keyword, as that may be
-      # a self reference; also skip if there happens to be a repeated search
-      # term in the same depth (including a previous no match);
-      if item_name == self.keyword or item_name in tree:
-        continue
-      dependencies = self.RepoHasDependency(item['full_name'])
-      if dependencies:
-        item['all_dependencies'] = dependencies
-        # If the matched dependency file is already created earlier in other
-        # depth, do not keep further nodes to prevent future search.
-        tree[item_name] = item
-        if item_name in self._all_dependent_repo_names:
-          tree[item_name] = {}
-        self._all_dependent_repo_names.add(item_name)
-        children_count += 1
-      # Still store the repo if there is no dependency so that we don't go back
-      # and rerun this repo.
-      else:
-        tree[item_name] = False
-      util.PickleTree(self._tree_dict, self._raw_data_file_name)
-      util.PickleTree(self._all_dependent_repo_names, self._all_repos_file_name)
-    pprint('%d repos were found that are dependent on %s' % (
-        children_count, self.keyword))
+      previous_statuses = [
+          self._crawl_state.GetStatus(self.parents[0], item['full_name'])
+          for item in batch]
+      # Repos evaluated before are only fetched again if they were pushed to
+      # since, and then past the fresh cached responses.
+      kept_dependencies = [
+          self._GetKeptDependencies(item, previous_status)
+          for item, previous_status in zip(batch, previous_statuses)]
+      unchecked_items = [
+          (item, previous_status is not None)
+          for item, previous_status, dependencies
+          in zip(batch, previous_statuses, kept_dependencies)
+          if dependencies is None]
+      # Every check fetches at most one request per manifest file; a batch
+      # the budget has no room for is left for a later crawl.
+      with self._Spend(len(unchecked_items) * len(VERIFY_FILES)) as allowed:
+        if not allowed:
+          break
+        checked_dependencies = iter(self._Map(self._CheckItem,
+                                              unchecked_items))
+      for item, previous_status, dependencies in zip(
+          batch, previous_statuses, kept_dependencies):
+        if dependencies is None:
+          dependencies = next(checked_dependencies)
+        evaluated_repos.add(item['full_name'])
+        repo_node = None
+        if dependencies:
+          # Only the fields the tree and the crawl use are kept.
+          repo_node = crawl_store.RepoNode.FromSearchItem(item, dependencies)
+          children_count += 1
+        results.append((item['full_name'], previous_status, repo_node,
+                        item.get('pushed_at')))
+    logging.info('%d repos were found that are dependent on %s',
+                 children_count, self.keyword)
+    return results
+
+  def ApplydownwardResults(self, results):
+    """For downward, record the checked repositories.
+
+    Args:
+      results: List of checked repo tuples from FetchdownwardResults.
+    """
+    with self._lock:
+      for item_full_name, previous_status, repo_node, pushed_at in results:
+        if repo_node:
+          # If the matched repo is already expanded earlier in other depth,
+          # do not keep further nodes to prevent future search.
+          status = (crawl_store.REPEAT
+                    if item_full_name in self._crawl_state.expanded_repos
+                    else crawl_store.MATCH)
+        # Still store the repo if there is no dependency so that we don't go
+        # back and rerun this repo.
+        else:
+          status = crawl_store.NO_MATCH
+        self._Record(item_full_name, status, repo_node, self.incremental,
+                     pushed_at)
+    self._Save()
+
+  def _CheckItem(self, item_refresh):
+    """Check a found repo for the dependency, for use with _Map.
+
+    Args:
+      item_refresh: Tuple with (dictionary for the repo detail, boolean for
+          whether to fetch its manifests again).
+
+    Returns:
+      Dictionary for all the dependicies of the repo, and False if the
+      keyword is not found in the dependency.
+    """
+    item, refresh = item_refresh
+    return self.RepoHasDependency(
+        item['full_name'], item.get('pushed_at'), refresh)
 
-  def RepoHasDependency(self, repo_full_name):
+  def _Map(self, func, args):
+    """Apply the function to all arguments, in parallel if there is a pool.
+
+    Args:
+      func: Function taking a single argument.
+      args: List of arguments to apply the function to.
+
+    Returns:
+      List of function outputs in the same order as args.
+    """
+    if self._fetch_pool and len(args) > 1:
+      return self._fetch_pool.map(func, args)
+    return [func(arg) for arg in args]
+
+  def RepoHasDependency(self, repo_full_name, pushed_at=None, refresh=False):
     """Checks if the repository specifies dependency of the keyword file.
 
     Args:
       repo_full_name: String for the children repository full name to verify
           dependency for.
+      pushed_at: String for the repo's pushed_at time from the search result,
+          used to tell if manifests known to be missing may have been added.
+      refresh: Boolean for whether to fetch the manifests again, for a repo
+          that changed since it was evaluated.
 
     Returns:
       Dictionary for all the dependicies of this repo, and False if the
           specified keyword is not found in the dependency.
     """
+    normalized_keyword = self._manifest_index.NormalizeKeyword(self.keyword)
     for file_name in VERIFY_FILES:
-      file_output, _ = util.GitURLOpener(self._script_url.format(
-          path=repo_full_name, file=file_name))
-      if 'content' in file_output:
-        file_dependencies = self.CheckDependency(file_output)
-        if file_dependencies:
-          pprint('Found dependency in %s (%d dependencies) in %s' % (
-              file_name, len(file_dependencies), repo_full_name))
-          return file_dependencies
-    pprint('%s has no dependency of %s.' % (repo_full_name, self.keyword))
+      manifest = self._manifest_index.GetManifest(
+          repo_full_name, file_name, pushed_at, refresh)
+      if manifest and manifest.HasDependency(normalized_keyword):
+        logging.debug('Found dependency in %s (%d dependencies) in %s',
+                      file_name, len(manifest.dependencies), repo_full_name)
+        return manifest.dependencies
+    logging.debug('%s has no dependency of %s.', repo_full_name, self.keyword)
     return False
 
-  # The following two functions are for upward population.
+  # The following functions are for upward population, fetched and applied
+  # in the same way as for downward.
   def GetupwardRepoList(self):
+    """For upward, get the repository detail for the keyword."""
+    self.ApplyupwardResults(self.FetchupwardResults())
+
+  def FetchupwardResults(self):
     """For upward, get the repository detail for the keyword.
 
     We will search for the top 100 items and return the respository for
-    item matching keyword.
+    item matching keyword. Only the first page is read, as the repo with the
+    exact name almost always ranks at the top.
+
+    Returns:
+      crawl_store.RepoNode for the repo with all its dependencies, or None
+      if no repo is found or the repo is already expanded.
     """
     # Skip population if the repo is already found with dependencies.
-    if self.keyword in self._all_dependent_repo_names:
-      pprint('Repo detail for %s was already included.' % self.keyword)
-    query_output, _ = util.GitURLOpener(self._repo_url)
-    pprint('Getting keyword repo detail through %d found repos ...' % (
-        min(query_output['total_count'], 100)))
-    # pylint: disable=undefined-loop-variable
-    for item in query_output['items']:
-      item_name = item['name']
-      if item_name == self.keyword:
-        pprint('Repo detail found for %s.' % item_name)
+    if self._crawl_state.GetExpandedByName(self.keyword):
+      return None
+    item = None
+    for search_item in self._IterSearchItems(1):
+      if search_item['name'] == self.keyword:
+        item = search_item
+        logging.debug('Repo detail found for %s.', self.keyword)
         break
     # Break function if no repo detail is found.
-    if not query_output['total_count'] or item_name != self.keyword:
-      pprint('%s is not found with repo detail.' % self.keyword)
-      return
+    if item is None:
+      if not self.exhausted:
+        logging.info('%s is not found with repo detail.', self.keyword)
+      return None
+
+    # The dependencies are read again even if the repo did not change, as
+    # they decide the next keywords, and are served from the cache then.
+    changed = (self._crawl_state.GetStatus(
+        self.parents[0], item['full_name']) is not None and
+               self._crawl_state.IsChanged(
+                   self.parents[0], item['full_name'], item.get('pushed_at')))
+    with self._Spend(len(VERIFY_FILES)) as allowed:
+      if not allowed:
+        return None
+      all_unique_dependencies = self.GetDependency(
+          item['full_name'], item.get('pushed_at'), changed)
+    logging.info('%d dependencies are found for %s.',
+                 len(all_unique_dependencies), self.keyword)
+    return crawl_store.RepoNode.FromSearchItem(item, all_unique_dependencies)
+
+  def ApplyupwardResults(self, repo_node):
+    """For upward, record the repository detail for the keyword.
 
-    all_unique_dependencies = self.GetDependency(item['full_name'])
-    # If the matched dependency file is already created earlier in other
-    # depth, do not keep further nodes to prevent future search.
-    for repo_name in all_unique_dependencies:
-      if repo_name in self._all_dependent_repo_names:
-        all_unique_dependencies[repo_name] = ''
-    item['all_dependencies'] = all_unique_dependencies
-    self._tree_dict[self.keyword] = item
-    self._all_dependent_repo_names.add(item_name)
-
-    util.PickleTree(self._tree_dict, self._raw_data_file_name)
-    util.PickleTree(self._all_dependent_repo_names, self._all_repos_file_name)
-    pprint('%d dependencies are found for %s.' % (
-        len(all_unique_dependencies), self.keyword))
-
-  def GetDependency(self, repo_full_name):
+    Args:
+      repo_node: crawl_store.RepoNode from FetchupwardResults, or None.
+    """
+    with self._lock:
+      # The repo can be expanded by a keyword applied earlier, and is then
+      # not crawled any further.
+      expanded_full_name = self._crawl_state.GetExpandedByName(self.keyword)
+      if expanded_full_name:
+        logging.debug('Repo detail for %s was already included.',
+                      self.keyword)
+        self._Record(expanded_full_name, crawl_store.REPEAT,
+                     replace=self.incremental)
+      elif repo_node:
+        # The repo can be found through a different keyword than its name,
+        # and is then not crawled any further.
+        status = (crawl_store.REPEAT
+                  if repo_node.full_name in self._crawl_state.expanded_repos
+                  else crawl_store.MATCH)
+        self._Record(repo_node.full_name, status, repo_node, self.incremental,
+                     repo_node.pushed_at)
+    self._Save()
+
+  def GetDependency(self, repo_full_name, pushed_at=None, refresh=False):
     """Get all the dependent repo names for the keyword file.
 
     Args:
       repo_full_name: String for repository full name to get dependency for.
+      pushed_at: String for the repo's pushed_at time from the search result,
+          used to tell if manifests known to be missing may have been added.
+      refresh: Boolean for whether to fetch the manifests again, for a repo
+          that changed since it was evaluated.
 
     Returns:
-      Dict for all the unique dependicies of this repo, and [] if nothing found.
+      Dict for all the unique dependicies of this repo, and {} if nothing found.
     """
     all_dependencies = {}
-    for file_name in VERIFY_FILES:
-      file_output, _ = util.GitURLOpener(self._script_url.format(
-          path=repo_full_name, file=file_name))
-      if 'content' in file_output:
-        file_dependencies = self.CheckDependency(file_output)
-        if file_dependencies:
-          all_dependencies.update(file_dependencies)
-          pprint('Found dependency in %s (%d total dependencies) in %s' % (
-              file_name, len(file_dependencies), repo_full_name))
+    # Both files are always read, so fetch them together and merge them in
+    # the VERIFY_FILES order.
+    all_manifests = self._Map(
+        lambda file_name: self._manifest_index.GetManifest(
+            repo_full_name, file_name, pushed_at, refresh), VERIFY_FILES)
+    for file_name, manifest in zip(VERIFY_FILES, all_manifests):
+      if manifest:
+        all_dependencies.update(manifest.dependencies)
+        logging.debug('Found dependency in %s (%d total dependencies) in %s',
+                      file_name, len(manifest.dependencies), repo_full_name)
     return all_dependencies
 
-  def CheckDependency(self, file_output):
-    """Check if dependency is in the specified file (either Bower or Package).
 
-    Will first decode the content with base64, and then sanitize dependencies
-    and keyword strings to allow accurate comparison.
+class CrawlEngine(object):
+  """Breadth-first crawl through the depths of a direction.
+
+  The frontier, the expanded repos and the evaluated repos are kept in one
+  CrawlState for the whole run, instead of being read in again for every
+  keyword. Keywords found for several parents of a depth are searched for
+  only once, and the crawl store writes its rows in batches as they fill up
+  and at the end of every depth.
+
+  Attributes:
+    direction: String for directions to crawl through.
+    concurrency: Integer for the number of keywords, and of manifest fetches,
+        to run in parallel, and for the most requests in flight.
+    max_search_pages: Integer for the search result pages read at most per
+        keyword.
+    incremental: Boolean for whether repos evaluated in an earlier run are
+        checked again if they were pushed to since.
+  """
+
+  def __init__(self, direction, concurrency=1,
+               max_search_pages=MAX_SEARCH_PAGES, incremental=False,
+               manifest_index=None):
+    """Read in the crawl state.
 
     Args:
-      file_output: String for content object in Base64 encoding.
+      direction: String for directions to crawl through.
+      concurrency: Integer for the number of keywords, and of manifest
+          fetches, to run in parallel; with 1 the keywords are crawled one by
+          one, otherwise all keywords of a depth are fetched together and
+          recorded in order, and manifests are fetched in batches; it is
+          also the most requests in flight at once.
+      max_search_pages: Integer for the search result pages read at most per
+          keyword.
+      incremental: Boolean for whether repos evaluated in an earlier run are
+          checked again if they were pushed to since; the edges added,
+          changed and removed are written to a change report.
+      manifest_index: dependency_matcher.ManifestIndex shared with the crawl
+          of the other direction; if not given, the engine keeps its own.
+    """
+    self.direction = direction
+    self.concurrency = concurrency
+    self.max_search_pages = max_search_pages
+    self.incremental = incremental
+    self._crawl_state = CrawlState(direction, incremental)
+    # Manifests are kept decoded for the run, as the same repos come up in
+    # the searches of many keywords.
+    self._manifest_index = manifest_index or dependency_matcher.ManifestIndex(
+        GIT_SCRIPT_URL)
+    self._method_name = 'Get{}RepoList'.format(direction)
+    self._fetch_method_name = 'Fetch{}Results'.format(direction)
+    self._apply_method_name = 'Apply{}Results'.format(direction)
 
-    Returns:
-      For downward, if the keyword is found in the dependency section, then
-          return dependency dicitonary, else return False.
-      For upward, return the dependencies.
+  def Run(self, start_depth, end_depth, root_keywords=ROOT_KEYWORDS):
+    """Crawl the depths from start to end.
+
+    All roots are crawled together, depth by depth, so a repo found under
+    several roots is fetched and expanded once, and is a repeat under the
+    roots that find it later.
+
+    Args:
+      start_depth: Integer for the starting depth to loop through.
+      end_depth: Integer for the ending depth to loop through.
+      root_keywords: List of the keywords the crawl starts from.
     """
-    # If contents are not properly formatted, we will skip to the end.
+    if start_depth == 1:
+      frontier = collections.OrderedDict(
+          (root_keyword, [root_keyword]) for root_keyword in root_keywords)
+    else:
+      # Continue an earlier crawl, where some keywords of the starting depth
+      # may already be crawled.
+      self._crawl_state.AddStoredMatches(start_depth - 1)
+      frontier = self._crawl_state.PopFrontier(start_depth - 1)
+    if self.incremental:
+      # A re-crawl expands the repos again in crawl order.
+      self._crawl_state.ResetExpanded(start_depth)
+    else:
+      self._crawl_state.AddStoredMatches(start_depth)
+    fetch_pool = keyword_pool = None
+    if self.concurrency > 1:
+      fetch_pool = FetchPool(self.concurrency)
+      keyword_pool = ThreadPool(self.concurrency)
     try:
-      file_content = json.loads(base64.b64decode(file_output['content']))
-    except ValueError:
-      pprint('Could not load dependency content!')
-      return False
-    if 'dependencies' in file_content:
-      dependencies = file_content['dependencies']
-      if self.direction == 'upward':
-        return dependencies
-      rep = re.compile(r'(\.|\-|\s)')
-      sanitized_keyword = rep.sub('', self.keyword.lower())
-      sanitized_dep_keys = [
-          rep.sub('', key.lower()) for key in dependencies.keys()]
-      if sanitized_keyword in sanitized_dep_keys:
-        return dependencies
-    return False
+      with util.LimitRequests(self.concurrency):
+        for depth in xrange(start_depth, (end_depth + 1)):
+          logging.info(
+              '==Generating Git data for %d keywords in depth %d...==',
+              len(frontier), depth)
+          with util.RATE_LIMITER.Phase('{} depth {}'.format(
+              self.direction, depth)):
+            self._CrawlDepth(depth, frontier, fetch_pool, keyword_pool)
+          self._crawl_state.Save()
+          frontier = self._crawl_state.PopFrontier(depth)
+      logging.info('Skipped %d probes of manifests known to be missing.',
+                   self._manifest_index.skipped_probes)
+      if self.incremental:
+        self._crawl_state.RemoveUnrecorded(start_depth, end_depth)
+        self._crawl_state.Save()
+        self._crawl_state.WriteChanges(os.path.join(
+            util.DATA_DIR, '{}_crawl_delta.json'.format(self.direction)))
+    finally:
+      if keyword_pool:
+        keyword_pool.terminate()
+        fetch_pool.terminate()
 
+  def _CrawlDepth(self, depth, frontier, fetch_pool, keyword_pool):
+    """Crawl all keywords of a depth.
+
+    Args:
+      depth: Integer for the depth to crawl.
+      frontier: OrderedDict of keyword to the list of parent full names.
+      fetch_pool: FetchPool for manifest fetches, or None.
+      keyword_pool: ThreadPool for crawling keywords in parallel, or None.
+    """
+    crawlers = [GitCrawler(keyword, self.direction, depth, parents,
+                           self._crawl_state, fetch_pool, self._manifest_index,
+                           self.max_search_pages, self.incremental)
+                for keyword, parents in frontier.iteritems()]
+    if not keyword_pool:
+      for crawler in crawlers:
+        getattr(crawler, self._method_name)()
+      return
+    # Searches and manifests of all keywords are fetched in parallel, and the
+    # results are recorded in frontier order, so that which repo is a match
+    # and which a repeat does not depend on the order the fetches finish in.
+    results = keyword_pool.map(
+        lambda crawler: getattr(crawler, self._fetch_method_name)(), crawlers)
+    for crawler, result in zip(crawlers, results):
+      getattr(crawler, self._apply_method_name)(result)
+
+
+class PriorityCrawlEngine(CrawlEngine):
+  """Crawl the most valuable keywords first, until a request budget runs out.
+
+  Instead of going through the depths one by one, the keywords of all depths
+  wait in one priority queue, with the roots first and then by the
+  CrawlState.GetPriority of the repos they were found for. Every crawled
+  keyword adds the keywords of the repos it matched, until the queue is
+  empty or the budget is used up. The keywords left in the queue are written
+  to data/<direction>_unexplored.json, from which a later crawl can resume.
+
+  A repo is expanded where it is matched first, which can be deeper than in
+  a depth-by-depth crawl, so the graph of an unlimited budget can differ
+  slightly from the one LoopThroughDepths crawls.
+
+  Attributes:
+    max_requests: Integer for the GitHub API requests the crawl may make.
+  """
+
+  def __init__(self, direction, max_requests, concurrency=1,
+               max_search_pages=MAX_SEARCH_PAGES, manifest_index=None):
+    """Read in the crawl state.
+
+    Args:
+      direction: String for directions to crawl through.
+      max_requests: Integer for the GitHub API requests the crawl may make.
+      concurrency: Integer for the number of manifests to fetch in parallel;
+          keywords are always crawled one by one, in priority order.
+      max_search_pages: Integer for the search result pages read at most per
+          keyword.
+      manifest_index: dependency_matcher.ManifestIndex shared with the crawl
+          of the other direction; if not given, the engine keeps its own.
+    """
+    CrawlEngine.__init__(self, direction, concurrency, max_search_pages,
+                         manifest_index=manifest_index)
+    self.max_requests = max_requests
+    self._unexplored_file = os.path.join(
+        util.DATA_DIR, '{}_unexplored.json'.format(direction))
+    # Heap of (0 for roots and 1 for the rest, negated priority, sequence,
+    # depth, keyword) tuples, where only the latest entry of a keyword counts.
+    self._queue = []
+    # Dictionary of (depth, keyword) to [list of parent full names, sequence
+    # of its latest heap entry, priority or None for a root] for the keywords
+    # waiting in the queue.
+    self._pending = {}
+    self._sequence = itertools.count()
 
-def LoopThroughDepths(direction, start_depth, end_depth=5):
+  def Run(self, end_depth, root_keywords=ROOT_KEYWORDS, resume=False):
+    """Crawl keywords in priority order until the budget is used up.
+
+    Args:
+      end_depth: Integer for the deepest depth to crawl.
+      root_keywords: List of the keywords the crawl starts from.
+      resume: Boolean for whether to start from the keywords left unexplored
+          by an earlier crawl instead of the roots.
+    """
+    budget = RequestBudget(self.max_requests)
+    if resume and os.path.isfile(self._unexplored_file):
+      with open(self._unexplored_file) as unexplored_file:
+        for entry in json.load(unexplored_file)['keywords']:
+          self._Push(entry['depth'], entry['keyword'], entry['parents'],
+                     entry['priority'])
+    else:
+      for root_keyword in root_keywords:
+        self._Push(1, root_keyword, [root_keyword], None)
+    fetch_pool = FetchPool(self.concurrency) if self.concurrency > 1 else None
+    interrupted = None
+    try:
+      with util.LimitRequests(self.concurrency), util.RATE_LIMITER.Phase(
+          '{} priority crawl'.format(self.direction)):
+        while not budget.IsExhausted():
+          work = self._Pop()
+          if work is None:
+            break
+          depth, keyword, parents, priority = work
+          crawler = GitCrawler(keyword, self.direction, depth, parents,
+                               self._crawl_state, fetch_pool,
+                               self._manifest_index, self.max_search_pages,
+                               budget=budget)
+          getattr(crawler, self._method_name)()
+          # Keywords of repos matched in the deepest depth are not crawled.
+          for next_keyword, next_parents in self._crawl_state.PopFrontier(
+              depth).iteritems():
+            if depth < end_depth:
+              self._Push(depth + 1, next_keyword, next_parents,
+                         self._crawl_state.GetPriority(next_parents))
+          if crawler.exhausted:
+            interrupted = (depth, keyword)
+            self._Push(depth, keyword, parents, priority)
+            break
+      self._crawl_state.Save()
+      self._WriteUnexplored(budget, interrupted)
+    finally:
+      if fetch_pool:
+        fetch_pool.terminate()
+
+  def _Push(self, depth, keyword, parents, priority):
+    """Add a keyword to the queue, or add parents to a waiting keyword.
+
+    Args:
+      depth: Integer for the depth to crawl the keyword in.
+      keyword: String for the keyword.
+      parents: List of parent full names, or the root keyword itself.
+      priority: Integer for the priority of the parents, or None for a root.
+    """
+    key = (depth, keyword)
+    sequence = next(self._sequence)
+    if key in self._pending:
+      waiting_parents, _, waiting_priority = self._pending[key]
+      parents = waiting_parents + [
+          parent for parent in parents if parent not in waiting_parents]
+      # Priorities are sums over the parents, so they add up.
+      if waiting_priority is None or priority is None:
+        priority = None
+      else:
+        priority += waiting_priority
+    self._pending[key] = [parents, sequence, priority]
+    heapq.heappush(self._queue, (
+        0 if priority is None else 1, -(priority or 0), sequence, depth,
+        keyword))
+
+  def _Pop(self):
+    """Take the keyword with the highest priority off the queue.
+
+    Returns:
+      Tuple of (integer for the depth, string for the keyword, list of
+      parent full names, priority), or None if the queue is empty.
+    """
+    while self._queue:
+      _, _, sequence, depth, keyword = heapq.heappop(self._queue)
+      pending = self._pending.get((depth, keyword))
+      # An entry replaced by a later push is skipped.
+      if pending is None or pending[1] != sequence:
+        continue
+      del self._pending[(depth, keyword)]
+      return (depth, keyword, pending[0], pending[2])
+    return None
+
+  def _WriteUnexplored(self, budget, interrupted):
+    """Write the keywords left in the queue, highest priority first.
+
+    Args:
+      budget: RequestBudget of the crawl.
+      interrupted: Tuple of (depth, keyword) for the keyword whose crawl the
+          budget cut short, or None.
+    """
+    keywords = []
+    while True:
+      work = self._Pop()
+      if work is None:
+        break
+      depth, keyword, parents, priority = work
+      keywords.append({
+          'depth': depth,
+          'keyword': keyword,
+          'parents': parents,
+          'priority': priority,
+          'partial': (depth, keyword) == interrupted,
+      })
+    with open(self._unexplored_file, 'w') as unexplored_file:
+      json.dump({
+          'direction': self.direction,
+          'max_requests': self.max_requests,
+          'used_requests': budget.GetUsed(),
+          'keywords': keywords,
+      }, unexplored_file, indent=2)
+    logging.info(
+        'Used %d of %d requests, and left %d keywords unexplored for %s.',
+        budget.GetUsed(), self.max_requests, len(keywords), self.direction)
+
+
+def CrawlWithBudget(direction, max_requests, end_depth=5, concurrency=1,
+                    max_search_pages=MAX_SEARCH_PAGES,
+                    root_keywords=ROOT_KEYWORDS, manifest_index=None,
+                    resume=False):
+  """Crawl the most valuable part of the graph a request budget can buy.
+
+  Args:
+    direction: String for directions to crawl through.
+    max_requests: Integer for the GitHub API requests the crawl may make.
+    end_depth: Integer for the deepest depth to crawl, default to 5.
+    concurrency: Integer for the number of manifests to fetch in parallel.
+    max_search_pages: Integer for the search result pages read at most per
+        keyword.
+    root_keywords: List of the keywords the crawl starts from.
+    manifest_index: dependency_matcher.ManifestIndex shared with the crawl
+        of the other direction.
+    resume: Boolean for whether to continue from the keywords left
+        unexplored in data/<direction>_unexplored.json.
+  """
+  PriorityCrawlEngine(direction, max_requests, concurrency, max_search_pages,
+                      manifest_index).Run(end_depth, root_keywords, resume)
+
+
+def LoopThroughDepths(direction, start_depth, end_depth=5, concurrency=1,
+                      max_search_pages=MAX_SEARCH_PAGES, incremental=False,
+                      root_keywords=ROOT_KEYWORDS, manifest_index=None):
   """Loop through various depth to get corresponding output.
 
+  There is no need to sleep between keywords, as requests wait for the rate
+  limit reset by themselves once the quota runs out.
+
   Args:
     direction: String for directions to crawl through.
     start_depth: Integer for the starting depth to loop through.
     end_depth: Integer for the ending depth to loop through, default to 5.
+    concurrency: Integer for the number of keywords, and of manifest
+        fetches, to run in parallel; with 1 the keywords are crawled one by
+        one, otherwise all keywords of a depth are fetched together and
+        recorded in order, and manifests are fetched in batches; it is
+        also the most requests in flight at once.
+    max_search_pages: Integer for the search result pages read at most per
+        keyword; a keyword stops reading pages once its children cap is met.
+    incremental: Boolean for whether to re-crawl an earlier run, checking
+        only repos pushed to since, and write the changes to
+        data/<direction>_crawl_delta.json.
+    root_keywords: List of the keywords the crawl starts from, which share
+        the fetched manifests and the expanded repos.
+    manifest_index: dependency_matcher.ManifestIndex shared with the crawl
+        of the other direction, so a manifest is fetched once for both.
   """
-  # Set the repo generation name based on direction.
-  method_name = 'Get{}RepoList'.format(direction)
-  if start_depth == 1:
-    getattr(GitCrawler('d3', direction, 1), method_name)()
-    # Increment start_depth by 1 to allow following populations.
-    start_depth += 1
-    if end_depth <= 1:
-      return
-  for depth in xrange(start_depth, (end_depth + 1)):
-    parent_file = '{}_raw_data_depth_{}'.format(direction, (depth - 1))
-    for parent, children in util.GetTreePickle(parent_file).iteritems():
-      # We will generate the keyword dict to loop through based on direction
-      # For downward, the group contains keys in children where the
-      # corresponding values are not null (which was set so for non-dependent
-      # repos or repos that are already searched).
-      # For upward, the group will be keys in the dependency dictionary we
-      # searched for.
-      keyword_dict = children[
-          'all_dependencies'] if direction == 'upward' else children
-      for child_name, child_info in keyword_dict.iteritems():
-        # Exclude all none-dependent files or already searched files.
-        if not child_info:
-          continue
-        pprint('==Generating Git data for %s in %s...==' % (
-            child_name, parent))
-        getattr(GitCrawler(child_name, direction, depth), method_name)()
-        pprint('Sleeping for 5 seconds to allow regeneration of rate limit.')
-        time.sleep(5)
+  CrawlEngine(direction, concurrency, max_search_pages, incremental,
+              manifest_index).Run(start_depth, end_depth, root_keywords)
 
 
 if __name__ == '__main__':
-  # If we need to start rerun from a cercertain step run CreateAllDependentRepos
-  # ; usage example: util.CreateAllDependentRepos('downward', 2)
-  # Get all git data for 6 depths.
-  LoopThroughDepths('downward', 1)
-  LoopThroughDepths('upward', 1, 6)
+  # If we need to continue from pickle files of an earlier crawl, import them
+  # first; usage example: util.ImportTreePickles('downward', 2)
+  # With a limited request budget, CrawlWithBudget crawls the most valuable
+  # keywords first instead, and can resume where the budget ran out.
+  # To refresh an earlier crawl, pass incremental=True to LoopThroughDepths,
+  # and write the tree again with populate_tree_json.py; the change report
+  # only lists what the re-crawl changed.
+  # Usage: crawl_git_repo_dependency.py <token> [root keyword ...]; every
+  # root gets its own tree, see populate_tree_json.py for the forest output.
+  # Progress, metrics and profiling are set up from the environment, see
+  # instrumentation.py.
+  root_keywords = sys.argv[2:] or ROOT_KEYWORDS
+  with instrumentation.Instrumented():
+    manifest_index = dependency_matcher.ManifestIndex(GIT_SCRIPT_URL)
+    # Get all git data for 6 depths.
+    LoopThroughDepths('downward', 1, root_keywords=root_keywords,
+                      manifest_index=manifest_index)
+    LoopThroughDepths('upward', 1, 6, root_keywords=root_keywords,
+                      manifest_index=manifest_index)
+    logging.info('Response cache stats: %s', util.RESPONSE_CACHE.GetStats())
+    logging.info('Connection pool stats: %s', util.HTTP_POOL.GetStats())
 
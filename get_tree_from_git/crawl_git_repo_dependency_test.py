@@ -0,0 +1,178 @@
+"""Tests for crawl_git_repo_dependency, against the offline GitHub stand-in."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import crawl_git_repo_dependency as crawler
+import crawl_store
+import fake_github
+import http_cache
+import http_pool
+import utilities as util
+
+# Small enough to crawl in seconds, large enough for repeats and caps.
+_NUM_REPOS = 300
+_END_DEPTH = 3
+
+
+class _CountingConnectionPool(http_pool.ConnectionPool):
+  """Connection pool that counts the most requests in flight at once.
+
+  Attributes:
+    most_in_flight: Integer for the most requests in flight at once so far.
+  """
+
+  def __init__(self):
+    http_pool.ConnectionPool.__init__(self)
+    self.most_in_flight = 0
+    self._in_flight = 0
+    self._count_lock = threading.Lock()
+
+  def Request(self, git_url, headers=None):
+    with self._count_lock:
+      self._in_flight += 1
+      self.most_in_flight = max(self.most_in_flight, self._in_flight)
+    try:
+      # Long enough for the requests of other threads to overlap.
+      time.sleep(0.005)
+      return http_pool.ConnectionPool.Request(self, git_url, headers)
+    finally:
+      with self._count_lock:
+        self._in_flight -= 1
+
+
+class CrawlEngineTest(unittest.TestCase):
+  """Compare crawls of the same graph done in different ways."""
+
+  def setUp(self):
+    self._temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self._temp_dir)
+    self._graph = fake_github.SyntheticGraph(_NUM_REPOS)
+    server = fake_github.FakeGitHubServer(self._graph).Start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    search_api = server.url + '/{q}'
+    self._Patch(crawler, 'GIT_SEARCH_API', search_api)
+    self._Patch(crawler, 'GIT_SCRIPT_URL', search_api.format(
+        q='repos/{path}/contents/{file}.json'))
+    # GitAPIRequest reads the token from the first argument.
+    self._Patch(sys, 'argv', [sys.argv[0], ''])
+    # Connections to the server are dropped with the pool after the test.
+    self._Patch(util, 'HTTP_POOL', http_pool.ConnectionPool())
+    for name in ('DATA_DIR', 'CRAWL_STORE', 'RESPONSE_CACHE'):
+      self._Patch(util, name, getattr(util, name))
+
+  def _Patch(self, module, name, value):
+    """Set a module attribute for the test only.
+
+    Args:
+      module: Module to set the attribute of.
+      name: String for the attribute name.
+      value: Value to set.
+    """
+    self.addCleanup(setattr, module, name, getattr(module, name))
+    setattr(module, name, value)
+
+  def _UseDataDir(self, name):
+    """Point the crawl at its own data directory.
+
+    Args:
+      name: String for the directory name within the temporary directory.
+    """
+    util.DATA_DIR = os.path.join(self._temp_dir, name)
+    if not os.path.isdir(util.DATA_DIR):
+      os.mkdir(util.DATA_DIR)
+    util.CRAWL_STORE = crawl_store.CrawlStore(
+        os.path.join(util.DATA_DIR, 'crawl_store.sqlite'))
+    util.RESPONSE_CACHE = http_cache.ResponseCache(
+        os.path.join(util.DATA_DIR, 'http_cache.sqlite'))
+
+  def _Crawl(self, incremental=False, concurrency=1):
+    """Crawl both directions into the current data directory.
+
+    Args:
+      incremental: Boolean for whether to re-crawl an earlier crawl.
+      concurrency: Integer for the number of keywords and manifest fetches
+          to run in parallel.
+
+    Returns:
+      Dictionary of direction to the sorted (parent, child, status) edges.
+    """
+    edges = {}
+    for direction in ('downward', 'upward'):
+      crawler.LoopThroughDepths(direction, 1, _END_DEPTH, concurrency,
+                                incremental=incremental)
+      edges[direction] = sorted(util.CRAWL_STORE.GetEdges(direction))
+    return edges
+
+  def testParallelMatchesSequentialCrawl(self):
+    self._UseDataDir('sequential')
+    sequential_edges = self._Crawl()
+    for run in xrange(3):
+      self._UseDataDir('parallel_{}'.format(run))
+      self.assertEqual(sequential_edges, self._Crawl(concurrency=8))
+
+  def testConcurrencyLimitsRequestsInFlight(self):
+    self._UseDataDir('parallel')
+    http_pool_counted = _CountingConnectionPool()
+    self._Patch(util, 'HTTP_POOL', http_pool_counted)
+    self._Crawl(concurrency=3)
+    self.assertGreater(http_pool_counted.most_in_flight, 1)
+    self.assertLessEqual(http_pool_counted.most_in_flight, 3)
+
+  def testBudgetCrawlStaysWithinBudget(self):
+    for direction in ('downward', 'upward'):
+      for concurrency in (1, 4):
+        for max_requests in (3, 8, 13):
+          self._UseDataDir('{}_{}_{}'.format(direction, concurrency,
+                                             max_requests))
+          crawler.CrawlWithBudget(direction, max_requests, _END_DEPTH,
+                                  concurrency)
+          with open(os.path.join(util.DATA_DIR, '{}_unexplored.json'.format(
+              direction))) as unexplored_file:
+            unexplored = json.load(unexplored_file)
+          # The budget cuts the crawl short, without being overrun.
+          self.assertTrue(unexplored['keywords'])
+          self.assertLessEqual(unexplored['used_requests'], max_requests)
+
+  def _CrawlChangedGraph(self):
+    """Crawl the graph, change it, and crawl it both again and afresh.
+
+    Returns:
+      Tuple of the edges of the first crawl, the incremental re-crawl and
+      the fresh crawl, as returned by _Crawl.
+    """
+    self._UseDataDir('incremental')
+    first_edges = self._Crawl()
+    self._graph.Mutate(_NUM_REPOS // 10)
+    incremental_edges = self._Crawl(incremental=True)
+    self._UseDataDir('fresh')
+    return (first_edges, incremental_edges, self._Crawl())
+
+  def testIncrementalMatchesFreshCrawl(self):
+    first_edges, incremental_edges, fresh_edges = self._CrawlChangedGraph()
+    self.assertNotEqual(first_edges, fresh_edges)
+    self.assertEqual(fresh_edges, incremental_edges)
+
+  def testIncrementalRemovesEdgesNoLongerFound(self):
+    first_edges, incremental_edges, fresh_edges = self._CrawlChangedGraph()
+    for direction in ('downward', 'upward'):
+      found_edges = set(
+          (parent, child) for parent, child, _ in fresh_edges[direction])
+      stale_edges = [
+          (parent, child) for parent, child, _ in first_edges[direction]
+          if (parent, child) not in found_edges]
+      self.assertTrue(stale_edges)
+      kept_edges = set(
+          (parent, child) for parent, child, _ in incremental_edges[direction])
+      self.assertFalse(kept_edges.intersection(stale_edges))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,409 @@
+"""Graph store of crawl results.
+
+All crawled repos of both directions are kept in one SQLite file, as a node
+table keyed by the repo full name and an edge table that links each parent
+repo to every repo evaluated for it. Edges are indexed by parent and by
+child, so the crawler and the tree generation look up the nodes they need
+instead of loading and merging whole depths.
+
+Rows are buffered and written in batches, each batch in one transaction, so
+a crash loses at most the last unwritten batch and never corrupts earlier
+results.
+
+Nodes are kept as compact RepoNode records rather than whole search items,
+which carry dozens of URL fields and text match metadata the tree never
+uses.
+"""
+
+import collections
+import cPickle
+import sqlite3
+import threading
+
+import instrumentation
+
+# Rows buffered before they are written in one transaction.
+DEFAULT_BATCH_SIZE = 50
+
+# Status of an evaluated repo.
+MATCH = 'match'
+# Matched repo that was already found with dependencies earlier, and thus is
+# not crawled any further.
+REPEAT = 'repeat'
+NO_MATCH = 'nomatch'
+
+# Set to True to also keep the whole search item of every node, for
+# debugging; this makes the store about ten times larger.
+KEEP_RAW_PAYLOADS = False
+
+# Strings shared by all nodes, as the same names and dependency keys come up
+# in many repos. The builtin intern only takes byte strings, and names from
+# the API are unicode.
+_INTERNED_STRINGS = {}
+
+
+def _Intern(text):
+  """Get the shared copy of a string.
+
+  Args:
+    text: String or unicode to intern, or None.
+
+  Returns:
+    The interned string, or None.
+  """
+  if text is None:
+    return None
+  return _INTERNED_STRINGS.setdefault(text, text)
+
+
+class RepoNode(object):
+  """Compact record of a crawled repo.
+
+  Attributes:
+    full_name: String for the repo full name.
+    name: String for the repo name.
+    created_at: String for the repo create time, or None.
+    pushed_at: String for the repo's last push time, or None.
+    stargazers_count: Integer for the repo stars.
+    forks_count: Integer for the repo forks.
+    all_dependencies: Tuple of the repo's dependency names.
+    raw: Dictionary for the whole search item if KEEP_RAW_PAYLOADS was set,
+        otherwise None.
+  """
+
+  __slots__ = ('full_name', 'name', 'created_at', 'pushed_at',
+               'stargazers_count', 'forks_count', 'all_dependencies', 'raw')
+
+  def __init__(self, full_name, name, created_at=None, pushed_at=None,
+               stargazers_count=0, forks_count=0, all_dependencies=(),
+               raw=None):
+    self.full_name = _Intern(full_name)
+    self.name = _Intern(name)
+    self.created_at = created_at
+    self.pushed_at = pushed_at
+    self.stargazers_count = stargazers_count
+    self.forks_count = forks_count
+    self.all_dependencies = tuple(
+        _Intern(dependency) for dependency in all_dependencies)
+    self.raw = raw
+
+  @classmethod
+  def FromSearchItem(cls, item, all_dependencies=None, keep_raw=None):
+    """Project a GitHub search item into a node record.
+
+    Args:
+      item: Dictionary for the search item of the repo.
+      all_dependencies: Iterable of the repo's dependency names; if not given,
+          the item's all_dependencies are used.
+      keep_raw: Boolean for whether to keep the whole item; if not given,
+          KEEP_RAW_PAYLOADS is used.
+
+    Returns:
+      RepoNode for the repo.
+    """
+    if all_dependencies is None:
+      all_dependencies = item.get('all_dependencies') or ()
+    if keep_raw is None:
+      keep_raw = KEEP_RAW_PAYLOADS
+    return cls(item['full_name'], item['name'], item.get('created_at'),
+               item.get('pushed_at'), item.get('stargazers_count', 0),
+               item.get('forks_count', 0), all_dependencies,
+               dict(item) if keep_raw else None)
+
+  def __getstate__(self):
+    # Pickled as a plain tuple, without the slot names.
+    return tuple(getattr(self, slot) for slot in self.__slots__)
+
+  def __setstate__(self, state):
+    self.__init__(*state)
+
+
+class CrawlStore(object):
+  """Node and edge tables of crawled repos in a SQLite file.
+
+  Edges of depth 1 use the root keyword as their parent, for example 'd3',
+  as the root itself is not a crawled repo. The connection is opened on
+  first use and shared by all threads, so every query goes through the lock.
+
+  Attributes:
+    batch_size: Integer for the rows buffered before they are written.
+  """
+
+  def __init__(self, db_file, batch_size=DEFAULT_BATCH_SIZE):
+    """Set up the store settings.
+
+    Args:
+      db_file: String for the path of the SQLite file.
+      batch_size: Integer for the rows buffered before they are written.
+    """
+    self.batch_size = batch_size
+    self._db_file = db_file
+    self._db = None
+    self._pending_nodes = {}
+    self._pending_edges = []
+    self._pending_manifests = {}
+    self._lock = threading.RLock()
+
+  def _Connect(self):
+    """Open the SQLite file and create the tables if needed.
+
+    Returns:
+      sqlite3.Connection for the store file.
+    """
+    if self._db is None:
+      self._db = sqlite3.connect(self._db_file, check_same_thread=False)
+      self._db.execute('PRAGMA journal_mode=WAL')
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS nodes ('
+          'full_name TEXT PRIMARY KEY, name TEXT, payload BLOB)')
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS edges ('
+          'direction TEXT, parent TEXT, child TEXT, depth INTEGER, '
+          'keyword TEXT, status TEXT, pushed_at TEXT, '
+          'PRIMARY KEY (direction, parent, child))')
+      # Store files written before evaluated times were kept lack the column.
+      columns = [row[1] for row in self._db.execute(
+          'PRAGMA table_info(edges)')]
+      if 'pushed_at' not in columns:
+        self._db.execute('ALTER TABLE edges ADD COLUMN pushed_at TEXT')
+      self._db.execute(
+          'CREATE INDEX IF NOT EXISTS edges_child ON edges (direction, child)')
+      self._db.execute(
+          'CREATE INDEX IF NOT EXISTS edges_depth ON edges (direction, depth)')
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS manifests ('
+          'full_name TEXT, file_name TEXT, present INTEGER, pushed_at TEXT, '
+          'PRIMARY KEY (full_name, file_name))')
+    return self._db
+
+  def AddNode(self, repo_node):
+    """Add or replace a repo node.
+
+    Args:
+      repo_node: RepoNode for the repo.
+    """
+    payload = sqlite3.Binary(cPickle.dumps(repo_node, protocol=-1))
+    with self._lock:
+      self._pending_nodes[repo_node.full_name] = (
+          repo_node.full_name, repo_node.name, payload)
+      self._FlushIfFull()
+
+  def AddEdge(self, direction, depth, parent, child, keyword, status,
+              pushed_at=None):
+    """Add or replace the edge of an evaluated repo.
+
+    Args:
+      direction: String for the crawl direction.
+      depth: Integer for the depth the repo was evaluated in.
+      parent: String for the parent repo full name, or the root keyword.
+      child: String for the evaluated repo full name.
+      keyword: String for the search keyword the repo was found for.
+      status: String for MATCH, REPEAT or NO_MATCH.
+      pushed_at: String for the repo's pushed_at time when it was evaluated,
+          or None if it is not known.
+    """
+    with self._lock:
+      self._pending_edges.append(
+          (direction, parent, child, depth, keyword, status, pushed_at))
+      self._FlushIfFull()
+
+  def DeleteEdges(self, direction, edges):
+    """Delete the edges of repos that are no longer evaluated for a parent.
+
+    Args:
+      direction: String for the crawl direction.
+      edges: List of (parent, child) tuples.
+    """
+    with self._lock:
+      # Buffered rows may hold the edges, so write them first.
+      self.Flush()
+      with self._Connect() as db:
+        db.executemany(
+            'DELETE FROM edges WHERE direction = ? AND parent = ? AND '
+            'child = ?',
+            [(direction, parent, child) for parent, child in edges])
+
+  def SetManifestPresence(self, full_name, file_name, present, pushed_at):
+    """Record whether a repo has a manifest file.
+
+    Args:
+      full_name: String for the repo full name.
+      file_name: String for the manifest file name without extension.
+      present: Boolean for whether the file exists.
+      pushed_at: String for the repo's pushed_at time when the file was
+          checked, or None if unknown.
+    """
+    with self._lock:
+      self._pending_manifests[(full_name, file_name)] = (
+          full_name, file_name, int(present), pushed_at)
+      self._FlushIfFull()
+
+  def _FlushIfFull(self):
+    """Write the buffered rows once a batch is full."""
+    if (len(self._pending_nodes) + len(self._pending_edges) +
+        len(self._pending_manifests) >= self.batch_size):
+      self.Flush()
+
+  def Flush(self):
+    """Write all buffered rows in one transaction."""
+    with self._lock:
+      if not (self._pending_nodes or self._pending_edges or
+              self._pending_manifests):
+        return
+      with instrumentation.METRICS.Time('persist'), self._Connect() as db:
+        db.executemany('INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)',
+                       self._pending_nodes.values())
+        db.executemany(
+            'INSERT OR REPLACE INTO edges VALUES (?, ?, ?, ?, ?, ?, ?)',
+            self._pending_edges)
+        db.executemany('INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?)',
+                       self._pending_manifests.values())
+      self._pending_nodes = {}
+      self._pending_edges = []
+      self._pending_manifests = {}
+
+  def _Query(self, query, args):
+    """Run a query on the store, after writing all buffered rows.
+
+    Args:
+      query: String for the SQL query.
+      args: Tuple of query arguments.
+
+    Returns:
+      List of result rows.
+    """
+    with self._lock:
+      self.Flush()
+      return self._Connect().execute(query, args).fetchall()
+
+  def GetNode(self, full_name):
+    """Get the detail of a repo node.
+
+    Args:
+      full_name: String for the repo full name.
+
+    Returns:
+      RepoNode for the repo, or None if there is no such node.
+    """
+    rows = self._Query('SELECT payload FROM nodes WHERE full_name = ?',
+                       (full_name,))
+    return _LoadNode(rows[0][0]) if rows else None
+
+  def GetChildren(self, direction, parent):
+    """Get the evaluated repos of a parent in crawl order.
+
+    Args:
+      direction: String for the crawl direction.
+      parent: String for the parent repo full name, or the root keyword.
+
+    Returns:
+      List of (child full name, status) tuples.
+    """
+    return self._Query(
+        'SELECT child, status FROM edges WHERE direction = ? AND parent = ? '
+        'ORDER BY rowid', (direction, parent))
+
+  def GetDepthExpandedNodes(self, direction, depth):
+    """Get the repos that were matched in a depth and are crawled further.
+
+    Args:
+      direction: String for the crawl direction.
+      depth: Integer for the depth.
+
+    Returns:
+      List of (repo full name, repo name, RepoNode) tuples in crawl order.
+    """
+    rows = self._Query(
+        'SELECT edges.child, nodes.name, nodes.payload FROM edges '
+        'JOIN nodes ON nodes.full_name = edges.child '
+        'WHERE edges.direction = ? AND edges.depth = ? AND edges.status = ? '
+        'ORDER BY edges.rowid', (direction, depth, MATCH))
+    return [(full_name, name, _LoadNode(payload))
+            for full_name, name, payload in rows]
+
+  def GetEdges(self, direction):
+    """Get all evaluated edges of a direction.
+
+    Args:
+      direction: String for the crawl direction.
+
+    Returns:
+      List of (parent, child, status) tuples in crawl order.
+    """
+    return self._Query(
+        'SELECT parent, child, status FROM edges WHERE direction = ? '
+        'ORDER BY rowid', (direction,))
+
+  def GetDepthEdges(self, direction, start_depth, end_depth):
+    """Get the evaluated edges of a range of depths.
+
+    Args:
+      direction: String for the crawl direction.
+      start_depth: Integer for the first depth.
+      end_depth: Integer for the last depth.
+
+    Returns:
+      List of (parent, child, status) tuples in crawl order.
+    """
+    return self._Query(
+        'SELECT parent, child, status FROM edges WHERE direction = ? AND '
+        'depth BETWEEN ? AND ? ORDER BY rowid',
+        (direction, start_depth, end_depth))
+
+  def GetEvaluatedTimes(self, direction):
+    """Get the pushed_at times the repos of a direction were evaluated at.
+
+    Args:
+      direction: String for the crawl direction.
+
+    Returns:
+      List of (parent, child, pushed_at) tuples, where pushed_at is None for
+      edges added before the times were kept.
+    """
+    return self._Query(
+        'SELECT parent, child, pushed_at FROM edges WHERE direction = ?',
+        (direction,))
+
+  def GetExpandedNodes(self, direction):
+    """Get all repos that were matched and crawled further.
+
+    Args:
+      direction: String for the crawl direction.
+
+    Returns:
+      Dictionary of repo full name to repo name.
+    """
+    rows = self._Query(
+        'SELECT DISTINCT edges.child, nodes.name FROM edges '
+        'JOIN nodes ON nodes.full_name = edges.child '
+        'WHERE edges.direction = ? AND edges.status = ?', (direction, MATCH))
+    return collections.OrderedDict(rows)
+
+  def GetManifestPresence(self):
+    """Get whether repos have their manifest files, for all checked repos.
+
+    Returns:
+      Dictionary of (repo full name, file name) to (boolean for whether the
+      file exists, string for the repo's pushed_at time when it was checked).
+    """
+    return dict(
+        ((full_name, file_name), (bool(present), pushed_at))
+        for full_name, file_name, present, pushed_at in self._Query(
+            'SELECT full_name, file_name, present, pushed_at FROM manifests',
+            ()))
+
+
+def _LoadNode(payload):
+  """Unpickle a node payload.
+
+  Args:
+    payload: Buffer for the pickled node.
+
+  Returns:
+    RepoNode for the repo; stores written before node records were used
+    hold whole search items, which are projected on load.
+  """
+  node = cPickle.loads(str(payload))
+  if isinstance(node, dict):
+    return RepoNode.FromSearchItem(node, keep_raw=False)
+  return node
@@ -0,0 +1,255 @@
+"""Decoded manifest index for dependency matching.
+
+The same candidate repos come up in the searches of many keywords, and each
+used to have its bower.json/package.json fetched, decoded and sanitized
+again for every keyword. The index keeps the manifests of a run decoded,
+with the set of its normalized dependency names, so checking a repo against
+any number of keywords costs one set lookup per keyword and no extra API
+calls. The least recently used manifests are dropped past a bound, and are
+read from the response cache again if they come up later.
+
+Most repos have no bower.json, so the index also keeps which manifest files
+each repo has in the crawl store across runs. A file known to be missing is
+not probed again until the repo is pushed to.
+"""
+
+import base64
+import collections
+import json
+import logging
+import re
+import threading
+
+import utilities as util
+
+# Characters ignored when comparing dependency names with keywords.
+_SANITIZE_PATTERN = re.compile(r'(\.|\-|\s)')
+# Decoded manifests kept in memory before the least recently used is dropped.
+DEFAULT_MAX_MANIFESTS = 20000
+
+
+def NormalizeName(name):
+  """Sanitize a dependency name or keyword to allow accurate comparison.
+
+  Args:
+    name: String for the dependency name or keyword.
+
+  Returns:
+    String for the lower cased name without dots, dashes and spaces.
+  """
+  return _SANITIZE_PATTERN.sub('', name.lower())
+
+
+class Manifest(object):
+  """Decoded dependency section of a bower.json or package.json file.
+
+  Attributes:
+    dependencies: Dictionary of dependency name to version.
+    normalized_names: Frozenset of the normalized dependency names.
+  """
+
+  __slots__ = ('dependencies', 'normalized_names')
+
+  def __init__(self, dependencies):
+    self.dependencies = dependencies
+    self.normalized_names = frozenset(
+        NormalizeName(name) for name in dependencies)
+
+  def HasDependency(self, normalized_keyword):
+    """Check if the manifest lists a dependency.
+
+    Args:
+      normalized_keyword: String for the keyword, already normalized.
+
+    Returns:
+      Boolean for whether the keyword is a dependency.
+    """
+    return normalized_keyword in self.normalized_names
+
+
+def ParseManifest(file_output):
+  """Decode the dependency section of a manifest file from the contents API.
+
+  Args:
+    file_output: Dictionary for the contents API response, with the file
+        content in Base64 encoding.
+
+  Returns:
+    Manifest for the file, or None if the file is not properly formatted or
+    has no dependencies.
+  """
+  # If contents are not properly formatted, we will skip to the end.
+  try:
+    file_content = json.loads(base64.b64decode(file_output['content']))
+  except ValueError:
+    logging.warning('Could not load dependency content!')
+    return None
+  if isinstance(file_content, dict) and file_content.get('dependencies'):
+    return Manifest(file_content['dependencies'])
+  return None
+
+
+class ManifestIndex(object):
+  """Size-bounded LRU index of the manifests of the repos seen in a run.
+
+  The index is shared by all crawlers and threads of a run; a repo's
+  manifest is fetched under a per-file lock, so that two crawlers checking
+  the same repo at the same time share one request.
+
+  Attributes:
+    max_manifests: Integer for the manifests to keep before dropping the least
+        recently used.
+    skipped_probes: Integer for the fetches skipped for files known to be
+        missing.
+  """
+
+  def __init__(self, script_url, max_manifests=DEFAULT_MAX_MANIFESTS):
+    """Set up the empty index.
+
+    Args:
+      script_url: String for the contents API URL template, with path and
+          file placeholders.
+      max_manifests: Integer for the manifests to keep before dropping the
+          least recently used.
+    """
+    self._script_url = script_url
+    self.max_manifests = max_manifests
+    # Ordered dictionary of (repo full name, file name) to Manifest or None,
+    # from the least to the most recently used.
+    self._manifests = collections.OrderedDict()
+    self._fetch_locks = {}
+    self._lock = threading.Lock()
+    # Dictionary of keyword to its normalized name.
+    self._normalized_keywords = {}
+    # Dictionary of (repo full name, file name) to (whether the file exists,
+    # repo pushed_at time when it was checked), kept across runs.
+    self._presence = util.CRAWL_STORE.GetManifestPresence()
+    self.skipped_probes = 0
+
+  def GetManifest(self, repo_full_name, file_name, pushed_at=None,
+                  refresh=False):
+    """Get the decoded manifest of a repo, fetching it on first use.
+
+    Args:
+      repo_full_name: String for the repository full name.
+      file_name: String for the manifest file name without extension.
+      pushed_at: String for the repo's current pushed_at time; a file is
+          fetched again past its cached response if the repo was pushed to
+          since it was checked. If None, a file known to be missing is not
+          probed.
+      refresh: Boolean for whether to fetch the file again even if it is known
+          to be missing or its cached response is still fresh, for repos that
+          changed since they were checked. A file is still fetched at most once
+          while the index keeps it.
+
+    Returns:
+      Manifest for the file, or None if the file is missing or has no
+      dependencies.
+    """
+    key = (repo_full_name, file_name)
+    with self._lock:
+      if key in self._manifests:
+        return self._Touch(key)
+      if not refresh and self._IsKnownMissing(key, pushed_at):
+        self.skipped_probes += 1
+        self._Keep(key, None)
+        return None
+      # A repo can turn up for another parent after it changed, and its
+      # cached file is then outdated even though the parent never saw it.
+      refresh = refresh or self._IsPushedSince(key, pushed_at)
+      fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+    with fetch_lock:
+      # Another thread may have fetched the file while we waited.
+      with self._lock:
+        if key in self._manifests:
+          return self._Touch(key)
+      with util.METRICS.Time('manifest_fetch'):
+        status, file_output, _, _ = util.GitAPIRequest(
+            self._script_url.format(path=repo_full_name, file=file_name),
+            revalidate=refresh)
+      with util.METRICS.Time('decode'):
+        manifest = (ParseManifest(file_output) if 'content' in file_output
+                    else None)
+      with self._lock:
+        self._Keep(key, manifest)
+        del self._fetch_locks[key]
+        # Other errors say nothing about the file, and are not recorded.
+        if status in (200, 404):
+          self._presence[key] = (status == 200, pushed_at)
+          util.CRAWL_STORE.SetManifestPresence(
+              repo_full_name, file_name, status == 200, pushed_at)
+    return manifest
+
+  def _Touch(self, key):
+    """Get a kept manifest, and mark it as the most recently used.
+
+    Must be called with the lock held.
+
+    Args:
+      key: Tuple of (repo full name, file name) of a kept manifest.
+
+    Returns:
+      Manifest for the file, or None.
+    """
+    manifest = self._manifests.pop(key)
+    self._manifests[key] = manifest
+    return manifest
+
+  def _Keep(self, key, manifest):
+    """Keep a manifest, dropping the least recently used past the bound.
+
+    Must be called with the lock held.
+
+    Args:
+      key: Tuple of (repo full name, file name).
+      manifest: Manifest for the file, or None.
+    """
+    self._manifests[key] = manifest
+    while len(self._manifests) > self.max_manifests:
+      self._manifests.popitem(last=False)
+
+  def _IsKnownMissing(self, key, pushed_at):
+    """Check if a manifest file is known to be missing from a repo.
+
+    Args:
+      key: Tuple of (repo full name, file name).
+      pushed_at: String for the repo's current pushed_at time, or None.
+
+    Returns:
+      Boolean for whether the file can be skipped without probing.
+    """
+    if key not in self._presence:
+      return False
+    present, checked_pushed_at = self._presence[key]
+    if present:
+      return False
+    return pushed_at is None or pushed_at == checked_pushed_at
+
+  def _IsPushedSince(self, key, pushed_at):
+    """Check if a repo was pushed to since its manifest file was checked.
+
+    Args:
+      key: Tuple of (repo full name, file name).
+      pushed_at: String for the repo's current pushed_at time, or None.
+
+    Returns:
+      Boolean for whether the file may have changed since.
+    """
+    if key not in self._presence or pushed_at is None:
+      return False
+    return pushed_at != self._presence[key][1]
+
+  def NormalizeKeyword(self, keyword):
+    """Get the normalized name of a keyword, computed once per keyword.
+
+    Args:
+      keyword: String for the keyword.
+
+    Returns:
+      String for the normalized keyword.
+    """
+    normalized_keyword = self._normalized_keywords.get(keyword)
+    if normalized_keyword is None:
+      normalized_keyword = NormalizeName(keyword)
+      self._normalized_keywords[keyword] = normalized_keyword
+    return normalized_keyword
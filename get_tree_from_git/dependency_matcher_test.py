@@ -0,0 +1,116 @@
+"""Tests for dependency_matcher."""
+
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import crawl_store
+import dependency_matcher
+import utilities as util
+
+_SCRIPT_URL = 'https://api.github.test/repos/{path}/contents/{file}.json'
+
+
+class ManifestIndexTest(unittest.TestCase):
+  """Fetch manifests against recorded responses, across two runs."""
+
+  def setUp(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    self.addCleanup(setattr, util, 'CRAWL_STORE', util.CRAWL_STORE)
+    util.CRAWL_STORE = crawl_store.CrawlStore(
+        os.path.join(temp_dir, 'crawl.sqlite'))
+    self.addCleanup(setattr, util, 'GitAPIRequest', util.GitAPIRequest)
+    util.GitAPIRequest = self._GitAPIRequest
+    # Dictionary of URL to the manifest dependencies, for the files that
+    # exist.
+    self._files = {
+        _SCRIPT_URL.format(path='a/lib', file='package'): {'d3': '^3.5'},
+    }
+    # List of (URL, whether it was revalidated) tuples of the requests.
+    self.requests = []
+
+  def _GitAPIRequest(self, git_url, revalidate=False):
+    """Answer a request from the files, see utilities.GitAPIRequest."""
+    self.requests.append((git_url, revalidate))
+    if git_url not in self._files:
+      return (404, {}, 0, None)
+    content = base64.b64encode(json.dumps(
+        {'dependencies': self._files[git_url]}))
+    return (200, {'content': content}, None, None)
+
+  def _NewRun(self):
+    """Start a new run, with the presence kept by the earlier ones.
+
+    Returns:
+      ManifestIndex for the run.
+    """
+    util.CRAWL_STORE.Flush()
+    self.requests = []
+    return dependency_matcher.ManifestIndex(_SCRIPT_URL)
+
+  def testManifestIsFetchedOncePerRun(self):
+    manifest_index = self._NewRun()
+    for _ in xrange(2):
+      manifest = manifest_index.GetManifest('a/lib', 'package', 't1')
+      self.assertTrue(manifest.HasDependency('d3'))
+    self.assertEqual(1, len(self.requests))
+
+  def testLeastRecentlyUsedManifestIsDropped(self):
+    self._files[_SCRIPT_URL.format(path='b/lib', file='package')] = {
+        'd3': '^4.0'}
+    manifest_index = dependency_matcher.ManifestIndex(_SCRIPT_URL,
+                                                      max_manifests=2)
+    for repo_full_name in ('a/lib', 'b/lib', 'a/lib', 'c/lib', 'a/lib',
+                           'b/lib'):
+      manifest_index.GetManifest(repo_full_name, 'package', 't1')
+    self.assertEqual(
+        [_SCRIPT_URL.format(path=repo_full_name, file='package')
+         for repo_full_name in ('a/lib', 'b/lib', 'c/lib', 'b/lib')],
+        [git_url for git_url, _ in self.requests])
+
+  def testMissingManifestIsSkippedUntilPushed(self):
+    self._NewRun().GetManifest('a/lib', 'bower', 't1')
+    manifest_index = self._NewRun()
+    self.assertIsNone(manifest_index.GetManifest('a/lib', 'bower', 't1'))
+    self.assertEqual([], self.requests)
+    self.assertEqual(1, manifest_index.skipped_probes)
+    manifest_index = self._NewRun()
+    self.assertIsNone(manifest_index.GetManifest('a/lib', 'bower', 't2'))
+    self.assertEqual(1, len(self.requests))
+
+  def testManifestIsRevalidatedOnlyAfterPush(self):
+    self._NewRun().GetManifest('a/lib', 'package', 't1')
+    self._NewRun().GetManifest('a/lib', 'package', 't1')
+    self.assertEqual([(_SCRIPT_URL.format(path='a/lib', file='package'),
+                       False)], self.requests)
+    # A repo pushed to since is revalidated, even without refresh, as it can
+    # turn up for a parent that never saw it before.
+    self._NewRun().GetManifest('a/lib', 'package', 't2')
+    self.assertEqual([(_SCRIPT_URL.format(path='a/lib', file='package'),
+                       True)], self.requests)
+
+  def testRefreshRevalidatesManifest(self):
+    self._NewRun().GetManifest('a/lib', 'bower', 't1')
+    manifest_index = self._NewRun()
+    self.assertIsNone(manifest_index.GetManifest(
+        'a/lib', 'bower', 't1', refresh=True))
+    self.assertEqual([(_SCRIPT_URL.format(path='a/lib', file='bower'),
+                       True)], self.requests)
+
+  def testManifestWithoutPushTimeIsNotRevalidated(self):
+    manifest_index = self._NewRun()
+    manifest_index.GetManifest('a/lib', 'package', 't1')
+    manifest_index.GetManifest('a/lib', 'bower', 't1')
+    manifest_index = self._NewRun()
+    self.assertTrue(manifest_index.GetManifest('a/lib', 'package'))
+    self.assertIsNone(manifest_index.GetManifest('a/lib', 'bower'))
+    self.assertEqual([(_SCRIPT_URL.format(path='a/lib', file='package'),
+                       False)], self.requests)
+
+
+if __name__ == '__main__':
+  unittest.main()
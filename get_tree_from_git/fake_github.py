@@ -0,0 +1,550 @@
+"""Offline stand-in for the GitHub API, serving a synthetic repo graph.
+
+The server answers the two kinds of requests the crawler makes, repository
+searches and manifest contents, from a graph of repos generated from a seed,
+so crawls can be measured and compared without GitHub access or a token.
+Responses look like GitHub's: search pages are linked with a Link header,
+missing manifests are 404s, every response has an ETag and rate limit
+headers, conditional requests get a 304 that does not count against the
+quota, and responses are gzipped when asked for.
+
+Point the crawler at the server with GIT_API_URL, for example:
+
+  python fake_github.py --repos 2000 --port 8000
+  GIT_API_URL=http://127.0.0.1:8000 python crawl_git_repo_dependency.py ''
+"""
+
+import argparse
+import base64
+import BaseHTTPServer
+import bisect
+import collections
+import datetime
+import hashlib
+import json
+import random
+import SocketServer
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+# Rate limits are high enough by default that a benchmark never waits for a
+# reset, and can be lowered to GitHub's to exercise the rate limit scheduler.
+DEFAULT_CORE_LIMIT = 1000000
+DEFAULT_SEARCH_LIMIT = 1000000
+RATE_LIMIT_WINDOW_SECONDS = 3600
+MAX_PER_PAGE = 100
+
+# Dates the synthetic repos are created in, in days since the epoch.
+_FIRST_CREATED_DAY = datetime.date(2010, 1, 1).toordinal()
+_LAST_CREATED_DAY = datetime.date(2016, 1, 1).toordinal()
+
+
+class SyntheticRepo(object):
+  """Repo of the synthetic graph.
+
+  Attributes:
+    index: Integer for the repo's position in the graph.
+    name: String for the repo name.
+    full_name: String for the owner and repo name.
+    stargazers_count: Integer for the repo stars.
+    forks_count: Integer for the repo forks.
+    created_at: String for the ISO creation time.
+    pushed_at: String for the ISO last push time.
+    dependencies: List of the names of the repos it depends on.
+    mentions: List of the names of other repos it mentions without
+        depending on them, which make it show up in their searches.
+    manifest_files: List of the manifest file names without extension the
+        repo has.
+  """
+
+  __slots__ = ('index', 'name', 'full_name', 'stargazers_count',
+               'forks_count', 'created_at', 'pushed_at', 'dependencies',
+               'mentions', 'manifest_files')
+
+
+class SyntheticGraph(object):
+  """Repos with dependencies between them, generated from a seed.
+
+  Stars follow a long-tailed distribution, and dependencies go to popular
+  repos more often than to others, like on GitHub, so a few libraries have
+  many dependents. The root repo is the most popular one.
+
+  Attributes:
+    repos: List of SyntheticRepo, the root first.
+  """
+
+  def __init__(self, num_repos, fan_out=4, num_mentions=2, seed=0,
+               root_name='d3'):
+    """Generate the graph.
+
+    Args:
+      num_repos: Integer for the number of repos.
+      fan_out: Integer for the dependencies of every repo.
+      num_mentions: Integer for the other repos every repo mentions without
+          depending on them.
+      seed: Integer for the random seed; the same seed gives the same graph.
+      root_name: String for the name of the root repo.
+    """
+    rng = random.Random(seed)
+    num_owners = max(num_repos // 3, 1)
+    self.repos = []
+    for index in xrange(num_repos):
+      repo = SyntheticRepo()
+      repo.index = index
+      repo.name = root_name if index == 0 else 'lib-{}'.format(index)
+      repo.full_name = 'user{}/{}'.format(
+          rng.randrange(num_owners), repo.name)
+      repo.stargazers_count = int(rng.paretovariate(1.1) * 10)
+      repo.forks_count = repo.stargazers_count // rng.randint(3, 20)
+      created_day = rng.randint(_FIRST_CREATED_DAY, _LAST_CREATED_DAY)
+      repo.created_at = _FormatDay(created_day)
+      repo.pushed_at = _FormatDay(
+          rng.randint(created_day, _LAST_CREATED_DAY))
+      repo.manifest_files = [
+          file_name for file_name, share in (('bower', 0.4), ('package', 0.8))
+          if rng.random() < share]
+      self.repos.append(repo)
+    self.repos[0].stargazers_count = max(
+        repo.stargazers_count for repo in self.repos) + 1
+    self._fan_out = fan_out
+    self._num_mentions = num_mentions
+    # Cumulative stars, to pick popular repos more often.
+    self._cumulative_stars = []
+    total_stars = 0
+    for repo in self.repos:
+      total_stars += repo.stargazers_count + 1
+      self._cumulative_stars.append(total_stars)
+    for repo in self.repos:
+      repo.dependencies = self._PickNames(rng, repo, fan_out)
+      repo.mentions = self._PickNames(rng, repo, num_mentions)
+    # Days pushed to by Mutate, after all generated push times.
+    self._last_push_day = _LAST_CREATED_DAY
+    self._IndexSearch()
+    self._by_full_name = dict(
+        (repo.full_name, repo) for repo in self.repos)
+
+  def _PickNames(self, rng, repo, count):
+    """Pick the names of other repos, popular ones more often.
+
+    Args:
+      rng: random.Random to pick with.
+      repo: SyntheticRepo to pick for, which is never picked itself.
+      count: Integer for the number of names to pick.
+
+    Returns:
+      Sorted list of at most count repo names.
+    """
+    names = set()
+    for _ in xrange(min(count, len(self.repos) - 1) * 4):
+      if len(names) >= count:
+        break
+      picked = self.repos[bisect.bisect_right(
+          self._cumulative_stars, rng.randrange(self._cumulative_stars[-1]))]
+      if picked is not repo:
+        names.add(picked.name)
+    return sorted(names)
+
+  def _IndexSearch(self):
+    """Index the repos every keyword search finds."""
+    # Dictionary of keyword to the repos its search finds, most stars first.
+    self._search_index = collections.defaultdict(list)
+    for repo in sorted(self.repos, key=lambda repo: -repo.stargazers_count):
+      for keyword in set([repo.name] + repo.dependencies + repo.mentions):
+        self._search_index[keyword].append(repo)
+
+  def Mutate(self, num_changed, seed=1):
+    """Push changes to some repos, like between two crawls.
+
+    Every changed repo gets new dependencies and mentions, and a pushed_at
+    time later than all earlier ones.
+
+    Args:
+      num_changed: Integer for the number of repos to change.
+      seed: Integer for the random seed; the same seed gives the same
+          changes.
+
+    Returns:
+      List of the changed SyntheticRepo.
+    """
+    rng = random.Random(seed)
+    self._last_push_day += 1
+    changed_repos = rng.sample(self.repos, min(num_changed, len(self.repos)))
+    for repo in changed_repos:
+      repo.dependencies = self._PickNames(rng, repo, self._fan_out)
+      repo.mentions = self._PickNames(rng, repo, self._num_mentions)
+      repo.pushed_at = _FormatDay(self._last_push_day)
+    self._IndexSearch()
+    return changed_repos
+
+  def Search(self, keyword):
+    """Get the repos a repository search for a keyword finds.
+
+    Args:
+      keyword: String for the search keyword.
+
+    Returns:
+      List of SyntheticRepo, most stars first.
+    """
+    return self._search_index.get(keyword, [])
+
+  def GetRepo(self, full_name):
+    """Get a repo by its full name.
+
+    Args:
+      full_name: String for the owner and repo name.
+
+    Returns:
+      SyntheticRepo, or None if there is no such repo.
+    """
+    return self._by_full_name.get(full_name)
+
+
+def _FormatDay(day):
+  """Format a day as a GitHub timestamp.
+
+  Args:
+    day: Integer for the proleptic Gregorian ordinal of the day.
+
+  Returns:
+    String for the ISO time at noon of the day.
+  """
+  return datetime.date.fromordinal(day).isoformat() + 'T12:00:00Z'
+
+
+class FakeGitHubServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+  """Threaded HTTP server answering GitHub API requests from a graph.
+
+  Attributes:
+    graph: SyntheticGraph to answer from.
+    url: String for the API root to set as GIT_API_URL.
+  """
+
+  daemon_threads = True
+
+  def __init__(self, graph, port=0, core_limit=DEFAULT_CORE_LIMIT,
+               search_limit=DEFAULT_SEARCH_LIMIT):
+    """Bind the server to a local port.
+
+    Args:
+      graph: SyntheticGraph to answer from.
+      port: Integer for the port to listen on; with 0 any free port is used.
+      core_limit: Integer for the core requests allowed per window.
+      search_limit: Integer for the search requests allowed per window.
+    """
+    BaseHTTPServer.HTTPServer.__init__(
+        self, ('127.0.0.1', port), _FakeGitHubHandler)
+    self.graph = graph
+    self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+    # Dictionary of resource to [limit, remaining, reset epoch seconds].
+    self._quota = {
+        'core': [core_limit, core_limit, 0],
+        'search': [search_limit, search_limit, 0],
+    }
+    self._stats = collections.Counter()
+    self._lock = threading.Lock()
+
+  def Start(self):
+    """Serve requests in a background thread.
+
+    Returns:
+      FakeGitHubServer itself, for chaining.
+    """
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def TakeQuota(self, resource):
+    """Count a request against the quota of its resource.
+
+    Args:
+      resource: String for the rate limit resource, 'core' or 'search'.
+
+    Returns:
+      Tuple of (boolean for whether the request is allowed, dictionary of
+      the rate limit headers to send).
+    """
+    with self._lock:
+      quota = self._quota[resource]
+      now = time.time()
+      if now >= quota[2]:
+        quota[1] = quota[0]
+        quota[2] = int(now) + RATE_LIMIT_WINDOW_SECONDS
+      allowed = quota[1] > 0
+      if allowed:
+        quota[1] -= 1
+      return (allowed, self._GetQuotaHeaders(resource))
+
+  def PeekQuota(self, resource):
+    """Get the rate limit headers without counting a request.
+
+    Args:
+      resource: String for the rate limit resource, 'core' or 'search'.
+
+    Returns:
+      Dictionary of the rate limit headers to send.
+    """
+    with self._lock:
+      return self._GetQuotaHeaders(resource)
+
+  def _GetQuotaHeaders(self, resource):
+    """Get the rate limit headers of a resource, under the lock.
+
+    Args:
+      resource: String for the rate limit resource, 'core' or 'search'.
+
+    Returns:
+      Dictionary of header name to value.
+    """
+    limit, remaining, reset = self._quota[resource]
+    return {
+        'X-RateLimit-Limit': str(limit),
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(reset),
+        'X-RateLimit-Resource': resource,
+    }
+
+  def RecordResponse(self, status, num_bytes):
+    """Count a sent response.
+
+    Args:
+      status: Integer for the HTTP status.
+      num_bytes: Integer for the body bytes sent.
+    """
+    with self._lock:
+      self._stats['requests'] += 1
+      self._stats['bytes'] += num_bytes
+      self._stats['status_{}'.format(status)] += 1
+
+  def GetStats(self):
+    """Get the response counters.
+
+    Returns:
+      Dictionary of counter name to count, with the requests, the body bytes
+      sent and the responses of every status.
+    """
+    with self._lock:
+      return dict(self._stats)
+
+
+class _FakeGitHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Request handler of FakeGitHubServer."""
+
+  # Keep connections alive, like GitHub does.
+  protocol_version = 'HTTP/1.1'
+  # Buffer every response into one write, as small writes of the headers
+  # and body wait for delayed ACKs on a kept-alive connection.
+  wbufsize = -1
+
+  def do_GET(self):
+    """Answer a search, contents or unknown request."""
+    parsed_url = urlparse.urlsplit(self.path)
+    path_parts = parsed_url.path.strip('/').split('/')
+    if path_parts == ['search', 'repositories']:
+      self._AnswerSearch(parsed_url)
+    elif (len(path_parts) == 5 and path_parts[0] == 'repos' and
+          path_parts[3] == 'contents'):
+      self._AnswerContents('/'.join(path_parts[1:3]), path_parts[4])
+    else:
+      self._Send('core', 404, _NotFound())
+
+  def _AnswerSearch(self, parsed_url):
+    """Answer a repository search with one page of results.
+
+    Args:
+      parsed_url: urlparse.SplitResult for the request URL.
+    """
+    params = urlparse.parse_qs(parsed_url.query)
+    # The query is the keyword followed by qualifiers like language:js.
+    keyword = params.get('q', [''])[0].split(' ')[0]
+    per_page = min(int(params.get('per_page', [30])[0]), MAX_PER_PAGE)
+    page = int(params.get('page', [1])[0])
+    found_repos = self.server.graph.Search(keyword)
+    page_repos = found_repos[(page - 1) * per_page:page * per_page]
+    last_page = max((len(found_repos) + per_page - 1) // per_page, 1)
+    headers = {}
+    if page < last_page:
+      headers['Link'] = '{}; rel="next", {}; rel="last"'.format(
+          self._GetPageLink(params, page + 1),
+          self._GetPageLink(params, last_page))
+    self._Send('search', 200, {
+        'total_count': len(found_repos),
+        'incomplete_results': False,
+        'items': [_GetSearchItem(repo, self.server.url)
+                  for repo in page_repos],
+    }, headers)
+
+  def _GetPageLink(self, params, page):
+    """Get the Link header entry of a search result page.
+
+    Args:
+      params: Dictionary of query parameter to list of values.
+      page: Integer for the page number.
+
+    Returns:
+      String for the URL of the page in angle brackets.
+    """
+    page_params = dict((key, values[0]) for key, values in params.iteritems())
+    page_params['page'] = page
+    return '<{}/search/repositories?{}>'.format(
+        self.server.url, urllib.urlencode(sorted(page_params.iteritems())))
+
+  def _AnswerContents(self, full_name, file_path):
+    """Answer a contents request for a manifest file.
+
+    Args:
+      full_name: String for the owner and repo name.
+      file_path: String for the requested file name.
+    """
+    repo = self.server.graph.GetRepo(full_name)
+    file_name = file_path[:-len('.json')]
+    if (repo is None or not file_path.endswith('.json') or
+        file_name not in repo.manifest_files):
+      self._Send('core', 404, _NotFound())
+      return
+    manifest = json.dumps({
+        'name': repo.name,
+        'version': '1.0.0',
+        'dependencies': dict(
+            (name, '^1.0.0') for name in repo.dependencies),
+    }, indent=2)
+    encoded = base64.b64encode(manifest)
+    self._Send('core', 200, {
+        'type': 'file',
+        'encoding': 'base64',
+        'size': len(manifest),
+        'name': file_path,
+        'path': file_path,
+        # GitHub wraps the Base64 content in lines of 60 characters.
+        'content': '\n'.join(
+            encoded[start:start + 60]
+            for start in xrange(0, len(encoded), 60)) + '\n',
+        'sha': hashlib.sha1(manifest).hexdigest(),
+        'url': '{}/repos/{}/contents/{}'.format(
+            self.server.url, full_name, file_path),
+        'download_url': 'https://raw.githubusercontent.com/{}/master/{}'.format(
+            full_name, file_path),
+    })
+
+  def _Send(self, resource, status, content, headers=None):
+    """Send a JSON response, or a 304 if the client has it already.
+
+    Args:
+      resource: String for the rate limit resource of the request.
+      status: Integer for the HTTP status.
+      content: Dictionary for the response JSON content.
+      headers: Dictionary of extra header name to value.
+    """
+    body = json.dumps(content)
+    etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+    if self.headers.getheader('If-None-Match') == etag:
+      # Conditional requests answered with a 304 do not use up quota.
+      self._Respond(304, '', self.server.PeekQuota(resource))
+      return
+    allowed, quota_headers = self.server.TakeQuota(resource)
+    if not allowed:
+      self._Respond(403, json.dumps(
+          {'message': 'API rate limit exceeded'}), quota_headers)
+      return
+    quota_headers.update(headers or {})
+    quota_headers['ETag'] = etag
+    quota_headers['Content-Type'] = 'application/json; charset=utf-8'
+    self._Respond(status, body, quota_headers)
+
+  def _Respond(self, status, body, headers):
+    """Write the response, gzipped if the client accepts it.
+
+    Args:
+      status: Integer for the HTTP status.
+      body: String for the response body.
+      headers: Dictionary of header name to value.
+    """
+    if body and 'gzip' in (self.headers.getheader('Accept-Encoding') or ''):
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      body = compressor.compress(body) + compressor.flush()
+      headers['Content-Encoding'] = 'gzip'
+    self.send_response(status)
+    for name, value in headers.iteritems():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+    self.server.RecordResponse(status, len(body))
+
+  def log_message(self, *args):
+    """Keep quiet, as a crawl makes thousands of requests."""
+
+
+def _NotFound():
+  """Get the content of a 404 response.
+
+  Returns:
+    Dictionary for the response JSON content.
+  """
+  return {
+      'message': 'Not Found',
+      'documentation_url': 'https://developer.github.com/v3',
+  }
+
+
+def _GetSearchItem(repo, api_url):
+  """Get the search result item of a repo, with GitHub's main fields.
+
+  Args:
+    repo: SyntheticRepo to describe.
+    api_url: String for the API root of the server.
+
+  Returns:
+    Dictionary for the item.
+  """
+  owner = repo.full_name.split('/')[0]
+  return {
+      'id': repo.index + 1,
+      'name': repo.name,
+      'full_name': repo.full_name,
+      'owner': {
+          'login': owner,
+          'type': 'User',
+          'url': '{}/users/{}'.format(api_url, owner),
+      },
+      'private': False,
+      'fork': False,
+      'html_url': 'https://github.com/{}'.format(repo.full_name),
+      'url': '{}/repos/{}'.format(api_url, repo.full_name),
+      'description': 'Built with {}.'.format(', '.join(
+          repo.dependencies + repo.mentions)),
+      'created_at': repo.created_at,
+      'updated_at': repo.pushed_at,
+      'pushed_at': repo.pushed_at,
+      'stargazers_count': repo.stargazers_count,
+      'watchers_count': repo.stargazers_count,
+      'forks_count': repo.forks_count,
+      'language': 'JavaScript',
+      'default_branch': 'master',
+      'score': 1.0,
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--repos', type=int, default=1000,
+                      help='number of repos in the graph')
+  parser.add_argument('--fan-out', type=int, default=4,
+                      help='dependencies of every repo')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  parser.add_argument('--port', type=int, default=8000, help='port to use')
+  parser.add_argument('--core-limit', type=int, default=DEFAULT_CORE_LIMIT,
+                      help='core requests allowed per hour')
+  parser.add_argument('--search-limit', type=int,
+                      default=DEFAULT_SEARCH_LIMIT,
+                      help='search requests allowed per hour')
+  args = parser.parse_args()
+  server = FakeGitHubServer(
+      SyntheticGraph(args.repos, args.fan_out, seed=args.seed), args.port,
+      args.core_limit, args.search_limit)
+  print 'Serving {} repos at {}'.format(args.repos, server.url)
+  server.serve_forever()
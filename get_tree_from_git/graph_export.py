@@ -0,0 +1,508 @@
+"""Columnar export of the crawled graph, and queries over it.
+
+The crawl store keeps the graph as rows for incremental crawling, and
+TreeGenerator turns it into nested display JSON; neither is fit for
+questions over the whole graph. The export writes the dependency edges of a
+direction in compressed sparse row (CSR) form, into a directory of flat
+little-endian arrays:
+
+  meta.json: direction, node and edge counts, and the dtype of every array.
+  offsets.bin: int64 of num_nodes + 1; the children of node i are
+      targets[offsets[i]:offsets[i + 1]].
+  targets.bin: int32 of num_edges, the child ids of every parent in crawl
+      order.
+  name_offsets.bin: int64 of num_nodes + 1; the name of node i is
+      names[name_offsets[i]:name_offsets[i + 1]].
+  names.bin: UTF-8 of all node names, concatenated.
+
+Node ids are given in crawl order, so the root keywords come first. Edges go
+from parent to child as crawled: for downward, from a repo to the repos that
+depend on it, and for upward, from a repo to its dependencies. Repos found
+without the dependency are not edges.
+
+With NumPy, the arrays are memory-mapped and the queries run vectorized
+over a whole BFS level at a time. Without it, the arrays are read with the
+array module and the queries run in pure Python, which is fine for crawls
+of a few thousand repos. Usage examples:
+
+  python graph_export.py export downward upward
+  python graph_export.py reach downward d3
+  python graph_export.py degree downward --top 20
+  python graph_export.py degree upward --incoming --top 20
+  python graph_export.py depth upward d3
+"""
+
+import argparse
+import array
+import bisect
+import collections
+import heapq
+import json
+import logging
+import os
+import sys
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import crawl_store
+import instrumentation
+import utilities as util
+
+FORMAT_VERSION = 1
+# Dtypes of the exported arrays, as NumPy dtype strings.
+_DTYPES = {
+    'offsets': '<i8',
+    'targets': '<i4',
+    'name_offsets': '<i8',
+}
+# Typecodes of the array module for the dtypes, by item size.
+_TYPECODES = {4: 'i', 8: 'l' if array.array('l').itemsize == 8 else 'q'}
+
+
+def GetGraphDir(direction):
+  """Get the default export directory of a direction.
+
+  Args:
+    direction: String for the crawl direction.
+
+  Returns:
+    String for the directory path in DATA_DIR.
+  """
+  return os.path.join(util.DATA_DIR, '{}_graph'.format(direction))
+
+
+def ExportGraph(direction, graph_dir=None):
+  """Export the dependency edges of a direction from the crawl store.
+
+  Args:
+    direction: String for the crawl direction.
+    graph_dir: String for the directory to write the arrays into, default to
+        GetGraphDir(direction).
+
+  Returns:
+    Tuple of (integer for the nodes, integer for the edges) exported.
+  """
+  graph_dir = graph_dir or GetGraphDir(direction)
+  node_ids = {}
+  names = []
+  sources = array.array(_TYPECODES[4])
+  targets = array.array(_TYPECODES[4])
+  for parent, child, status in util.CRAWL_STORE.GetEdges(direction):
+    if status == crawl_store.NO_MATCH:
+      continue
+    for name in (parent, child):
+      if name not in node_ids:
+        node_ids[name] = len(names)
+        names.append(name)
+    sources.append(node_ids[parent])
+    targets.append(node_ids[child])
+  num_nodes = len(names)
+  # Counting sort of the edges by parent, which keeps the crawl order of the
+  # children of every parent.
+  offsets = array.array(_TYPECODES[8], [0]) * (num_nodes + 1)
+  for source in sources:
+    offsets[source + 1] += 1
+  for node_id in xrange(num_nodes):
+    offsets[node_id + 1] += offsets[node_id]
+  positions = offsets[:-1]
+  sorted_targets = array.array(_TYPECODES[4], [0]) * len(targets)
+  for source, target in zip(sources, targets):
+    sorted_targets[positions[source]] = target
+    positions[source] += 1
+  encoded_names = [name.encode('utf-8') for name in names]
+  name_offsets = array.array(_TYPECODES[8], [0]) * (num_nodes + 1)
+  for node_id, encoded_name in enumerate(encoded_names):
+    name_offsets[node_id + 1] = name_offsets[node_id] + len(encoded_name)
+
+  if not os.path.isdir(graph_dir):
+    os.makedirs(graph_dir)
+  with util.METRICS.Time('persist'):
+    for array_name, values in (('offsets', offsets),
+                               ('targets', sorted_targets),
+                               ('name_offsets', name_offsets)):
+      _WriteArray(os.path.join(graph_dir, array_name + '.bin'), values)
+    with open(os.path.join(graph_dir, 'names.bin'), 'wb') as names_file:
+      names_file.write(''.join(encoded_names))
+    # The meta file goes last, so a graph with one is complete.
+    with open(os.path.join(graph_dir, 'meta.json'), 'w') as meta_file:
+      json.dump({
+          'version': FORMAT_VERSION,
+          'direction': direction,
+          'num_nodes': num_nodes,
+          'num_edges': len(sorted_targets),
+          'dtypes': _DTYPES,
+      }, meta_file, indent=2, sort_keys=True)
+  logging.info('Exported %d nodes and %d edges for %s to %s', num_nodes,
+               len(sorted_targets), direction, graph_dir)
+  return (num_nodes, len(sorted_targets))
+
+
+def _WriteArray(file_name, values):
+  """Write an array module array as little-endian items.
+
+  Args:
+    file_name: String for the path to write to.
+    values: array.array to write.
+  """
+  if sys.byteorder == 'big':
+    values = array.array(values.typecode, values)
+    values.byteswap()
+  with open(file_name, 'wb') as array_file:
+    values.tofile(array_file)
+
+
+def _ReadArray(graph_dir, array_name, length):
+  """Read an exported array, memory-mapped if NumPy is available.
+
+  Args:
+    graph_dir: String for the export directory.
+    array_name: String for the array name, a key of _DTYPES.
+    length: Integer for the number of items.
+
+  Returns:
+    numpy.ndarray, or array.array without NumPy.
+  """
+  file_name = os.path.join(graph_dir, array_name + '.bin')
+  dtype = _DTYPES[array_name]
+  if numpy is not None:
+    # Empty files cannot be mapped.
+    if not length:
+      return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(file_name, dtype=dtype, mode='r', shape=(length,))
+  values = array.array(_TYPECODES[int(dtype[-1])])
+  with open(file_name, 'rb') as array_file:
+    values.fromfile(array_file, length)
+  if sys.byteorder == 'big':
+    values.byteswap()
+  return values
+
+
+class CSRGraph(object):
+  """Exported graph of a direction, with queries over the whole graph.
+
+  Attributes:
+    direction: String for the crawl direction.
+    num_nodes: Integer for the nodes.
+    num_edges: Integer for the edges.
+    offsets: Array of num_nodes + 1 bounds of every node's targets.
+    targets: Array of num_edges child ids.
+  """
+
+  def __init__(self, direction, offsets, targets, name_offsets, names):
+    """Set up the graph from its arrays.
+
+    Args:
+      direction: String for the crawl direction.
+      offsets: Array of num_nodes + 1 bounds of every node's targets.
+      targets: Array of num_edges child ids.
+      name_offsets: Array of num_nodes + 1 bounds of every node name.
+      names: Byte string of all node names in UTF-8, concatenated.
+    """
+    self.direction = direction
+    self.num_nodes = len(offsets) - 1
+    self.num_edges = len(targets)
+    self.offsets = offsets
+    self.targets = targets
+    self._name_offsets = name_offsets
+    self._names = names
+
+  @classmethod
+  def Load(cls, graph_dir):
+    """Load an exported graph.
+
+    Args:
+      graph_dir: String for the export directory.
+
+    Returns:
+      CSRGraph for the export.
+
+    Raises:
+      ValueError: If the export is of an unknown format version.
+    """
+    with open(os.path.join(graph_dir, 'meta.json')) as meta_file:
+      meta = json.load(meta_file)
+    if meta['version'] != FORMAT_VERSION:
+      raise ValueError('Unknown graph format version {} in {}'.format(
+          meta['version'], graph_dir))
+    with open(os.path.join(graph_dir, 'names.bin'), 'rb') as names_file:
+      names = names_file.read()
+    return cls(meta['direction'],
+               _ReadArray(graph_dir, 'offsets', meta['num_nodes'] + 1),
+               _ReadArray(graph_dir, 'targets', meta['num_edges']),
+               _ReadArray(graph_dir, 'name_offsets', meta['num_nodes'] + 1),
+               names)
+
+  def GetName(self, node_id):
+    """Get the name of a node.
+
+    Args:
+      node_id: Integer for the node id.
+
+    Returns:
+      String for the repo full name, or the root keyword.
+    """
+    return self._names[int(self._name_offsets[node_id]):
+                       int(self._name_offsets[node_id + 1])].decode('utf-8')
+
+  def GetId(self, name):
+    """Get the id of a node.
+
+    Args:
+      name: String for the repo full name, or the root keyword.
+
+    Returns:
+      Integer for the node id.
+
+    Raises:
+      KeyError: If there is no such node.
+    """
+    # The name table is searched instead of decoding every name into a
+    # dictionary; a match only counts if it spans a whole name.
+    encoded_name = name.encode('utf-8')
+    start = self._names.find(encoded_name)
+    while start >= 0:
+      node_id = bisect.bisect_right(self._name_offsets, start) - 1
+      if (self._name_offsets[node_id] == start and
+          self._name_offsets[node_id + 1] == start + len(encoded_name)):
+        return node_id
+      start = self._names.find(encoded_name, start + 1)
+    raise KeyError(name)
+
+  def GetOutDegrees(self):
+    """Get the number of children of every node.
+
+    Returns:
+      Array of the out-degree of every node id.
+    """
+    if numpy is not None:
+      return numpy.diff(self.offsets)
+    return [self.offsets[node_id + 1] - self.offsets[node_id]
+            for node_id in xrange(self.num_nodes)]
+
+  def GetInDegrees(self):
+    """Get the number of parents of every node.
+
+    Returns:
+      Array of the in-degree of every node id.
+    """
+    if numpy is not None:
+      return numpy.bincount(self.targets, minlength=self.num_nodes)
+    in_degrees = [0] * self.num_nodes
+    for target in self.targets:
+      in_degrees[target] += 1
+    return in_degrees
+
+  def Reverse(self):
+    """Get the graph with every edge reversed, in memory.
+
+    For downward, the reversed graph goes from a repo to its dependencies,
+    and for upward, from a repo to the repos that depend on it.
+
+    Returns:
+      CSRGraph with the same node ids and names.
+    """
+    if numpy is not None:
+      sources = numpy.repeat(numpy.arange(self.num_nodes, dtype=_DTYPES[
+          'targets']), self.GetOutDegrees())
+      # The order of the parents of a child does not matter to the queries.
+      order = numpy.argsort(self.targets)
+      offsets = numpy.zeros(self.num_nodes + 1, dtype=_DTYPES['offsets'])
+      numpy.cumsum(self.GetInDegrees(), out=offsets[1:])
+      targets = sources[order]
+    else:
+      children = [[] for _ in xrange(self.num_nodes)]
+      for node_id in xrange(self.num_nodes):
+        for edge in xrange(self.offsets[node_id], self.offsets[node_id + 1]):
+          children[self.targets[edge]].append(node_id)
+      offsets = array.array(_TYPECODES[8], [0])
+      targets = array.array(_TYPECODES[4])
+      for node_children in children:
+        targets.extend(node_children)
+        offsets.append(len(targets))
+    return CSRGraph(self.direction, offsets, targets, self._name_offsets,
+                    self._names)
+
+  def GetShortestDepths(self, source_ids):
+    """Get the fewest edges from the sources to every node, by BFS.
+
+    Args:
+      source_ids: List of integers for the node ids to start from.
+
+    Returns:
+      Array of the depth of every node id, with 0 for the sources and -1 for
+      nodes that cannot be reached.
+    """
+    if numpy is None:
+      return self._GetShortestDepthsPython(source_ids)
+    depths = numpy.full(self.num_nodes, -1, dtype=numpy.int32)
+    frontier = numpy.unique(numpy.asarray(source_ids, dtype=numpy.int64))
+    depths[frontier] = 0
+    depth = 0
+    while frontier.size:
+      depth += 1
+      starts = self.offsets[frontier]
+      counts = self.offsets[frontier + 1] - starts
+      total = counts.sum()
+      if not total:
+        break
+      # Edge positions of all children of the frontier at once: each
+      # parent's run starts at its offset, and goes on for its out-degree.
+      run_starts = numpy.repeat(starts - (numpy.cumsum(counts) - counts),
+                                counts)
+      children = self.targets[run_starts + numpy.arange(total)]
+      frontier = numpy.unique(children[depths[children] < 0])
+      depths[frontier] = depth
+    return depths
+
+  def _GetShortestDepthsPython(self, source_ids):
+    """Get the fewest edges from the sources to every node, without NumPy.
+
+    Args:
+      source_ids: List of integers for the node ids to start from.
+
+    Returns:
+      List of the depth of every node id, with 0 for the sources and -1 for
+      nodes that cannot be reached.
+    """
+    depths = [-1] * self.num_nodes
+    queue = collections.deque()
+    for source_id in source_ids:
+      if depths[source_id] < 0:
+        depths[source_id] = 0
+        queue.append(source_id)
+    while queue:
+      node_id = queue.popleft()
+      for edge in xrange(self.offsets[node_id], self.offsets[node_id + 1]):
+        child = self.targets[edge]
+        if depths[child] < 0:
+          depths[child] = depths[node_id] + 1
+          queue.append(child)
+    return depths
+
+
+def GetTopNodes(values, top):
+  """Get the nodes with the highest values, such as degrees.
+
+  Args:
+    values: Array of the value of every node id.
+    top: Integer for the number of nodes to get.
+
+  Returns:
+    List of (node id, value) tuples, highest value first, ties by node id.
+  """
+  if numpy is not None:
+    values = numpy.asarray(values)
+    top = min(top, values.size)
+    if not top:
+      return []
+    # A partial sort finds the candidates, and only those are sorted.
+    candidates = numpy.argpartition(-values, top - 1)[:top]
+    threshold = values[candidates].min()
+    candidates = numpy.flatnonzero(values >= threshold)
+    order = numpy.lexsort((candidates, -values[candidates]))[:top]
+    return [(int(node_id), int(values[node_id]))
+            for node_id in candidates[order]]
+  return heapq.nsmallest(top, enumerate(values),
+                         key=lambda item: (-item[1], item[0]))
+
+
+def _GetSourceIds(graph, names):
+  """Get the node ids of names given on the command line.
+
+  Args:
+    graph: CSRGraph to look the names up in.
+    names: List of strings for the node names.
+
+  Returns:
+    List of integers for the node ids.
+  """
+  source_ids = []
+  for name in names:
+    try:
+      source_ids.append(graph.GetId(name.decode('utf-8')))
+    except KeyError:
+      sys.exit('No node {} in the {} graph.'.format(name, graph.direction))
+  return source_ids
+
+
+def _Main(args):
+  """Run a command of the command line.
+
+  Args:
+    args: argparse.Namespace of the parsed command line.
+  """
+  if args.command == 'export':
+    for direction in args.directions:
+      ExportGraph(direction)
+    return
+  graph = CSRGraph.Load(args.graph_dir or GetGraphDir(args.direction))
+  if getattr(args, 'reverse', False):
+    graph = graph.Reverse()
+  if args.command == 'degree':
+    degrees = graph.GetInDegrees() if args.incoming else graph.GetOutDegrees()
+    for node_id, degree in GetTopNodes(degrees, args.top):
+      print '{:>8d} {}'.format(degree, graph.GetName(node_id).encode('utf-8'))
+    return
+  depths = graph.GetShortestDepths(_GetSourceIds(graph, args.names))
+  if args.command == 'reach':
+    if numpy is not None:
+      reached_ids = numpy.flatnonzero(depths > 0)
+      reached_ids = reached_ids[numpy.argsort(depths[reached_ids],
+                                              kind='mergesort')]
+      reached = zip(depths[reached_ids].tolist(), reached_ids.tolist())
+    else:
+      reached = sorted((depth, node_id) for node_id, depth
+                       in enumerate(depths) if depth > 0)
+    for depth, node_id in reached:
+      print '{:>4d} {}'.format(depth, graph.GetName(node_id).encode('utf-8'))
+    logging.info('%d nodes are reached', len(reached))
+    return
+  if numpy is not None:
+    histogram = dict(enumerate(numpy.bincount(depths[depths >= 0]).tolist()))
+  else:
+    histogram = collections.Counter(depth for depth in depths if depth >= 0)
+  for depth in sorted(histogram):
+    if histogram[depth]:
+      print '{:>4d} {:>10d}'.format(depth, histogram[depth])
+  logging.info('%d of %d nodes are reached', sum(histogram.itervalues()),
+               graph.num_nodes)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  subparsers = parser.add_subparsers(dest='command')
+  export_parser = subparsers.add_parser(
+      'export', help='export the crawl store into DATA_DIR/<direction>_graph')
+  export_parser.add_argument('directions', nargs='+',
+                             choices=('downward', 'upward'))
+  query_parsers = [
+      subparsers.add_parser(
+          'reach', help='list the nodes reachable from the given nodes, '
+          'with their shortest depth'),
+      subparsers.add_parser(
+          'depth', help='count the nodes at every shortest depth from the '
+          'given nodes'),
+      subparsers.add_parser(
+          'degree', help='rank the nodes by their number of children'),
+  ]
+  for query_parser in query_parsers:
+    query_parser.add_argument('direction', choices=('downward', 'upward'))
+    query_parser.add_argument('--graph-dir',
+                              help='export directory to query instead of '
+                              'the default one of the direction')
+    query_parser.add_argument('--reverse', action='store_true',
+                              help='follow the edges from child to parent')
+  for query_parser in query_parsers[:2]:
+    query_parser.add_argument('names', nargs='+',
+                              help='repo full names or root keywords')
+  query_parsers[2].add_argument('--incoming', action='store_true',
+                                help='rank by the number of parents instead')
+  query_parsers[2].add_argument('--top', type=int, default=20,
+                                help='number of nodes to list')
+  # Progress, metrics and profiling are set up from the environment, see
+  # instrumentation.py.
+  with instrumentation.Instrumented():
+    _Main(parser.parse_args())
@@ -0,0 +1,158 @@
+"""Tests for graph_export, on a small crawl graph built by hand."""
+
+import argparse
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import crawl_store
+import graph_export
+import utilities as util
+
+# Downward (parent, child, status) edges in crawl order. a/b -> a/c -> a/b
+# is a cycle, the name of a/b is a prefix of a/bc, and x/none has no
+# dependency, so it is no node.
+_EDGES = (
+    ('d3', 'a/a', crawl_store.MATCH),
+    ('d3', 'a/b', crawl_store.MATCH),
+    ('a/a', 'a/c', crawl_store.MATCH),
+    ('a/a', 'x/none', crawl_store.NO_MATCH),
+    ('a/b', 'a/bc', crawl_store.MATCH),
+    ('a/b', 'a/c', crawl_store.REPEAT),
+    ('a/c', 'a/b', crawl_store.REPEAT),
+    ('a/bc', 'e/f', crawl_store.MATCH),
+)
+# Node names by id, in crawl order.
+_NAMES = ['d3', 'a/a', 'a/b', 'a/c', 'a/bc', 'e/f']
+_OFFSETS = [0, 2, 3, 5, 6, 7, 7]
+_TARGETS = [1, 2, 3, 4, 3, 2, 5]
+
+_NUMPY = graph_export.numpy
+
+
+class GraphExportTest(unittest.TestCase):
+  """Export the graph and query it with NumPy, if installed, and without."""
+
+  def setUp(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    self.addCleanup(setattr, util, 'CRAWL_STORE', util.CRAWL_STORE)
+    util.CRAWL_STORE = crawl_store.CrawlStore(
+        os.path.join(temp_dir, 'crawl.sqlite'))
+    for parent, child, status in _EDGES:
+      util.CRAWL_STORE.AddEdge('downward', 1, parent, child, parent, status)
+    util.CRAWL_STORE.Flush()
+    self._graph_dir = os.path.join(temp_dir, 'downward_graph')
+    self.assertEqual((len(_NAMES), len(_TARGETS)),
+                     graph_export.ExportGraph('downward', self._graph_dir))
+
+  def _OnBothPaths(self, func):
+    """Call a function with NumPy, if it is installed, and without it.
+
+    Args:
+      func: Function taking no arguments.
+
+    Returns:
+      List of the function outputs, the one with NumPy first.
+    """
+    outputs = []
+    if _NUMPY is not None:
+      outputs.append(func())
+    graph_export.numpy = None
+    try:
+      outputs.append(func())
+    finally:
+      graph_export.numpy = _NUMPY
+    return outputs
+
+  def _Load(self):
+    """Load the exported graph.
+
+    Returns:
+      CSRGraph of the export.
+    """
+    return graph_export.CSRGraph.Load(self._graph_dir)
+
+  def testExportIsCSR(self):
+    for graph in self._OnBothPaths(self._Load):
+      self.assertEqual(_OFFSETS, [int(offset) for offset in graph.offsets])
+      self.assertEqual(_TARGETS, [int(target) for target in graph.targets])
+      self.assertEqual(_NAMES, [graph.GetName(node_id)
+                                for node_id in xrange(graph.num_nodes)])
+      self.assertEqual(range(len(_NAMES)),
+                       [graph.GetId(name) for name in _NAMES])
+      self.assertRaises(KeyError, graph.GetId, 'a')
+
+  def _Query(self):
+    """Run every query on the exported graph and its reverse.
+
+    Returns:
+      Dictionary of the query name to the list of its results.
+    """
+    graph = self._Load()
+    reverse = graph.Reverse()
+    d3_id = graph.GetId('d3')
+    return dict((name, [int(value) for value in values]) for name, values in (
+        ('out_degrees', graph.GetOutDegrees()),
+        ('in_degrees', graph.GetInDegrees()),
+        ('depths', graph.GetShortestDepths([d3_id])),
+        ('root_depths', graph.GetShortestDepths([d3_id, graph.GetId('a/c')])),
+        ('reverse_out_degrees', reverse.GetOutDegrees()),
+        ('reverse_depths', reverse.GetShortestDepths([graph.GetId('e/f')])),
+        ('top_in_degrees', [node_id for node_id, _ in graph_export.GetTopNodes(
+            graph.GetInDegrees(), 3)]),
+    ))
+
+  def testQueriesMatchWithoutNumPy(self):
+    expected = {
+        'out_degrees': [2, 1, 2, 1, 1, 0],
+        'in_degrees': [0, 1, 2, 2, 1, 1],
+        'depths': [0, 1, 1, 2, 2, 3],
+        'root_depths': [0, 1, 1, 0, 2, 3],
+        'reverse_out_degrees': [0, 1, 2, 2, 1, 1],
+        'reverse_depths': [3, 4, 2, 3, 1, 0],
+        # Ties go to the lower node id.
+        'top_in_degrees': [2, 3, 1],
+    }
+    for results in self._OnBothPaths(self._Query):
+      self.assertEqual(expected, results)
+
+  def _RunCommands(self):
+    """Run the query commands of the command line on the export.
+
+    Returns:
+      List of strings for the output of every command.
+    """
+    outputs = []
+    for command, options in (
+        ('reach', {'names': ['d3']}),
+        ('reach', {'names': ['e/f'], 'reverse': True}),
+        ('depth', {'names': ['d3', 'a/c']}),
+        ('degree', {'incoming': False, 'top': 3}),
+        ('degree', {'incoming': True, 'top': 10}),
+    ):
+      args = argparse.Namespace(command=command, direction='downward',
+                                graph_dir=self._graph_dir, reverse=False)
+      vars(args).update(options)
+      stdout = sys.stdout
+      sys.stdout = StringIO.StringIO()
+      try:
+        graph_export._Main(args)
+        outputs.append(sys.stdout.getvalue())
+      finally:
+        sys.stdout = stdout
+    return outputs
+
+  def testCommandsMatchWithoutNumPy(self):
+    outputs = self._OnBothPaths(self._RunCommands)
+    self.assertEqual(
+        '   1 a/a\n   1 a/b\n   2 a/c\n   2 a/bc\n   3 e/f\n', outputs[0][0])
+    for command_outputs in outputs[1:]:
+      self.assertEqual(outputs[0], command_outputs)
+
+
+if __name__ == '__main__':
+  unittest.main()
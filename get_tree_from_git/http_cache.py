@@ -0,0 +1,255 @@
+"""On-disk cache of GitHub API responses.
+
+Responses are kept in a SQLite file keyed by URL, together with their ETag
+and Last-Modified headers and the next page link of paginated responses.
+Fresh entries are served without a request at all, and stale entries are
+revalidated with a conditional request, where a 304 response does not count
+against the rate limit. Manifest contents stay fresh for a day, while search
+results and other listings change with every push, so they are revalidated
+on every use by default. The cache is bounded in size, and the least recently
+used entries are evicted first.
+"""
+
+import sqlite3
+import threading
+import time
+
+# Path segment of the URLs of repo file contents, which get the long TTL.
+_CONTENTS_PATH = '/contents/'
+
+# Manifest content entries younger than this are served without
+# revalidation.
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+# Search and other listing entries younger than this are served without
+# revalidation.
+DEFAULT_LISTING_TTL_SECONDS = 0
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class CacheEntry(object):
+  """Cached response for a URL.
+
+  Attributes:
+    body: String for the raw response body.
+    etag: String for the ETag header, or None.
+    last_modified: String for the Last-Modified header, or None.
+    fetched_at: Float for the epoch seconds the response was last validated.
+    next_url: String for the URL of the next page, or None.
+  """
+
+  __slots__ = ('body', 'etag', 'last_modified', 'fetched_at', 'next_url')
+
+  def __init__(self, body, etag, last_modified, fetched_at, next_url):
+    self.body = body
+    self.etag = etag
+    self.last_modified = last_modified
+    self.fetched_at = fetched_at
+    self.next_url = next_url
+
+  def GetConditionalHeaders(self):
+    """Get the headers to revalidate the entry with.
+
+    Returns:
+      List of (header name, value) tuples.
+    """
+    headers = []
+    if self.etag:
+      headers.append(('If-None-Match', self.etag))
+    if self.last_modified:
+      headers.append(('If-Modified-Since', self.last_modified))
+    return headers
+
+
+class ResponseCache(object):
+  """Size-bounded LRU cache of responses in a SQLite file.
+
+  The connection is opened on first use and shared by all threads, so every
+  query goes through the lock.
+
+  Attributes:
+    ttl_seconds: Integer for the seconds a file content entry is served
+        without revalidation.
+    listing_ttl_seconds: Integer for the seconds any other entry, such as
+        a search result page, is served without revalidation.
+    max_bytes: Integer for the total body size to keep before evicting.
+  """
+
+  def __init__(self, db_file, ttl_seconds=DEFAULT_TTL_SECONDS,
+               max_bytes=DEFAULT_MAX_BYTES,
+               listing_ttl_seconds=DEFAULT_LISTING_TTL_SECONDS):
+    """Set up the cache settings.
+
+    Args:
+      db_file: String for the path of the SQLite file.
+      ttl_seconds: Integer for the seconds a file content entry is served
+          without revalidation.
+      max_bytes: Integer for the total body size to keep before evicting.
+      listing_ttl_seconds: Integer for the seconds any other entry, such as
+          a search result page, is served without revalidation.
+    """
+    self.ttl_seconds = ttl_seconds
+    self.listing_ttl_seconds = listing_ttl_seconds
+    self.max_bytes = max_bytes
+    self._db_file = db_file
+    self._db = None
+    self._total_bytes = 0
+    self._lock = threading.Lock()
+    self._stats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'evicted': 0}
+
+  def _Connect(self):
+    """Open the SQLite file and create the table if needed.
+
+    Returns:
+      sqlite3.Connection for the cache file.
+    """
+    if self._db is None:
+      self._db = sqlite3.connect(self._db_file, check_same_thread=False)
+      self._db.text_factory = str
+      self._db.execute('PRAGMA journal_mode=WAL')
+      self._db.execute('PRAGMA synchronous=NORMAL')
+      self._db.execute(
+          'CREATE TABLE IF NOT EXISTS responses ('
+          'url TEXT PRIMARY KEY, body TEXT, etag TEXT, last_modified TEXT, '
+          'fetched_at REAL, accessed_at REAL, size INTEGER, next_url TEXT)')
+      # Cache files written before next page links were kept lack the column.
+      columns = [row[1] for row in self._db.execute(
+          'PRAGMA table_info(responses)')]
+      if 'next_url' not in columns:
+        self._db.execute('ALTER TABLE responses ADD COLUMN next_url TEXT')
+      self._db.execute(
+          'CREATE INDEX IF NOT EXISTS responses_accessed_at '
+          'ON responses (accessed_at)')
+      self._total_bytes = self._db.execute(
+          'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+    return self._db
+
+  def Get(self, git_url):
+    """Get the cached entry for a URL.
+
+    Args:
+      git_url: String for GitHub API URL.
+
+    Returns:
+      CacheEntry for the URL, or None if it is not cached.
+    """
+    with self._lock:
+      db = self._Connect()
+      row = db.execute(
+          'SELECT body, etag, last_modified, fetched_at, next_url '
+          'FROM responses '
+          'WHERE url = ?', (git_url,)).fetchone()
+      if row is None:
+        return None
+      with db:
+        db.execute('UPDATE responses SET accessed_at = ? WHERE url = ?',
+                   (time.time(), git_url))
+      return CacheEntry(*row)
+
+  def GetTTL(self, git_url):
+    """Get the seconds the entry of a URL is served without revalidation.
+
+    Args:
+      git_url: String for GitHub API URL.
+
+    Returns:
+      Integer for ttl_seconds for file contents, and listing_ttl_seconds
+      for any other URL.
+    """
+    if _CONTENTS_PATH in git_url:
+      return self.ttl_seconds
+    return self.listing_ttl_seconds
+
+  def IsFresh(self, entry, git_url):
+    """Check if an entry can be served without revalidation.
+
+    Args:
+      entry: CacheEntry to check.
+      git_url: String for GitHub API URL the entry is cached for.
+
+    Returns:
+      Boolean for whether the entry is within the TTL of its URL.
+    """
+    return time.time() - entry.fetched_at < self.GetTTL(git_url)
+
+  def RecordHit(self, revalidated=False):
+    """Count a response served from the cache.
+
+    Args:
+      revalidated: Boolean for whether the entry was revalidated with a 304
+          response rather than served as fresh.
+    """
+    with self._lock:
+      self._stats['revalidated' if revalidated else 'hits'] += 1
+
+  def RecordMiss(self):
+    """Count a response that had to be fetched in full."""
+    with self._lock:
+      self._stats['misses'] += 1
+
+  def Touch(self, git_url):
+    """Mark an entry as validated now, after a 304 response.
+
+    Args:
+      git_url: String for GitHub API URL.
+    """
+    with self._lock:
+      now = time.time()
+      with self._Connect() as db:
+        db.execute(
+            'UPDATE responses SET fetched_at = ?, accessed_at = ? '
+            'WHERE url = ?', (now, now, git_url))
+
+  def Put(self, git_url, body, etag, last_modified, next_url=None):
+    """Store a response, evicting least recently used entries if needed.
+
+    Args:
+      git_url: String for GitHub API URL.
+      body: String for the raw response body.
+      etag: String for the ETag header, or None.
+      last_modified: String for the Last-Modified header, or None.
+      next_url: String for the URL of the next page, or None.
+    """
+    with self._lock:
+      db = self._Connect()
+      now = time.time()
+      with db:
+        old_row = db.execute('SELECT size FROM responses WHERE url = ?',
+                             (git_url,)).fetchone()
+        if old_row:
+          self._total_bytes -= old_row[0]
+        db.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (git_url, body, etag, last_modified, now, now, len(body),
+             next_url))
+        self._total_bytes += len(body)
+        self._Evict(db)
+
+  def _Evict(self, db):
+    """Delete least recently used entries until the cache fits in max_bytes.
+
+    Args:
+      db: sqlite3.Connection for the cache file, within a transaction.
+    """
+    while self._total_bytes > self.max_bytes:
+      rows = db.execute(
+          'SELECT url, size FROM responses ORDER BY accessed_at LIMIT 100'
+      ).fetchall()
+      if not rows:
+        break
+      for git_url, size in rows:
+        db.execute('DELETE FROM responses WHERE url = ?', (git_url,))
+        self._total_bytes -= size
+        self._stats['evicted'] += 1
+        if self._total_bytes <= self.max_bytes:
+          break
+
+  def GetStats(self):
+    """Get the cache counters.
+
+    Returns:
+      Dictionary of counter name to count, plus the cached bytes.
+    """
+    with self._lock:
+      stats = dict(self._stats)
+      stats['bytes'] = self._total_bytes
+      return stats
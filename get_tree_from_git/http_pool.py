@@ -0,0 +1,184 @@
+"""Keep-alive HTTP connection pool for GitHub API requests.
+
+Opening a new connection for every request costs a TCP and TLS handshake,
+which is most of the time spent on a small manifest request. The pool keeps
+idle connections per host and hands them out to any thread, so that all
+crawlers reuse the same few connections. Responses are requested gzipped
+and decompressed before they are returned.
+"""
+
+import httplib
+import Queue
+import socket
+import threading
+import urlparse
+import zlib
+
+DEFAULT_TIMEOUT_SECONDS = 30
+# Idle connections kept per host, which should cover the crawl concurrency.
+DEFAULT_MAX_IDLE = 16
+MAX_REDIRECTS = 5
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPResponse(object):
+  """Fully read response of a pooled request.
+
+  Attributes:
+    status: Integer for the HTTP status code.
+    reason: String for the HTTP reason phrase.
+    headers: httplib.HTTPMessage for the response headers.
+    body: String for the decompressed response body.
+  """
+
+  __slots__ = ('status', 'reason', 'headers', 'body')
+
+  def __init__(self, status, reason, headers, body):
+    self.status = status
+    self.reason = reason
+    self.headers = headers
+    self.body = body
+
+
+class ConnectionPool(object):
+  """Pool of keep-alive connections, shared by all threads.
+
+  Attributes:
+    timeout: Integer for the socket timeout in seconds.
+    max_idle: Integer for the idle connections to keep per host.
+  """
+
+  def __init__(self, timeout=DEFAULT_TIMEOUT_SECONDS,
+               max_idle=DEFAULT_MAX_IDLE):
+    """Set up the empty pool.
+
+    Args:
+      timeout: Integer for the socket timeout in seconds.
+      max_idle: Integer for the idle connections to keep per host.
+    """
+    self.timeout = timeout
+    self.max_idle = max_idle
+    # Dictionary of (scheme, host) to Queue of idle connections.
+    self._idle = {}
+    self._stats = {'opened': 0, 'reused': 0}
+    self._stats_lock = threading.Lock()
+
+  def _GetQueue(self, scheme, host):
+    """Get the idle connection queue for a host.
+
+    Args:
+      scheme: String for the URL scheme, either 'http' or 'https'.
+      host: String for the host with optional port.
+
+    Returns:
+      Queue.LifoQueue of idle connections.
+    """
+    # setdefault is atomic, so two threads never end up with different
+    # queues for the same host.
+    return self._idle.setdefault(
+        (scheme, host), Queue.LifoQueue(self.max_idle))
+
+  def _GetConnection(self, scheme, host):
+    """Get an idle connection for a host, or open a new one.
+
+    Args:
+      scheme: String for the URL scheme, either 'http' or 'https'.
+      host: String for the host with optional port.
+
+    Returns:
+      Tuple with (httplib.HTTPConnection, boolean for whether it is reused).
+    """
+    try:
+      conn = self._GetQueue(scheme, host).get_nowait()
+      reused = True
+    except Queue.Empty:
+      connection_class = (httplib.HTTPSConnection if scheme == 'https'
+                          else httplib.HTTPConnection)
+      conn = connection_class(host, timeout=self.timeout)
+      reused = False
+    with self._stats_lock:
+      self._stats['reused' if reused else 'opened'] += 1
+    return (conn, reused)
+
+  def _ReleaseConnection(self, scheme, host, conn):
+    """Put a connection back into the pool, or close it if the pool is full.
+
+    Args:
+      scheme: String for the URL scheme, either 'http' or 'https'.
+      host: String for the host with optional port.
+      conn: httplib.HTTPConnection to release.
+    """
+    try:
+      self._GetQueue(scheme, host).put_nowait(conn)
+    except Queue.Full:
+      conn.close()
+
+  def Request(self, git_url, headers=None):
+    """Send a GET request over a pooled connection, following redirects.
+
+    Args:
+      git_url: String for the URL to get.
+      headers: List of (header name, value) tuples to send.
+
+    Returns:
+      HTTPResponse for the final response.
+
+    Raises:
+      httplib.HTTPException or socket.error if the request fails on a new
+          connection.
+    """
+    request_headers = dict(headers or [])
+    request_headers['Accept-Encoding'] = 'gzip'
+    for _ in xrange(MAX_REDIRECTS):
+      response = self._Send(git_url, request_headers)
+      location = response.headers.getheader('Location')
+      if response.status not in REDIRECT_CODES or not location:
+        return response
+      git_url = urlparse.urljoin(git_url, location)
+    return response
+
+  def _Send(self, git_url, request_headers):
+    """Send a single GET request and read the whole response.
+
+    A reused connection may have been closed by the server while idle, in
+    which case the request is retried on another connection.
+
+    Args:
+      git_url: String for the URL to get.
+      request_headers: Dictionary of header name to value.
+
+    Returns:
+      HTTPResponse for the response.
+    """
+    parsed_url = urlparse.urlsplit(git_url)
+    path = parsed_url.path or '/'
+    if parsed_url.query:
+      path += '?' + parsed_url.query
+    while True:
+      conn, reused = self._GetConnection(parsed_url.scheme, parsed_url.netloc)
+      try:
+        conn.request('GET', path, headers=request_headers)
+        response = conn.getresponse()
+        body = response.read()
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        if reused:
+          continue
+        raise
+      break
+    if response.getheader('Content-Encoding') == 'gzip':
+      body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if response.will_close:
+      conn.close()
+    else:
+      self._ReleaseConnection(parsed_url.scheme, parsed_url.netloc, conn)
+    return HTTPResponse(response.status, response.reason, response.msg, body)
+
+  def GetStats(self):
+    """Get the connection counters.
+
+    Returns:
+      Dictionary of counter name to count.
+    """
+    with self._stats_lock:
+      return dict(self._stats)
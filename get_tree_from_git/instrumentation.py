@@ -0,0 +1,218 @@
+"""Phase timers, counters and profiling for crawls and tree generation.
+
+Progress messages go through logging, so their level decides what is
+printed, and a quiet run skips formatting them at all. Alongside, METRICS
+keeps machine-readable measures of the run:
+
+  phases: total seconds and calls of search, manifest_fetch, decode,
+      persist and tree_build, summed over all threads.
+  counters: API calls by resource, 404s, rate limited retries, and cache
+      hits, revalidations and misses.
+  gauges: the last quota remaining of every resource.
+
+The run is set up from environment variables by Instrumented, which the
+scripts wrap their work in:
+
+  GIT_TREE_LOG_LEVEL: logging level name, default to INFO; DEBUG shows
+      every request and evaluated repo, WARNING keeps the run quiet.
+  GIT_TREE_METRICS: path of a JSON lines file, which gets a line for every
+      timed phase call and a summary line at the end.
+  GIT_TREE_PROFILE: path to write cProfile stats of the whole run to.
+"""
+
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+
+PHASES = ('search', 'manifest_fetch', 'decode', 'persist', 'tree_build')
+
+
+class _PhaseTimer(object):
+  """Context manager timing one call of a phase.
+
+  A class rather than a generator, as it wraps every request.
+  """
+
+  __slots__ = ('_metrics', '_phase', '_start_time')
+
+  def __init__(self, metrics, phase):
+    self._metrics = metrics
+    self._phase = phase
+    self._start_time = None
+
+  def __enter__(self):
+    self._start_time = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._metrics.AddTime(self._phase, time.time() - self._start_time)
+
+
+class Metrics(object):
+  """Thread-safe phase timers, counters and gauges of a run."""
+
+  def __init__(self):
+    """Set up empty measures without a JSON lines file."""
+    self._lock = threading.Lock()
+    self._phase_seconds = collections.defaultdict(float)
+    self._phase_calls = collections.Counter()
+    self._counters = collections.Counter()
+    self._gauges = {}
+    self._events_file = None
+
+  def OpenEvents(self, file_name):
+    """Start writing a JSON line for every timed phase call.
+
+    Args:
+      file_name: String for the path of the JSON lines file.
+    """
+    with self._lock:
+      self._events_file = open(file_name, 'a')
+
+  def CloseEvents(self):
+    """Stop writing JSON lines and close the file."""
+    with self._lock:
+      if self._events_file:
+        self._events_file.close()
+        self._events_file = None
+
+  def Time(self, phase):
+    """Time a phase call, for use in a with statement.
+
+    Args:
+      phase: String for the phase, one of PHASES.
+
+    Returns:
+      Context manager adding the time spent within it to the phase.
+    """
+    return _PhaseTimer(self, phase)
+
+  def AddTime(self, phase, seconds):
+    """Add the time of a phase call.
+
+    Args:
+      phase: String for the phase, one of PHASES.
+      seconds: Float for the seconds the call took.
+    """
+    with self._lock:
+      self._phase_seconds[phase] += seconds
+      self._phase_calls[phase] += 1
+      if self._events_file:
+        self._WriteEvent(
+            {'event': 'phase', 'phase': phase, 'seconds': seconds})
+
+  def Increment(self, counter, count=1):
+    """Add to a counter.
+
+    Args:
+      counter: String for the counter name.
+      count: Integer to add.
+    """
+    with self._lock:
+      self._counters[counter] += count
+
+  def SetGauge(self, gauge, value):
+    """Set a gauge to its latest value.
+
+    Args:
+      gauge: String for the gauge name.
+      value: Number for the value.
+    """
+    with self._lock:
+      self._gauges[gauge] = value
+
+  def GetSummary(self):
+    """Get all measures of the run so far.
+
+    Returns:
+      Dictionary with 'phases', mapping each timed phase to its seconds and
+      calls, 'counters' and 'gauges'.
+    """
+    with self._lock:
+      return {
+          'phases': dict(
+              (phase, {'seconds': self._phase_seconds[phase],
+                       'calls': self._phase_calls[phase]})
+              for phase in self._phase_calls),
+          'counters': dict(self._counters),
+          'gauges': dict(self._gauges),
+      }
+
+  def Report(self):
+    """Log the summary, and write it as the last JSON line if enabled."""
+    summary = self.GetSummary()
+    for phase in PHASES:
+      if phase in summary['phases']:
+        logging.info('Phase %s: %.2f seconds in %d calls', phase,
+                     summary['phases'][phase]['seconds'],
+                     summary['phases'][phase]['calls'])
+    if summary['counters']:
+      logging.info('Counters: %s', ', '.join(
+          '%s=%d' % item for item in sorted(summary['counters'].iteritems())))
+    if summary['gauges']:
+      logging.info('Gauges: %s', ', '.join(
+          '%s=%s' % item for item in sorted(summary['gauges'].iteritems())))
+    with self._lock:
+      if self._events_file:
+        summary['event'] = 'summary'
+        self._WriteEvent(summary)
+        self._events_file.flush()
+
+  def _WriteEvent(self, event):
+    """Write a JSON line, under the lock.
+
+    Args:
+      event: Dictionary for the line.
+    """
+    event['time'] = time.time()
+    self._events_file.write(json.dumps(event, sort_keys=True) + '\n')
+
+
+# Shared by all modules and threads of a run.
+METRICS = Metrics()
+
+
+def ConfigureLogging(level_name=None):
+  """Set the level of the progress messages.
+
+  Args:
+    level_name: String for the logging level name; if not given, it is
+        read from GIT_TREE_LOG_LEVEL, default to INFO.
+  """
+  level_name = level_name or os.environ.get('GIT_TREE_LOG_LEVEL') or 'INFO'
+  logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+  logging.getLogger().setLevel(getattr(logging, level_name.upper()))
+
+
+@contextlib.contextmanager
+def Instrumented():
+  """Set up logging, metrics and profiling for a run from the environment.
+
+  Yields:
+    Metrics of the run; the summary is logged when the block exits.
+  """
+  ConfigureLogging()
+  metrics_file = os.environ.get('GIT_TREE_METRICS')
+  if metrics_file:
+    METRICS.OpenEvents(metrics_file)
+  profile_file = os.environ.get('GIT_TREE_PROFILE')
+  profiler = cProfile.Profile() if profile_file else None
+  if profiler:
+    profiler.enable()
+  try:
+    yield METRICS
+  finally:
+    if profiler:
+      profiler.disable()
+      profiler.dump_stats(profile_file)
+      logging.info('Profile is written to %s', profile_file)
+      if logging.getLogger().isEnabledFor(logging.DEBUG):
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+    METRICS.Report()
+    METRICS.CloseEvents()
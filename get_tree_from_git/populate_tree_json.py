@@ -5,14 +5,77 @@ node from D3), and list out more generations of Git libaries dependent on D3
 and its future generation, or libraries that D3 is dependent on.
 
 For each node, we will store the name, full path name, and create date.
+
+The tree JSON is streamed to disk node by node, so writing it takes memory
+for the crawl graph but not for the whole tree. It can also be split into a
+small top file with the first levels and shard files for deeper subtrees,
+which the web template loads as nodes are expanded.
+
+A crawl from several root keywords is written as a forest, with the trees of
+every root and direction in one file.
+
+A wide crawl can be written at a bounded size by keeping only the top
+children of every node, ranked by stars or creation date, and collapsing the
+rest into a '+N more' summary node; a node budget then caps the whole tree.
 """
 import collections
 import json
 import logging
 import os
+import shutil
+import sys
+
+import crawl_store
+import instrumentation
 import utilities as util
 
-logging.basicConfig(level=logging.DEBUG)
+# Set to limit the size of the tree written by this script, see the
+# top_children and node_budget arguments of TreeGenerator.
+TOP_CHILDREN = None
+NODE_BUDGET = None
+
+# Orders the children of a node are ranked in when only the top ones are
+# kept: by most stars, or by oldest creation date, the order the web
+# template's sortByDate draws them in.
+RANK_BY_STARS = 'stars'
+RANK_BY_DATE = 'date'
+
+# Edge status of the summary node of the children left out, whose child is
+# the summary JSON object instead of a full name.
+_COLLAPSED = 'collapsed'
+
+
+class _Frame(object):
+  """Node being materialized on the traversal stack.
+
+  Attributes:
+    name: String for the node full name.
+    depth: Integer for the depth level the node's children are in.
+    edges: Iterator over the (child full name, status) tuples of the node.
+    children: List of the children JSON objects materialized so far, which
+        stays empty when the tree is streamed.
+    num_children: Integer for the children materialized so far.
+    height: Integer for the levels of descendants materialized so far.
+    complete: Boolean for whether no edge below the node was cut as a cycle.
+    node: Dictionary for the node's JSON object, or None for a root parent,
+        whose children are the first level of the tree.
+    names: Set of the full names of the nodes materialized below the node,
+        which a reused subtree must not have on the path it is reused on.
+  """
+
+  __slots__ = ('name', 'depth', 'edges', 'children', 'num_children', 'height',
+               'complete', 'node', 'names')
+
+  def __init__(self, name, depth, edges, node=None):
+    self.name = name
+    self.depth = depth
+    self.edges = iter(edges)
+    self.node = node
+    self.children = []
+    self.num_children = 0
+    self.height = 0
+    self.complete = True
+    self.names = set()
 
 
 class TreeGenerator(object):
@@ -21,139 +84,560 @@ class TreeGenerator(object):
   The output will be a JSON object that contains children libraries for levels
   specifed by the depth number.
 
+  The tree is materialized with an explicit stack rather than recursion, and
+  the children of every node are materialized once and reused wherever the
+  node shows up again, so a dense graph costs time linear in its nodes and
+  edges. An edge back to a node on the current path is a cycle, and is kept
+  as a repeated leaf. A subtree is not reused where one of its nodes is on
+  the path, as that node is a cycle there, so the tree is the same whichever
+  branch a shared node is first materialized in.
+
   Attributes:
     direction: String for direction to generate tree for.
     max_depth: Integer for number of depths to populate tree for.
+    share_subtrees: Boolean for whether a subtree that shows up more than
+        once is written out only the first time, with a 'subtreeId' of its
+        node full name, and elsewhere replaced by a 'subtreeRef' to that id,
+        which the web template copies the children from on expand; D3 keys
+        the drawn nodes by their own 'id'. When the tree is streamed, later
+        refs are not known yet, so the first occurrence of every node with
+        children gets its id. The children of a root parent have no node to
+        refer to, and are written out again.
+    root_keyword: String for the root keyword the crawl started from.
+    top_children: Integer for the children kept per node, or None to keep
+        all. The rest are collapsed into one summary node, named '+N more',
+        with 'more' for their number, 'moreStars' for their stars and
+        'moreRepeats' for how many of them are repeated.
+    rank_by: String for how children are ranked to keep the top ones, either
+        RANK_BY_STARS or RANK_BY_DATE.
+    node_budget: Integer for the most nodes below the origin, or None for no
+        limit. Children are cut from the deepest level up, keeping the same
+        number of top children for every node of a level, until the tree
+        fits. The budget counts repeated and shared subtrees in full, so the
+        tree written can be smaller.
   """
 
-  def __init__(self, direction, max_depth):
-    """Initialize tree data and tree output.
+  def __init__(self, direction, max_depth, share_subtrees=False,
+               root_keyword='d3', top_children=None, rank_by=RANK_BY_STARS,
+               node_budget=None):
+    """Initialize tree output.
 
     Args:
       direction: String for direction to generate tree for.
       max_depth: Integer for number of depths to populate tree for.
+      share_subtrees: Boolean for whether shared subtrees are written out
+          once and referred to by id.
+      root_keyword: String for the root keyword the crawl started from.
+      top_children: Integer for the children kept per node, or None to keep
+          all.
+      rank_by: String for the order to keep the top children in.
+      node_budget: Integer for the most nodes below the origin, or None for
+          no limit.
     """
     self.direction = direction
     self.max_depth = max_depth
-    self._tree_data = collections.defaultdict(dict)
-    # Get existing data from the populated raw data file, and update overall
-    # tree_data for later use. Adding depth buffer for upward population as the
-    # data layout requires an additional level for the children info.
-    depth_buffer = 1 if direction == 'upward' else 0
-    for depth in xrange(1, max_depth + 1 + depth_buffer):
-      self._tree_data.update(util.GetTreePickle('{}_raw_data_depth_{}'.format(
-          direction, depth)))
+    self.share_subtrees = share_subtrees
+    self.root_keyword = root_keyword
+    self.top_children = top_children
+    self.rank_by = rank_by
+    self.node_budget = node_budget
     # Start from the base level, and we will name it origin to separate it from
     # the rest of the nodes.
     self._json_output = {
         'name': 'origin',
         'direction': direction,
     }
+    # Dictionary of parent full name to its (child full name, status) tuples,
+    # read from the crawl store on first use.
+    self._edges = None
+    # Dictionary of node full name to display name.
+    self._display_names = {}
+    # Dictionary of node full name to its (stars, creation time), read with
+    # the display name when children are ranked.
+    self._rank_details = {}
+    # Dictionary of parent full name to its ranked (child full name, status)
+    # tuples, without the children that did not match.
+    self._ranked_edges = {}
+    # List of the children kept per node by the depth level they are in, or
+    # None if all children are kept; computed on first use.
+    self._depth_caps = None
+    self._ResetSubtrees()
+
+  def _ResetSubtrees(self):
+    """Forget the subtrees materialized by an earlier pass over the tree."""
+    # Dictionary of node full name to (children list, depth levels the
+    # children were allowed, levels materialized, set of the node full names
+    # below) of its first materialization.
+    self._subtrees = {}
+    # Dictionary of node full name to the JSON object its kept children were
+    # materialized in, which gets the id once a shared subtree refers to it,
+    # or None for a root parent, which has no object to refer to.
+    self._first_nodes = {}
+    # Set of node full names given an id while the tree is streamed.
+    self._streamed_ids = set()
 
   def PopulateTree(self):
     """Populate tree for the direction.
 
-    We will start with the original node, where parent name is D3, and
-    propagate through the rest of the tree. We will write the output
-    to an overall json file so that we can just read in one file from
+    We will start with the original node, where parent name is the root
+    keyword, and propagate through the rest of the tree. We will write the
+    output to an overall json file so that we can just read in one file from
     the actual web template.
     """
-    self._json_output['children'] = getattr(self, 'Map{}Child'.format(
-        self.direction))('d3', 1)
+    self._ResetSubtrees()
+    self._json_output['children'] = []
+    with util.METRICS.Time('tree_build'):
+      for root_parent in self.GetRootParents(self.root_keyword):
+        self._json_output['children'].extend(self.MapChild(root_parent, 1))
     logging.info('Populated JSON tree for %s', self.direction)
     return self._json_output
 
-  # pylint: disable=g-explicit-bool-comparison
-  def MapdownwardChild(self, parent_name, depth):
-    """Populate D3-tree-compatible structure for each downward child.
+  def GetRootParents(self, root_keyword):
+    """Get the parents whose children are the first level of the tree.
+
+    For downward, the first level are the repos dependent on the root
+    itself. For upward, the crawl first finds the root repo, and the first
+    level are the dependencies of that repo.
+
+    Args:
+      root_keyword: String for the root keyword the crawl started from.
+
+    Returns:
+      List of parent names to get the first level children for.
+    """
+    if self.direction == 'downward':
+      return [root_keyword]
+    return [child for child, status in util.CRAWL_STORE.GetChildren(
+        self.direction, root_keyword) if status == crawl_store.MATCH]
 
-    For each child node, from the tree dictionary, get the children keys and
-    children generation, and recurse through the same function to get future
-    generation details.
+  def MapChild(self, parent_name, depth):
+    """Populate D3-tree-compatible structure for each child.
+
+    For each child node, get the child's detail from the crawl store, and
+    go through the same steps for future generation details.
 
     Args:
-      parent_name: String for parent node name.
+      parent_name: String for parent node full name.
       depth: Integer for the depth level the children are in, and we use it to
           terminate the overall population if it exceeds the max cap.
 
     Returns:
       List of children array.
     """
-    children_array = []
     # If depth exceeds the max amount, return empty array.
     if depth > self.max_depth:
-      return children_array
-    logging.info('Populating child for %s...', parent_name)
-    depth += 1
-    num_mapped_children = 0
-    for child_name, child_info in self._tree_data[parent_name].iteritems():
-      # For downward, we will separate out cases when child_info is {} versus
-      # when child_info is False: {} means child_info is already mapped
-      # earlier, and thus it should not contain anymore children nodes;
-      # whereas False means that they are not part of the dependent files, but
+      return []
+    on_path = set([parent_name])
+    subtree = self._GetSubtree(parent_name, depth, on_path)
+    if subtree is not None:
+      return subtree[0]
+    stack = [self._EnterNode(parent_name, depth)]
+    while True:
+      frame = stack[-1]
+      child_name, status = next(frame.edges, (None, None))
+      if child_name is None:
+        self._LeaveNode(frame)
+        stack.pop()
+        on_path.discard(frame.name)
+        if not stack:
+          return frame.children
+        self._AddToParent(stack[-1], frame)
+        continue
+      # We will separate out cases when the repo is repeated versus when it
+      # has no match: repeated means the repo is already mapped earlier, while
+      # no match means that they are not part of the dependent files, but
       # rather they are kept in crawling process to prevent repetitive search.
-      if child_info == False:
+      if status == crawl_store.NO_MATCH:
         continue
-      child_json = {
-          'name': self.GetNodeDisplayName(child_info),
-          'children': self.MapdownwardChild(child_name, depth),
-      }
+      if status == _COLLAPSED:
+        frame.children.append(child_name)
+        frame.num_children += 1
+        frame.height = max(frame.height, 1)
+        continue
+      child_json = {'name': self._GetDisplayName(child_name)}
       # Add in repeated flag to differentiate nodes with the same name.
-      if child_info == {}:
+      if status == crawl_store.REPEAT:
+        child_json['repeated'] = True
+      frame.children.append(child_json)
+      frame.names.add(child_name)
+      frame.num_children += 1
+      frame.height = max(frame.height, 1)
+      child_depth = frame.depth + 1
+      if child_name in on_path:
+        # The child is its own ancestor, so it is not expanded again, and the
+        # subtrees it is in depend on the path and are not reused.
+        child_json['children'] = []
         child_json['repeated'] = True
-      num_mapped_children += 1
-      children_array.append(child_json)
-    logging.info('%d of children were populated for %s',
-                 num_mapped_children, parent_name)
-    return children_array
+        frame.complete = False
+        continue
+      if child_depth > self.max_depth:
+        child_json['children'] = []
+        continue
+      subtree = self._GetSubtree(child_name, child_depth, on_path)
+      if subtree is not None:
+        children, height, names = subtree
+        frame.names.update(names)
+        first_node = self._first_nodes.get(child_name)
+        if self.share_subtrees and children and first_node is not None:
+          child_json['subtreeRef'] = child_name
+          first_node['subtreeId'] = child_name
+        else:
+          child_json['children'] = children
+        frame.height = max(frame.height, height + 1)
+        continue
+      child_frame = self._EnterNode(child_name, child_depth, child_json)
+      child_json['children'] = child_frame.children
+      stack.append(child_frame)
+      on_path.add(child_name)
+
+  def IterNodes(self):
+    """Walk the tree for the direction lazily, in pre-order.
 
-  def MapupwardChild(self, parent_name, depth):
-    """Populate D3-tree-compatible structure for each upward child.
+    Unlike PopulateTree, no part of the tree is kept once it is yielded, and
+    a subtree that shows up more than once is walked again unless
+    share_subtrees is set.
 
-    For each child node, from their children array, get the children keys and
-    find the children info from the tree dictionary, and recurse through the
-    same function to get future generation details.
-    Using parent_object would avoid re-calling the same object twice, but to
-    allow reuseable PopulateTree code, plus there are only little nodes to loop
-    through, we will stick with parent_name.
+    Yields:
+      Tuple of (integer for the nesting level, with 0 for the origin,
+      dictionary for the node); a node that has children has an empty
+      'children' list, and its children are the nodes yielded after it with
+      a higher level.
+    """
+    self._ResetSubtrees()
+    yield (0, {'name': 'origin', 'direction': self.direction, 'children': []})
+    for root_parent in self.GetRootParents(self.root_keyword):
+      for level_node in self._IterChildren(root_parent, 1):
+        yield level_node
+    logging.info('Streamed JSON tree for %s', self.direction)
+
+  def _IterChildren(self, parent_name, depth):
+    """Walk the descendants of a node lazily, in pre-order.
 
     Args:
-      parent_name: String for parent node name.
-      depth: Integer for the depth level the children are in, and we use it to
-          terminate the overall population if it exceeds the max cap.
+      parent_name: String for parent node full name.
+      depth: Integer for the depth level the children are in, which is also
+          their nesting level.
 
-    Returns:
-      List of children array.
+    Yields:
+      Tuple of (integer for the nesting level, dictionary for the node).
     """
-    children_array = []
-    # If depth exceeds the max amount, return empty array.
     if depth > self.max_depth:
-      return children_array
-    logging.info('Populating child for %s...', parent_name)
-    depth += 1
-    num_mapped_children = 0
-    for child_name, child_info in self._tree_data[parent_name][
-        'all_dependencies'].iteritems():
-      # For upward, we will separate out cases when child_info is '' versus
-      # when child info is not found: '' means child_info is already mapped
-      # earlier, and thus it should not contain anymore children nodes;
-      # whereas if child info is not found int the tree dictionary, it  means
-      # that they are not part of the dependent files.
-      if child_name not in self._tree_data:
+      return
+    stack = [self._EnterNode(parent_name, depth)]
+    on_path = set([parent_name])
+    while stack:
+      frame = stack[-1]
+      child_name, status = next(frame.edges, (None, None))
+      if child_name is None:
+        self._LeaveNode(frame)
+        stack.pop()
+        on_path.discard(frame.name)
+        if stack:
+          self._AddToParent(stack[-1], frame)
         continue
-      child_detail = self._tree_data[child_name]
-      child_json = {
-          'name': self.GetNodeDisplayName(child_detail),
-          'children': self.MapupwardChild(child_name, depth),
-      }
-      # Add in repeated flag to differentiate nodes with the same name.
-      if child_info == '':
+      if status == crawl_store.NO_MATCH:
+        continue
+      if status == _COLLAPSED:
+        frame.num_children += 1
+        frame.height = max(frame.height, 1)
+        # Writers can change yielded nodes, so every one gets its own copy.
+        yield (frame.depth, dict(child_name, children=[]))
+        continue
+      child_json = {'name': self._GetDisplayName(child_name), 'children': []}
+      if status == crawl_store.REPEAT:
         child_json['repeated'] = True
-      num_mapped_children += 1
-      children_array.append(child_json)
-    logging.info('%d of children were populated for %s',
-                 num_mapped_children, parent_name)
-    return children_array
+      # The names below a node are only needed to reuse its subtree.
+      if self.share_subtrees:
+        frame.names.add(child_name)
+      frame.num_children += 1
+      frame.height = max(frame.height, 1)
+      child_depth = frame.depth + 1
+      if child_name in on_path:
+        child_json['repeated'] = True
+        frame.complete = False
+        yield (frame.depth, child_json)
+        continue
+      if child_depth > self.max_depth:
+        yield (frame.depth, child_json)
+        continue
+      if self.share_subtrees:
+        subtree = self._GetSubtree(child_name, child_depth, on_path)
+        # Only a node yielded with an id can be referred to, and the id went
+        # to the node's first occurrence, which may not be the one kept.
+        first_node = self._first_nodes.get(child_name)
+        if (subtree is not None and subtree[1] and first_node is not None and
+            'subtreeId' in first_node):
+          del child_json['children']
+          child_json['subtreeRef'] = child_name
+          frame.height = max(frame.height, subtree[1] + 1)
+          frame.names.update(subtree[2])
+          yield (frame.depth, child_json)
+          continue
+        if (child_name not in self._streamed_ids and
+            self._GetEdges(child_name)):
+          self._streamed_ids.add(child_name)
+          child_json['subtreeId'] = child_name
+      yield (frame.depth, child_json)
+      stack.append(self._EnterNode(child_name, child_depth, child_json))
+      on_path.add(child_name)
+
+  def _GetEdges(self, name):
+    """Get the edges of a node, reading all edges of the direction once.
+
+    Args:
+      name: String for the node full name.
+
+    Returns:
+      List of (child full name, status) tuples in crawl order.
+    """
+    if self._edges is None:
+      self._edges = collections.defaultdict(list)
+      for parent, child, status in util.CRAWL_STORE.GetEdges(self.direction):
+        self._edges[parent].append((child, status))
+    return self._edges.get(name, ())
+
+  def _EnterNode(self, name, depth, node=None):
+    """Start materializing the children of a node.
+
+    Args:
+      name: String for the node full name.
+      depth: Integer for the depth level the children are in.
+      node: Dictionary for the node's JSON object, or None for a root parent.
+
+    Returns:
+      _Frame for the node.
+    """
+    logging.debug('Populating child for %s...', name)
+    return _Frame(name, depth, self._GetShownEdges(name, depth), node)
+
+  def _LeaveNode(self, frame):
+    """Finish materializing the children of a node, and keep them for reuse.
+
+    Args:
+      frame: _Frame for the node.
+    """
+    logging.debug('%d of children were populated for %s',
+                  frame.num_children, frame.name)
+    # Only the first materialization is kept, as shared subtrees refer to it.
+    if frame.complete and frame.name not in self._subtrees:
+      self._subtrees[frame.name] = (
+          frame.children, self.max_depth - frame.depth + 1, frame.height,
+          frame.names)
+      self._first_nodes[frame.name] = frame.node
+
+  def _AddToParent(self, parent, frame):
+    """Add what was materialized below a node to its parent.
+
+    Args:
+      parent: _Frame for the parent.
+      frame: _Frame for the node, which is done.
+    """
+    parent.height = max(parent.height, frame.height + 1)
+    parent.complete = parent.complete and frame.complete
+    parent.names.update(frame.names)
+
+  def _GetSubtree(self, name, depth, on_path):
+    """Get the materialized children of a node, if they can be reused.
+
+    Children materialized with a different depth cap can be reused if the
+    cap did not cut them short, and they fit within the new cap. Children
+    with a node on the current path are materialized again, as that node is
+    a cycle there.
+
+    Args:
+      name: String for the node full name.
+      depth: Integer for the depth level the children are in.
+      on_path: Set of the full names of the node's ancestors.
+
+    Returns:
+      Tuple of (children list, integer for the levels of descendants, set of
+      the node full names below), or None if the node has to be
+      materialized.
+    """
+    if name not in self._subtrees:
+      return None
+    children, levels, height, names = self._subtrees[name]
+    if not on_path.isdisjoint(names):
+      return None
+    allowed_levels = self.max_depth - depth + 1
+    if levels == allowed_levels:
+      return (children, height, names)
+    # The children kept per node differ by depth, so children materialized
+    # elsewhere were cut differently.
+    if self._GetDepthCaps() is not None:
+      return None
+    if height < min(levels, allowed_levels + 1):
+      return (children, height, names)
+    return None
+
+  def _GetShownEdges(self, name, depth):
+    """Get the edges of a node to walk, after keeping the top children.
+
+    Args:
+      name: String for the node full name.
+      depth: Integer for the depth level the children are in.
+
+    Returns:
+      List of (child full name, status) tuples; if children are left out,
+      the last tuple is (summary JSON object, _COLLAPSED).
+    """
+    depth_caps = self._GetDepthCaps()
+    if depth_caps is None:
+      return self._GetEdges(name)
+    ranked_edges = self._GetRankedEdges(name)
+    cap = depth_caps[depth]
+    if len(ranked_edges) <= cap:
+      return ranked_edges
+    collapsed_edges = ranked_edges[cap:]
+    return ranked_edges[:cap] + [({
+        'name': '+{} more'.format(len(collapsed_edges)),
+        'more': len(collapsed_edges),
+        'moreStars': sum(self._GetRankDetail(child)[0]
+                         for child, _ in collapsed_edges),
+        'moreRepeats': sum(1 for _, status in collapsed_edges
+                           if status == crawl_store.REPEAT),
+        'children': [],
+    }, _COLLAPSED)]
+
+  def _GetRankedEdges(self, name):
+    """Get the edges of a node to its matched children, best ranked first.
+
+    Args:
+      name: String for the node full name.
+
+    Returns:
+      List of (child full name, status) tuples, ranked by rank_by, and in
+      crawl order for ties.
+    """
+    ranked_edges = self._ranked_edges.get(name)
+    if ranked_edges is None:
+      ranked_edges = [edge for edge in self._GetEdges(name)
+                      if edge[1] != crawl_store.NO_MATCH]
+      if self.rank_by == RANK_BY_DATE:
+        # Repos without a creation time go last.
+        ranked_edges.sort(key=lambda edge: (
+            self._GetRankDetail(edge[0])[1] is None,
+            self._GetRankDetail(edge[0])[1]))
+      else:
+        ranked_edges.sort(key=lambda edge: -self._GetRankDetail(edge[0])[0])
+      self._ranked_edges[name] = ranked_edges
+    return ranked_edges
+
+  def _GetDepthCaps(self):
+    """Get the children kept per node at every depth level.
+
+    Without a node budget, every level keeps top_children. With one, the
+    deepest level is cut first, to the most children that fit the budget,
+    and only if even keeping none of its children does not fit is the level
+    above it cut, and so on.
+
+    Returns:
+      List of the children kept per node, indexed by the depth level they
+      are in, or None if all children are kept.
+    """
+    if self._depth_caps is not None or (
+        self.top_children is None and self.node_budget is None):
+      return self._depth_caps
+    root_parents = self.GetRootParents(self.root_keyword)
+    if self.top_children is not None:
+      top_children = self.top_children
+    else:
+      self._GetEdges(self.root_keyword)
+      top_children = max([len(edges) for edges in self._edges.itervalues()] or
+                         [0])
+    depth_caps = [top_children] * (self.max_depth + 1)
+    if (self.node_budget is not None and
+        self._CountNodes(root_parents, depth_caps) > self.node_budget):
+      for depth in xrange(self.max_depth, 0, -1):
+        # Binary search for the most children of the level that fit.
+        low, high = 0, depth_caps[depth]
+        while low < high:
+          depth_caps[depth] = (low + high + 1) // 2
+          if self._CountNodes(root_parents, depth_caps) <= self.node_budget:
+            low = depth_caps[depth]
+          else:
+            high = depth_caps[depth] - 1
+        depth_caps[depth] = low
+        if low or self._CountNodes(
+            root_parents, depth_caps) <= self.node_budget:
+          break
+    logging.info('Children kept per node by depth for %s: %s',
+                 self.direction, depth_caps[1:])
+    self._depth_caps = depth_caps
+    return depth_caps
+
+  def _CountNodes(self, root_parents, depth_caps):
+    """Count the nodes below the origin for the given children per node.
+
+    Args:
+      root_parents: List of the parents of the first level.
+      depth_caps: List of the children kept per node by depth level.
+
+    Returns:
+      Integer for the nodes, counting repeated subtrees in full.
+    """
+    # Dictionary of (node full name, depth level of its children) to the
+    # nodes below it. A child is one level deeper than its parent, so the
+    # counts never wait on themselves, and the recursion is at most max_depth
+    # deep.
+    counts = {}
+
+    def CountBelow(name, depth):
+      if depth > self.max_depth:
+        return 0
+      key = (name, depth)
+      if key not in counts:
+        ranked_edges = self._GetRankedEdges(name)
+        kept_edges = ranked_edges[:depth_caps[depth]]
+        counts[key] = (
+            len(kept_edges) + (len(ranked_edges) > len(kept_edges)) +
+            sum(CountBelow(child, depth + 1) for child, _ in kept_edges))
+      return counts[key]
+
+    return sum(CountBelow(name, 1) for name in root_parents)
+
+  def _GetDisplayName(self, name):
+    """Get the display name of a node, reading the node once.
+
+    Args:
+      name: String for the node full name.
+
+    Returns:
+      String for the display name.
+    """
+    display_name = self._display_names.get(name)
+    if display_name is None:
+      self._ReadNode(name)
+      display_name = self._display_names[name]
+    return display_name
+
+  def _GetRankDetail(self, name):
+    """Get the details of a node its rank is based on, reading it once.
+
+    Args:
+      name: String for the node full name.
+
+    Returns:
+      Tuple of (integer for the stars, string for the creation time or
+      None).
+    """
+    rank_detail = self._rank_details.get(name)
+    if rank_detail is None:
+      self._ReadNode(name)
+      rank_detail = self._rank_details[name]
+    return rank_detail
+
+  def _ReadNode(self, name):
+    """Read a node from the crawl store, and keep the details used of it.
+
+    Args:
+      name: String for the node full name.
+    """
+    node_object = util.CRAWL_STORE.GetNode(name)
+    self._display_names[name] = self.GetNodeDisplayName(node_object)
+    if self.top_children is not None or self.node_budget is not None:
+      self._rank_details[name] = (node_object.stargazers_count or 0,
+                                  node_object.created_at)
 
   def GetNodeDisplayName(self, node_object):
     """We will create customized names for tree nodes.
@@ -161,20 +645,239 @@ class TreeGenerator(object):
     The display is set to be '{path_name} ({create_date})'.
 
     Args:
-      node_object: Dictionary containing the repo detail.
+      node_object: crawl_store.RepoNode containing the repo detail.
 
     Returns:
       String for the display name.
     """
     return '{} ({})'.format(
-        node_object['full_name'], node_object['created_at'][:4])
+        node_object.full_name, (node_object.created_at or '')[:4])
+
+
+def WriteTreeJSON(js, tree_generators, indent=None):
+  """Stream the trees of several directions into one JSON document.
+
+  The document maps each direction to its tree, and is written node by node
+  as the trees are walked.
+
+  Args:
+    js: File object to write to.
+    tree_generators: List of TreeGenerator, one for each direction.
+    indent: Integer for the spaces to indent nested levels with; if not
+        given, the output is compact without any whitespace.
+  """
+  newline, key_separator = _GetFormat(indent)
+  js.write('{')
+  for index, tree_generator in enumerate(tree_generators):
+    if index:
+      js.write(',')
+    js.write(newline(1) + json.dumps(tree_generator.direction) + key_separator)
+    with util.METRICS.Time('tree_build'):
+      _WriteTree(js, tree_generator, newline, key_separator, 1)
+  js.write(newline(0) + '}\n')
+
+
+def WriteForestJSON(js, tree_generators, indent=None):
+  """Stream the trees of several roots and directions into one JSON document.
+
+  The document maps each root keyword to an object that maps each direction
+  to its tree, like the document of WriteTreeJSON.
+
+  Args:
+    js: File object to write to.
+    tree_generators: List of TreeGenerator, one for each root and direction,
+        in the order the roots are written in.
+    indent: Integer for the spaces to indent nested levels with; if not
+        given, the output is compact without any whitespace.
+  """
+  newline, key_separator = _GetFormat(indent)
+  root_generators = collections.OrderedDict()
+  for tree_generator in tree_generators:
+    root_generators.setdefault(tree_generator.root_keyword, []).append(
+        tree_generator)
+  js.write('{')
+  for root_index, (root_keyword, generators) in enumerate(
+      root_generators.iteritems()):
+    if root_index:
+      js.write(',')
+    js.write(newline(1) + json.dumps(root_keyword) + key_separator + '{')
+    for index, tree_generator in enumerate(generators):
+      if index:
+        js.write(',')
+      js.write(newline(2) + json.dumps(tree_generator.direction) +
+               key_separator)
+      with util.METRICS.Time('tree_build'):
+        _WriteTree(js, tree_generator, newline, key_separator, 2)
+    js.write(newline(1) + '}')
+  js.write(newline(0) + '}\n')
+
+
+def _GetFormat(indent):
+  """Get the whitespace of a streamed JSON document.
+
+  Args:
+    indent: Integer for the spaces to indent nested levels with, or None for
+        compact output.
+
+  Returns:
+    Tuple of (function to get the line break and indent for a nesting,
+    string for the separator between keys and values).
+  """
+  if indent is None:
+    return (lambda nesting: '', ':')
+  return (lambda nesting: '\n' + ' ' * (indent * nesting), ': ')
+
+
+def _WriteTree(js, tree_generator, newline, key_separator, nesting):
+  """Stream a tree as the value of an object key.
+
+  Args:
+    js: File object to write to.
+    tree_generator: TreeGenerator for the tree.
+    newline: Function to get the line break and indent for a nesting.
+    key_separator: String for the separator between keys and values.
+    nesting: Integer for the nesting of the tree's origin object.
+  """
+  # Levels of the nodes whose children list is still open, and for each of
+  # them whether a child was written yet.
+  open_levels = []
+  has_children = []
+  for level, node in tree_generator.IterNodes():
+    while open_levels and open_levels[-1] >= level:
+      _CloseNode(js, newline, nesting + 2 * open_levels.pop(),
+                 has_children.pop())
+    if has_children:
+      js.write(',' if has_children[-1] else '')
+      has_children[-1] = True
+    # Every level below the origin nests an object in a list.
+    node_nesting = nesting + 2 * level
+    js.write(('' if level == 0 else newline(node_nesting)) + '{')
+    js.write(','.join(
+        newline(node_nesting + 1) + json.dumps(key) + key_separator +
+        json.dumps(value) for key, value in sorted(node.iteritems())
+        if key != 'children'))
+    if 'children' in node:
+      js.write(',' + newline(node_nesting + 1) + '"children"' +
+               key_separator + '[')
+      open_levels.append(level)
+      has_children.append(False)
+    else:
+      js.write(newline(node_nesting) + '}')
+  while open_levels:
+    _CloseNode(js, newline, nesting + 2 * open_levels.pop(),
+               has_children.pop())
+
+
+def _CloseNode(js, newline, nesting, has_children):
+  """Close the children list and the object of a streamed node.
+
+  Args:
+    js: File object to write to.
+    newline: Function to get the line break and indent for a nesting.
+    nesting: Integer for the nesting of the node's object.
+    has_children: Boolean for whether any child was written.
+  """
+  js.write((newline(nesting + 1) if has_children else '') + ']' +
+           newline(nesting) + '}')
+
+
+def WriteTreeShards(data_dir, tree_generators, shard_levels,
+                    json_name='all_tree_data.json'):
+  """Write the trees of several directions as a top file and shard files.
+
+  The top file holds the first shard_levels levels of every tree. The
+  children of a node at the last of those levels go to a shard file instead,
+  which holds the next shard_levels levels in the same way, and so on. A node
+  whose children are in a shard has the shard path relative to data_dir in
+  'shard' and the number of its children in 'childCount', and no 'children'.
+
+  Args:
+    data_dir: String for the directory to write the files into; shards go
+        into a shards directory per direction, which is cleared first.
+    tree_generators: List of TreeGenerator, one for each direction.
+    shard_levels: Integer for the levels each file holds.
+    json_name: String for the top file name.
+  """
+  top_data = {}
+  with util.METRICS.Time('tree_build'):
+    for tree_generator in tree_generators:
+      shard_dir = os.path.join('shards', tree_generator.direction)
+      if os.path.isdir(os.path.join(data_dir, shard_dir)):
+        shutil.rmtree(os.path.join(data_dir, shard_dir))
+      os.makedirs(os.path.join(data_dir, shard_dir))
+      num_shards = num_written = 0
+      # Path of open nodes, as (level, node, the list their children go into,
+      # the shard file of the list or None) tuples.
+      open_nodes = []
+      for level, node in tree_generator.IterNodes():
+        while open_nodes and open_nodes[-1][0] >= level:
+          num_written += _CloseShardNode(data_dir, *open_nodes.pop()[1:])
+        if open_nodes:
+          open_nodes[-1][2].append(node)
+        else:
+          top_data[tree_generator.direction] = node
+        if 'children' not in node:
+          continue
+        shard_file = None
+        if level and level % shard_levels == 0:
+          num_shards += 1
+          shard_file = os.path.join(shard_dir, '{}.json'.format(num_shards))
+        open_nodes.append((level, node, node['children'], shard_file))
+      while open_nodes:
+        num_written += _CloseShardNode(data_dir, *open_nodes.pop()[1:])
+      logging.info('%d shards are written for %s', num_written,
+                   tree_generator.direction)
+  with open(os.path.join(data_dir, json_name), 'w') as js:
+    json.dump(top_data, js, separators=(',', ':'))
+
+
+def _CloseShardNode(data_dir, node, children, shard_file):
+  """Finish a node of the shard output, writing its shard if it has one.
+
+  Args:
+    data_dir: String for the directory to write the files into.
+    node: Dictionary for the node.
+    children: List of the node's children JSON objects.
+    shard_file: String for the shard path relative to data_dir, or None if
+        the children stay in the node.
+
+  Returns:
+    Boolean for whether a shard was written; a node without children keeps
+    its empty children list.
+  """
+  if shard_file is None or not children:
+    return False
+  with open(os.path.join(data_dir, shard_file), 'w') as js:
+    json.dump(children, js, separators=(',', ':'))
+  del node['children']
+  node['shard'] = shard_file.replace(os.sep, '/')
+  node['childCount'] = len(children)
+  return True
 
 
 if __name__ == '__main__':
-  overall_tree_data = {}
-  overall_tree_data['downward'] = TreeGenerator('downward', 5).PopulateTree()
-  overall_tree_data['upward'] = TreeGenerator('upward', 5).PopulateTree()
-  json_file = os.path.join(os.path.dirname(__file__), 'data/all_tree_data.json')
-  with open(json_file, 'w') as js:
-    json.dump(overall_tree_data, js, indent=2, separators=(',', ':'))
-  logging.info('All tree data is output to JSON file.')
+  # Usage: populate_tree_json.py [levels per shard]; without it, the whole
+  # tree goes into one file. For a crawl from several roots, use
+  # populate_tree_json.py forest <root keyword> ... to write the trees of
+  # every root into forest_tree_data.json.
+  # Progress, metrics and profiling are set up from the environment, see
+  # instrumentation.py.
+  with instrumentation.Instrumented():
+    data_dir = util.DATA_DIR
+    all_tree_generators = [
+        TreeGenerator(direction, 5, top_children=TOP_CHILDREN,
+                      node_budget=NODE_BUDGET)
+        for direction in ('downward', 'upward')]
+    if sys.argv[1:2] == ['forest']:
+      with open(os.path.join(data_dir, 'forest_tree_data.json'), 'w') as js:
+        WriteForestJSON(js, [
+            TreeGenerator(direction, 5, root_keyword=root_keyword,
+                          top_children=TOP_CHILDREN, node_budget=NODE_BUDGET)
+            for root_keyword in sys.argv[2:]
+            for direction in ('downward', 'upward')])
+    elif len(sys.argv) > 1:
+      WriteTreeShards(data_dir, all_tree_generators, int(sys.argv[1]))
+    else:
+      with open(os.path.join(data_dir, 'all_tree_data.json'), 'w') as js:
+        WriteTreeJSON(js, all_tree_generators)
+    logging.info('All tree data is output to JSON file.')
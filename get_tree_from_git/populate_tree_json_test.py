@@ -0,0 +1,331 @@
+"""Tests for populate_tree_json, on small crawl graphs built by hand."""
+
+import json
+import os
+import random
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import crawl_store
+import populate_tree_json
+import utilities as util
+
+# Upward (parent, child) edges, all matched. The root keyword finds two root
+# repos, and the second one depends on the first, so the subtree of a root
+# parent shows up again below another node; a/x is shared by two repos below
+# the roots.
+_SHARED_EDGES = (
+    ('d3', 'o/d3'),
+    ('d3', 'o/fork'),
+    ('o/d3', 'a/x'),
+    ('a/x', 'a/z'),
+    ('o/fork', 'o/d3'),
+    ('o/fork', 'b/y'),
+    ('b/y', 'a/x'),
+)
+
+# Downward (parent, child) edges with the cycle a/c -> a/b -> a/c. Below a/a,
+# the depth cap ends the tree at a/b before the cycle closes, so the subtree
+# of a/c is complete there; below a/b, a/b is on the path of a/c's subtree.
+_CYCLE_EDGES = (
+    ('d3', 'a/a'),
+    ('d3', 'a/b'),
+    ('a/a', 'a/c'),
+    ('a/c', 'a/b'),
+    ('a/b', 'a/c'),
+)
+
+# Stars and creation times of the repos the root keyword finds, ranked
+# differently by stars and by creation time.
+_RANKED_REPOS = {
+    'o/a': (50, '2014-01-01T00:00:00Z'),
+    'o/b': (10, '2011-01-01T00:00:00Z'),
+    'o/c': (30, '2016-01-01T00:00:00Z'),
+    'o/d': (40, '2012-01-01T00:00:00Z'),
+    'o/e': (20, '2013-01-01T00:00:00Z'),
+}
+
+
+
+def _IterTree(node):
+  """Walk a tree JSON object in pre-order.
+
+  Args:
+    node: Dictionary for the node to start from.
+
+  Yields:
+    Dictionary for every node.
+  """
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    yield node
+    stack.extend(reversed(node.get('children', [])))
+
+
+class TreeTestCase(unittest.TestCase):
+  """Base for tests on a crawl store of their own."""
+
+  def setUp(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    self.addCleanup(setattr, util, 'CRAWL_STORE', util.CRAWL_STORE)
+    util.CRAWL_STORE = crawl_store.CrawlStore(
+        os.path.join(temp_dir, 'crawl.sqlite'))
+
+  def _AddEdges(self, direction, edges, repo_details=None):
+    """Add edges and the repos they link to the crawl store.
+
+    Args:
+      direction: String for the crawl direction.
+      edges: List of (parent, child) or (parent, child, status) tuples in
+          crawl order; edges without a status are matched.
+      repo_details: Dictionary of repo full name to (stars, creation time);
+          repos not in it have no stars and were created in 2016.
+    """
+    repo_details = repo_details or {}
+    for full_name in set(name for edge in edges for name in edge[:2]):
+      stars, created_at = repo_details.get(
+          full_name, (0, '2016-01-01T00:00:00Z'))
+      util.CRAWL_STORE.AddNode(crawl_store.RepoNode(
+          full_name, full_name.split('/')[-1], created_at,
+          stargazers_count=stars))
+    for edge in edges:
+      status = edge[2] if len(edge) > 2 else crawl_store.MATCH
+      util.CRAWL_STORE.AddEdge(direction, 1, edge[0], edge[1], edge[0],
+                               status)
+    util.CRAWL_STORE.Flush()
+
+  def _Stream(self, tree_generator, indent=None):
+    """Write a tree with the streaming writer, and read it back.
+
+    Args:
+      tree_generator: TreeGenerator for the tree.
+      indent: Integer for the spaces to indent nested levels with, or None
+          for compact output.
+
+    Returns:
+      Dictionary for the tree JSON object.
+    """
+    js = StringIO.StringIO()
+    populate_tree_json.WriteTreeJSON(js, [tree_generator], indent)
+    return json.loads(js.getvalue())[tree_generator.direction]
+
+  def _GetNodes(self, tree, name):
+    """Get the nodes of a tree with a full name.
+
+    Args:
+      tree: Dictionary for the tree JSON object.
+      name: String for the node full name.
+
+    Returns:
+      List of the nodes.
+    """
+    return [node for node in _IterTree(tree)
+            if node['name'].startswith(name + ' ')]
+
+
+class SharedSubtreeTest(TreeTestCase):
+  """Write trees whose shared subtrees are referred to by id."""
+
+  def setUp(self):
+    TreeTestCase.setUp(self)
+    self._AddEdges('upward', _SHARED_EDGES)
+
+  def _AssertRefsResolve(self, tree):
+    """Check that every shared subtree refers to a node written with an id.
+
+    Args:
+      tree: Dictionary for the tree JSON object.
+
+    Returns:
+      Dictionary of the node full name to its number of refs.
+    """
+    ids = set()
+    refs = {}
+    for node in _IterTree(tree):
+      if 'subtreeId' in node:
+        ids.add(node['subtreeId'])
+        self.assertTrue(node['children'])
+      if 'subtreeRef' in node:
+        refs[node['subtreeRef']] = refs.get(node['subtreeRef'], 0) + 1
+        self.assertNotIn('children', node)
+    self.assertLessEqual(set(refs), ids)
+    return refs
+
+  def testPopulateTreeReusesRootSubtree(self):
+    tree = populate_tree_json.TreeGenerator(
+        'upward', 5, share_subtrees=True).PopulateTree()
+    self.assertEqual({'a/x': 1}, self._AssertRefsResolve(tree))
+    # The subtree of a root parent has no node to refer to, so it is inlined.
+    reused_root, = self._GetNodes(tree, 'o/d3')
+    self.assertEqual(['a/x (2016)'],
+                     [child['name'] for child in reused_root['children']])
+
+  def testStreamedTreeReusesRootSubtree(self):
+    tree = self._Stream(populate_tree_json.TreeGenerator(
+        'upward', 5, share_subtrees=True))
+    # Streamed nodes get their id up front, so the subtree of a root parent
+    # is walked again, and refers to a/x like b/y does.
+    self.assertEqual({'a/x': 2}, self._AssertRefsResolve(tree))
+    reused_root, = self._GetNodes(tree, 'o/d3')
+    self.assertEqual('o/d3', reused_root['subtreeId'])
+
+
+class CycleTest(TreeTestCase):
+  """Write trees of a graph with a cycle."""
+
+  def setUp(self):
+    TreeTestCase.setUp(self)
+    self._AddEdges('downward', _CYCLE_EDGES)
+
+  def testSubtreeWithNodeOnPathIsNotReused(self):
+    tree = populate_tree_json.TreeGenerator('downward', 3).PopulateTree()
+    first_b, second_b, nested_b = self._GetNodes(tree, 'a/b')
+    # Below a/a, a/b is only cut by the depth cap.
+    self.assertNotIn('repeated', first_b)
+    self.assertFalse(second_b.get('repeated'))
+    self.assertTrue(nested_b['repeated'])
+
+  def testPopulateTreeMatchesStreamedTree(self):
+    self.assertEqual(
+        self._Stream(populate_tree_json.TreeGenerator('downward', 3)),
+        populate_tree_json.TreeGenerator('downward', 3).PopulateTree())
+
+
+class TopChildrenTest(TreeTestCase):
+  """Write trees that keep the top children, and summarize the rest."""
+
+  def setUp(self):
+    TreeTestCase.setUp(self)
+    # o/e is a repeat, and o/x has no dependency, so it is never kept.
+    edges = [('d3', name, crawl_store.REPEAT if name == 'o/e'
+              else crawl_store.MATCH) for name in sorted(_RANKED_REPOS)]
+    edges.append(('d3', 'o/x', crawl_store.NO_MATCH))
+    # Every repo has three children, which have two children each.
+    for name in sorted(_RANKED_REPOS):
+      for index in xrange(3):
+        child = '{}-{}'.format(name, index)
+        edges.append((name, child))
+        edges.extend((child, '{}-{}'.format(child, grandchild_index))
+                     for grandchild_index in xrange(2))
+    self._AddEdges('downward', edges, _RANKED_REPOS)
+
+  def _GetRootChildren(self, **kwargs):
+    """Get the first level of the tree, streamed and built the same.
+
+    Args:
+      **kwargs: Keyword arguments for TreeGenerator.
+
+    Returns:
+      List of the child nodes of the origin.
+    """
+    tree = populate_tree_json.TreeGenerator(
+        'downward', 1, **kwargs).PopulateTree()
+    self.assertEqual(self._Stream(populate_tree_json.TreeGenerator(
+        'downward', 1, **kwargs)), tree)
+    return tree['children']
+
+  def testTopChildrenByStars(self):
+    children = self._GetRootChildren(top_children=2)
+    self.assertEqual(['o/a (2014)', 'o/d (2012)'],
+                     [child['name'] for child in children[:-1]])
+    self.assertEqual({'name': '+3 more', 'more': 3, 'moreStars': 60,
+                      'moreRepeats': 1, 'children': []}, children[-1])
+
+  def testTopChildrenByDate(self):
+    children = self._GetRootChildren(
+        top_children=2, rank_by=populate_tree_json.RANK_BY_DATE)
+    self.assertEqual(['o/b (2011)', 'o/d (2012)'],
+                     [child['name'] for child in children[:-1]])
+    self.assertEqual({'name': '+3 more', 'more': 3, 'moreStars': 100,
+                      'moreRepeats': 1, 'children': []}, children[-1])
+
+  def testAllChildrenByDate(self):
+    children = self._GetRootChildren(
+        top_children=len(_RANKED_REPOS),
+        rank_by=populate_tree_json.RANK_BY_DATE)
+    self.assertEqual(
+        ['o/b (2011)', 'o/d (2012)', 'o/e (2013)', 'o/a (2014)', 'o/c (2016)'],
+        [child['name'] for child in children])
+
+  def testNodeBudget(self):
+    # The tree has 5 + 15 + 30 nodes below the origin.
+    for node_budget in (1, 4, 12, 30, 49, 50):
+      trees = (
+          populate_tree_json.TreeGenerator(
+              'downward', 3, node_budget=node_budget).PopulateTree(),
+          self._Stream(populate_tree_json.TreeGenerator(
+              'downward', 3, node_budget=node_budget)))
+      for tree in trees:
+        # Summary nodes count against the budget too; the tree is cut to
+        # fit it, but not far below it.
+        num_nodes = len(list(_IterTree(tree))) - 1
+        self.assertLessEqual(num_nodes, node_budget)
+        self.assertGreater(num_nodes, node_budget // 2)
+    # The whole tree fits the last budget.
+    self.assertEqual(50, num_nodes)
+
+
+class StreamingParityTest(TreeTestCase):
+  """Check that the streamed tree is the tree PopulateTree builds."""
+
+  def setUp(self):
+    TreeTestCase.setUp(self)
+    # A dense random graph, with cycles, shared subtrees, repeats and repos
+    # without the dependency.
+    rng = random.Random(2)
+    repos = ['user{}/lib-{}'.format(index % 7, index) for index in xrange(60)]
+    edges = [('d3', repo) for repo in rng.sample(repos, 6)]
+    for repo in repos:
+      for child in rng.sample(repos, rng.randint(0, 5)):
+        if child != repo:
+          edges.append((repo, child, rng.choice(
+              (crawl_store.MATCH,) * 3 +
+              (crawl_store.REPEAT, crawl_store.NO_MATCH))))
+    repo_details = dict(
+        (repo, (rng.randint(0, 500), '20{:02d}-01-01T00:00:00Z'.format(
+            rng.randint(10, 16)))) for repo in repos)
+    for direction in ('downward', 'upward'):
+      self._AddEdges(direction, edges, repo_details)
+
+  def _AssertParity(self, indent=None, **kwargs):
+    """Check both directions for the given TreeGenerator arguments.
+
+    Args:
+      indent: Integer for the spaces to indent the streamed output with, or
+          None for compact output.
+      **kwargs: Keyword arguments for TreeGenerator.
+    """
+    for direction in ('downward', 'upward'):
+      tree = populate_tree_json.TreeGenerator(
+          direction, 5, **kwargs).PopulateTree()
+      self.assertEqual(
+          self._Stream(populate_tree_json.TreeGenerator(
+              direction, 5, **kwargs), indent),
+          json.loads(json.dumps(tree)))
+
+  def testAllChildren(self):
+    self._AssertParity()
+
+  def testPrettyOutput(self):
+    self._AssertParity(indent=2)
+
+  def testTopChildren(self):
+    self._AssertParity(top_children=2)
+
+  def testTopChildrenByDate(self):
+    self._AssertParity(top_children=2,
+                       rank_by=populate_tree_json.RANK_BY_DATE)
+
+  def testNodeBudget(self):
+    self._AssertParity(node_budget=50)
+
+  def testTopChildrenAndNodeBudget(self):
+    self._AssertParity(top_children=3, node_budget=80)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,157 @@
+"""Rate limit scheduler for GitHub API requests.
+
+GitHub keeps separate quotas for the search API and for the rest of the API
+(the core quota), and reports both in the X-RateLimit-* headers of every
+response. Instead of sleeping for a fixed time between keywords, every
+request takes a token from the bucket of its quota, and the bucket is synced
+with the headers of every response. Requests run at full speed while there
+is quota left, and wait until the reset time once the quota runs out.
+"""
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+# Seconds to wait past the reported reset time, to allow for clock skew
+# between us and GitHub.
+RESET_MARGIN_SECONDS = 1
+
+
+def GetResource(git_url):
+  """Get the rate limit resource for a GitHub API URL.
+
+  Args:
+    git_url: String for GitHub API URL.
+
+  Returns:
+    String for the resource, either 'search' or 'core'.
+  """
+  return 'search' if '/search/' in git_url else 'core'
+
+
+class _Bucket(object):
+  """Token bucket for a single rate limit resource.
+
+  Attributes:
+    limit: Integer for the quota per window, None until a response is seen.
+    remaining: Integer for the tokens left in the window, None until a
+        response is seen.
+    reset: Integer for the epoch seconds the window resets at.
+  """
+
+  def __init__(self):
+    self.limit = None
+    self.remaining = None
+    self.reset = 0
+
+
+class RateLimitScheduler(object):
+  """Schedule GitHub API requests by the quota left for each resource.
+
+  The scheduler is shared by all crawlers and threads, so the buckets are
+  guarded by a condition variable.
+  """
+
+  def __init__(self):
+    """Set up empty buckets and usage counters."""
+    self._buckets = collections.defaultdict(_Bucket)
+    self._condition = threading.Condition()
+    # Number of requests that used up quota, by resource.
+    self._used = collections.Counter()
+
+  def Acquire(self, resource):
+    """Take a token for a request, waiting for the reset if there is none.
+
+    Args:
+      resource: String for the rate limit resource of the request.
+    """
+    with self._condition:
+      bucket = self._buckets[resource]
+      while bucket.remaining is not None and bucket.remaining <= 0:
+        wait_seconds = bucket.reset + RESET_MARGIN_SECONDS - time.time()
+        if wait_seconds <= 0:
+          # The window is reset, so let requests through until a response
+          # tells us the new quota.
+          bucket.remaining = bucket.limit
+          break
+        logging.warning('No %s quota left, waiting %d seconds until reset.',
+                        resource, wait_seconds)
+        self._condition.wait(wait_seconds)
+      if bucket.remaining is not None:
+        bucket.remaining -= 1
+      self._used[resource] += 1
+
+  def Refund(self, resource):
+    """Give back the token of a request that did not count against the quota.
+
+    Args:
+      resource: String for the rate limit resource of the request.
+    """
+    with self._condition:
+      bucket = self._buckets[resource]
+      if bucket.remaining is not None:
+        bucket.remaining += 1
+      self._used[resource] -= 1
+      self._condition.notify_all()
+
+  def Update(self, resource, headers):
+    """Sync the bucket with the rate limit headers of a response.
+
+    Args:
+      resource: String for the rate limit resource of the request.
+      headers: Mapping of response headers, or None if there were none.
+
+    Returns:
+      Integer for the remaining quota, or None if the headers have none.
+    """
+    if not headers or headers.get('X-RateLimit-Remaining') is None:
+      return None
+    remaining = int(headers.get('X-RateLimit-Remaining'))
+    reset = int(headers.get('X-RateLimit-Reset') or 0)
+    with self._condition:
+      bucket = self._buckets[headers.get('X-RateLimit-Resource') or resource]
+      if headers.get('X-RateLimit-Limit') is not None:
+        bucket.limit = int(headers.get('X-RateLimit-Limit'))
+      # Responses of concurrent requests can arrive out of order, so within
+      # the same window only ever lower our count of the remaining tokens.
+      if (bucket.remaining is None or reset != bucket.reset or
+          remaining < bucket.remaining):
+        bucket.remaining = remaining
+      bucket.reset = reset
+      self._condition.notify_all()
+    return remaining
+
+  def GetUsage(self):
+    """Get the number of requests that used up quota so far.
+
+    Returns:
+      Dictionary of resource to number of requests.
+    """
+    with self._condition:
+      return dict(self._used)
+
+  @contextlib.contextmanager
+  def Phase(self, phase_name):
+    """Report the quota used by the requests made within the block.
+
+    Args:
+      phase_name: String for the crawl phase to report usage for.
+
+    Yields:
+      Nothing, the usage is printed when the block exits.
+    """
+    start_usage = self.GetUsage()
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      end_usage = self.GetUsage()
+      phase_usage = dict(
+          (resource, count - start_usage.get(resource, 0))
+          for resource, count in end_usage.iteritems())
+      logging.info('Quota used by %s in %.1f seconds: %s',
+                   phase_name, time.time() - start_time, ', '.join(
+                       '%s=%d' % item
+                       for item in sorted(phase_usage.iteritems())))
@@ -1,14 +1,44 @@
 """Utility file for all D3 tree."""
 
 import collections
+import contextlib
 import cPickle
 import json
+import logging
 import os
-# Using pprint instead of the usual logging as I am doing data exploration as
-# well at the same time, and will need to see the data structure.
-from pprint import pprint
+import re
 import sys
-import urllib2 as url
+import threading
+
+import crawl_store
+import http_cache
+import http_pool
+import instrumentation
+import rate_limiter
+
+# Directory of the crawl data, which can be moved with GIT_TREE_DATA_DIR, for
+# example to keep benchmark runs apart from the real crawl.
+DATA_DIR = os.environ.get('GIT_TREE_DATA_DIR') or os.path.join(
+    os.path.dirname(__file__), 'data')
+
+# Shared by all crawlers, so that every request is scheduled by the quota left.
+RATE_LIMITER = rate_limiter.RateLimitScheduler()
+# Connections are kept alive and reused by all crawlers and threads.
+HTTP_POOL = http_pool.ConnectionPool()
+# Responses are cached across runs, so a re-crawl mostly revalidates them.
+RESPONSE_CACHE = http_cache.ResponseCache(os.path.join(
+    DATA_DIR, 'http_cache.sqlite'))
+# Phase timers and counters of the run, see instrumentation.
+METRICS = instrumentation.METRICS
+# Journal of all evaluated repos, which the raw tree data is rebuilt from.
+CRAWL_STORE = crawl_store.CrawlStore(os.path.join(
+    DATA_DIR, 'crawl_store.sqlite'))
+# Semaphore for the requests in flight over all crawlers and threads, or None
+# for no limit, see LimitRequests.
+REQUEST_SLOTS = None
+
+# Link header entry of the next page of a paginated response.
+_NEXT_LINK_PATTERN = re.compile(r'<([^>]+)>;\s*rel="next"')
 
 
 def PickleTree(tree_data, file_name):
@@ -20,12 +50,10 @@ def PickleTree(tree_data, file_name):
     tree_data: Dictionary of tree info to be pickled.
     file_name: String for pickle file name to dump data in.
   """
-  pcl_file = os.path.join(os.path.dirname(__file__), 'data', '{}.pcl'.format(
-      file_name))
-  with open(pcl_file, 'wb') as pcl:
+  pcl_file = os.path.join(DATA_DIR, '{}.pcl'.format(file_name))
+  with METRICS.Time('persist'), open(pcl_file, 'wb') as pcl:
     cPickle.dump(tree_data, pcl, protocol=-1)
-  pprint('Pickled: %s (%d parent results)' % (
-      file_name, len(tree_data)))
+  logging.info('Pickled: %s (%d parent results)', file_name, len(tree_data))
 
 
 def GetTreePickle(file_name):
@@ -40,12 +68,11 @@ def GetTreePickle(file_name):
   Returns:
     Either empty or the found pickled tree dictionary.
   """
-  pcl_file = os.path.join(os.path.dirname(__file__), 'data', '{}.pcl'.format(
-      file_name))
+  pcl_file = os.path.join(DATA_DIR, '{}.pcl'.format(file_name))
   if os.path.isfile(pcl_file):
     with open(pcl_file, 'rb') as pcl:
       tree_dict = cPickle.load(pcl)
-      pprint('Get pickled %s.' % file_name)
+      logging.info('Get pickled %s.', file_name)
       return tree_dict
   return collections.defaultdict(dict)
 
@@ -53,15 +80,42 @@ def GetTreePickle(file_name):
 def GitURLOpener(git_url):
   """Read content from GitHub API.
 
+  Args:
+    git_url: String for GitHub API URL.
+
+  Returns:
+    Tuple with (dictionary for response JSON content, integer for remaining
+    query rate, or None if the response is served from cache).
+  """
+  _, content, remain_limit, _ = GitAPIRequest(git_url)
+  return (content, remain_limit)
+
+
+def GitAPIRequest(git_url, revalidate=False):
+  """Read content and status from GitHub API.
+
   Will add in headers to help make authorized calls with better formatting.
+  Responses are served from RESPONSE_CACHE while fresh, and revalidated with
+  a conditional request once stale; search results are stale right away by
+  default, see http_cache.
 
   Args:
     git_url: String for GitHub API URL.
+    revalidate: Boolean for whether to revalidate a cached response even if
+        it is still fresh.
 
   Returns:
-    Tuple with (dictionary for response JSON content, integer for remaining
-    query rate).
+    Tuple with (integer for HTTP status, dictionary for response JSON content,
+    integer for remaining query rate, or None if the response is served from
+    cache, string for the URL of the next page, or None if there is none). A
+    revalidated cached response has status 200.
   """
+  cache_entry = RESPONSE_CACHE.Get(git_url)
+  if (cache_entry and not revalidate and
+      RESPONSE_CACHE.IsFresh(cache_entry, git_url)):
+    RESPONSE_CACHE.RecordHit()
+    METRICS.Increment('cache_hits')
+    return (200, json.loads(cache_entry.body), None, cache_entry.next_url)
   # Add authentication and accept format to Git API request, for the basic
   # crawler, we set token as the first argument.
   api_headers = [
@@ -69,45 +123,168 @@ def GitURLOpener(git_url):
       ('Authorization', 'token {user_token}'.format(
           user_token=(sys.argv[1] or None))),
   ]
-  req = url.Request(url=git_url)
-  for header in api_headers:
-    req.add_header(*header)
-  try:
-    response = url.urlopen(req)
+  if cache_entry:
+    api_headers.extend(cache_entry.GetConditionalHeaders())
+  resource = rate_limiter.GetResource(git_url)
+  # Read once, so that the slot taken is the one given back.
+  request_slots = REQUEST_SLOTS
+  while True:
+    RATE_LIMITER.Acquire(resource)
+    if request_slots:
+      request_slots.acquire()
+    try:
+      response = HTTP_POOL.Request(git_url, api_headers)
+    finally:
+      if request_slots:
+        request_slots.release()
+    remain_limit = RATE_LIMITER.Update(resource, response.headers)
+    METRICS.Increment('api_calls_' + resource)
+    if remain_limit is not None:
+      METRICS.SetGauge('quota_remaining_' + resource, remain_limit)
+    # Retry once the quota is reset if the request was rejected for running
+    # out of it.
+    if response.status == 403 and remain_limit == 0:
+      METRICS.Increment('rate_limited')
+      logging.warning('Rate limit exceeded for %s, retrying after reset.',
+                      git_url)
+      continue
+    break
+  # The cached content is still valid, and the request did not count against
+  # the quota.
+  if response.status == 304 and cache_entry:
+    RATE_LIMITER.Refund(resource)
+    RESPONSE_CACHE.Touch(git_url)
+    RESPONSE_CACHE.RecordHit(revalidated=True)
+    METRICS.Increment('cache_revalidated')
+    logging.debug('Revalidated cached response for %s', git_url)
+    return (200, json.loads(cache_entry.body), remain_limit,
+            cache_entry.next_url)
   # If no such content exists, throw and error and return empty output.
-  except url.HTTPError, err:
-    pprint('Cannot retrieve URL info, http error %s' % err)
-    return ({}, 0)
-  content = json.loads(response.read())
-  remain_limit = int(response.info().getheader('X-RateLimit-Remaining'))
-  pprint('Retrieved response for %s, now with %s remaining limit' % (
-      git_url, remain_limit))
-  return (content, remain_limit)
+  if response.status != 200:
+    # Most manifest files are missing, which is not worth a warning.
+    if response.status == 404:
+      METRICS.Increment('not_found')
+      logging.debug('Not found: %s', git_url)
+    else:
+      logging.warning('Cannot retrieve URL info, http error HTTP Error %d: %s',
+                      response.status, response.reason)
+    return (response.status, {}, 0, None)
+  content = json.loads(response.body)
+  next_link = _NEXT_LINK_PATTERN.search(
+      response.headers.getheader('Link') or '')
+  next_url = next_link.group(1) if next_link else None
+  RESPONSE_CACHE.RecordMiss()
+  METRICS.Increment('cache_misses')
+  RESPONSE_CACHE.Put(git_url, response.body, response.headers.getheader('ETag'),
+                     response.headers.getheader('Last-Modified'), next_url)
+  logging.debug('Retrieved response for %s, now with %s remaining limit',
+                git_url, remain_limit)
+  return (response.status, content, remain_limit, next_url)
+
+
+@contextlib.contextmanager
+def LimitRequests(max_in_flight):
+  """Limit the GitHub API requests in flight while the context is active.
+
+  The limit holds for all threads together, however many of them make
+  requests, such as the keyword threads and the manifest fetch pool of a
+  concurrent crawl.
+
+  Args:
+    max_in_flight: Integer for the most requests in flight at once.
+
+  Yields:
+    Nothing, the limit is lifted when the block exits.
+  """
+  global REQUEST_SLOTS
+  previous_slots = REQUEST_SLOTS
+  REQUEST_SLOTS = threading.BoundedSemaphore(max_in_flight)
+  try:
+    yield
+  finally:
+    REQUEST_SLOTS = previous_slots
+
+
+def IterGitPages(git_url, max_pages, revalidate=False):
+  """Lazily get the pages of a paginated GitHub API response.
+
+  Pages are followed through the next links of the Link header, and each
+  page is only requested once the previous one is used up, so stopping the
+  iteration early saves the requests of the remaining pages.
+
+  Args:
+    git_url: String for GitHub API URL of the first page.
+    max_pages: Integer for the most pages to request.
+    revalidate: Boolean for whether to revalidate cached pages even if they
+        are still fresh.
+
+  Yields:
+    Dictionary for the response JSON content of each page.
+  """
+  for _ in xrange(max_pages):
+    status, content, _, next_url = GitAPIRequest(git_url, revalidate)
+    if status != 200:
+      return
+    yield content
+    if not next_url:
+      return
+    git_url = next_url
 
 
-def CreateAllDependentRepos(direction, end_depth):
-  """Create the total dependent unique repo names.
+def ImportTreePickles(direction, end_depth, root_keyword='d3'):
+  """Import raw data pickle files from earlier crawls into CRAWL_STORE.
 
-  Create a set that contains all found repo names that are dependent on the
-  overall tree nodes.
+  The pickle files are keyed by repo name, so parents are resolved to the
+  full name of the repo matched with that name in the previous depth, and
+  repeated repos to the full name of the repo they repeat. Repos without
+  dependency were pickled without their detail, and are not imported.
 
   Args:
     direction: String for tree crawling direction.
-    end_depth: Integer for the ending raw_data file to go through to create the
-        all_searched_repo file.
+    end_depth: Integer for the ending raw_data file to import.
+    root_keyword: String for the keyword the crawl started from.
   """
-  all_dependend_repos = set()
+  # Dictionary of repo name to full name for all repos matched so far.
+  expanded_repos = {}
+  # Dictionary of keyword to the full names of the repos it was found for.
+  keyword_parents = {root_keyword: [root_keyword]}
   for depth in xrange(1, (end_depth + 1)):
     data_file = GetTreePickle('{}_raw_data_depth_{}'.format(
         direction, depth))
-    pprint('Looping through %d parent nodes in depth %d' % (
-        len(data_file), depth))
-    for parent, children in data_file.iteritems():
-      matched_repo_names = [
-          child_name for child_name, child_info in children.iteritems()
-          if child_info]
-      pprint('%s has %d dependent repos out of %d total searched repos.' % (
-          parent, len(matched_repo_names), len(children)))
-      all_dependend_repos |= set(matched_repo_names)
-  PickleTree(all_dependend_repos, '{}_all_dependent_repo_names'.format(
-      direction))
+    logging.info('Importing %d parent nodes in depth %d', len(data_file),
+                 depth)
+    next_keyword_parents = collections.defaultdict(list)
+    for keyword, children in data_file.iteritems():
+      # For upward, each keyword maps to the detail of a single repo.
+      if direction == 'upward':
+        children = {keyword: children}
+      for child_name, child_info in children.iteritems():
+        if child_info:
+          status = crawl_store.MATCH
+          child_full_name = child_info['full_name']
+          CRAWL_STORE.AddNode(crawl_store.RepoNode.FromSearchItem(child_info))
+          expanded_repos[child_name] = child_full_name
+        elif child_info == {} and child_name in expanded_repos:
+          status = crawl_store.REPEAT
+          child_full_name = expanded_repos[child_name]
+        else:
+          continue
+        for parent in keyword_parents.get(keyword, []):
+          CRAWL_STORE.AddEdge(
+              direction, depth, parent, child_full_name, keyword, status)
+        if status == crawl_store.REPEAT:
+          continue
+        if direction == 'downward':
+          next_keyword_parents[child_name].append(child_full_name)
+          continue
+        for dependency, version in child_info['all_dependencies'].iteritems():
+          # Dependencies that were already crawled are marked with '', and
+          # were not searched for again in the next depth.
+          if version == '' and dependency in expanded_repos:
+            CRAWL_STORE.AddEdge(
+                direction, depth + 1, child_full_name,
+                expanded_repos[dependency], dependency, crawl_store.REPEAT)
+          else:
+            next_keyword_parents[dependency].append(child_full_name)
+    keyword_parents = next_keyword_parents
+  CRAWL_STORE.Flush()